@@ -7,7 +7,11 @@ from sqlalchemy import engine_from_config
 from sqlalchemy import pool
 from alembic import context
 
-from message_repository import Base
+from src.message_repository import Base
+import src.coordination  # noqa: F401 - registers the agent_leases table on Base.metadata
+import src.message_store  # noqa: F401 - registers the api_messages table on Base.metadata
+import src.dead_letters  # noqa: F401 - registers the dead_letters table on Base.metadata
+import src.partitioned_repository  # noqa: F401 - registers the recipient_messages table on Base.metadata
 from dotenv import load_dotenv
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
 
@@ -0,0 +1,33 @@
+"""agent leases
+
+Revision ID: 3f7b2c91d4e8
+Revises: 0c32213bfd7a
+Create Date: 2026-10-19 09:12:44.503118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f7b2c91d4e8'
+down_revision: Union[str, None] = '0c32213bfd7a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('agent_leases',
+    sa.Column('agent_name', sa.String(), nullable=False),
+    sa.Column('owner', sa.String(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('agent_name')
+    )
+    op.create_index(op.f('ix_agent_leases_expires_at'), 'agent_leases', ['expires_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_agent_leases_expires_at'), table_name='agent_leases')
+    op.drop_table('agent_leases')
@@ -0,0 +1,31 @@
+"""api message versions
+
+Revision ID: b5e90c3d7a14
+Revises: 8d41e6a07c2f
+Create Date: 2026-10-19 16:31:52.740961
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b5e90c3d7a14'
+down_revision: Union[str, None] = '8d41e6a07c2f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    versions = op.create_table('api_message_versions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.bulk_insert(versions, [{'id': 1, 'version': 0}])
+
+
+def downgrade() -> None:
+    op.drop_table('api_message_versions')
@@ -0,0 +1,40 @@
+"""dead letters
+
+Revision ID: d2a8f4e61b09
+Revises: b5e90c3d7a14
+Create Date: 2026-10-19 18:05:27.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd2a8f4e61b09'
+down_revision: Union[str, None] = 'b5e90c3d7a14'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('dead_letters',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('delivery_key', sa.String(), nullable=False),
+    sa.Column('recipient', sa.String(), nullable=False),
+    sa.Column('message', sa.Text(), nullable=False),
+    sa.Column('reason', sa.String(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('first_failed_at', sa.DateTime(), nullable=False),
+    sa.Column('last_failed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('delivery_key', 'recipient', name='uq_dead_letters_delivery_key_recipient')
+    )
+    op.create_index(op.f('ix_dead_letters_reason'), 'dead_letters', ['reason'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_dead_letters_reason'), table_name='dead_letters')
+    op.drop_table('dead_letters')
@@ -0,0 +1,54 @@
+"""recipient messages
+
+Revision ID: e7c3a9f15d62
+Revises: d2a8f4e61b09
+Create Date: 2026-10-19 19:22:08.641377
+
+On PostgreSQL the table is partitioned by hash of recipient into MESSAGE_PARTITIONS
+(default 16) partitions, recipient_messages_p0 ... recipient_messages_p15; the count is
+fixed by this migration. Elsewhere it is a plain table; the SQLite shards used by
+PartitionedMessageRepository are separate files that it creates itself.
+
+"""
+import os
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7c3a9f15d62'
+down_revision: Union[str, None] = 'd2a8f4e61b09'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    partitioned = op.get_bind().dialect.name == 'postgresql'
+    op.create_table('recipient_messages',
+    sa.Column('recipient', sa.String(), nullable=False),
+    sa.Column('delivery_key', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('collected_at', sa.DateTime(), nullable=True),
+    sa.Column('delivered_at', sa.DateTime(), nullable=True),
+    sa.Column('from_address', sa.String(), nullable=True),
+    sa.Column('to_address', sa.String(), nullable=True),
+    sa.Column('data', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('recipient', 'delivery_key'),
+    **({'postgresql_partition_by': 'HASH (recipient)'} if partitioned else {})
+    )
+    if partitioned:
+        partitions = int(os.getenv('MESSAGE_PARTITIONS') or 16)
+        for index in range(partitions):
+            op.execute(f"CREATE TABLE recipient_messages_p{index} PARTITION OF recipient_messages "
+                       f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {index})")
+    # Created on the parent, so PostgreSQL adds it to every partition
+    op.create_index('ix_recipient_messages_recipient_created_at', 'recipient_messages', ['recipient', 'created_at'],
+                    unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_recipient_messages_recipient_created_at', table_name='recipient_messages')
+    # Dropping the parent drops its partitions
+    op.drop_table('recipient_messages')
@@ -0,0 +1,31 @@
+"""drop api message versions
+
+Revision ID: f4b1d7e2c835
+Revises: e7c3a9f15d62
+Create Date: 2026-10-19 21:12:40.518327
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f4b1d7e2c835'
+down_revision: Union[str, None] = 'e7c3a9f15d62'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.drop_table('api_message_versions')
+
+
+def downgrade() -> None:
+    versions = op.create_table('api_message_versions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.bulk_insert(versions, [{'id': 1, 'version': 0}])
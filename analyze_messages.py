@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Reports delivery latency, per-agent throughput and backlog age from the messages table
+at DATABASE_URL, or from the recipient_messages table when MESSAGE_PARTITIONS is set. The
+table is read in chunks of --chunk-size rows, so memory stays flat however long the history is.
+"""
+import argparse
+import json
+import os
+import sys
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, 'src'))
+
+from src.analytics import analyze
+
+
+def _seconds(value) -> str:
+    if value is None:
+        return '-'
+    if value < 1:
+        return f"{value * 1000:.1f}ms"
+    if value < 120:
+        return f"{value:.1f}s"
+    if value < 7200:
+        return f"{value / 60:.1f}m"
+    return f"{value / 3600:.1f}h"
+
+
+def print_report(report) -> None:
+    print(f"📊 {report['messages']} messages")
+    print("\nLatency            count      p50      p90      p99      max")
+    for stage, summary in report['latency'].items():
+        print(f"  {stage:<24} {summary['count']:>7} " + " ".join(
+            f"{_seconds(summary.get(key)):>8}" for key in ('p50_s', 'p90_s', 'p99_s', 'max_s')))
+
+    window = report['delivery_window']
+    if window['hours']:
+        print(f"\nDeliveries from {window['first']} to {window['last']} ({window['hours']:.1f}h)")
+    for title, key in (('Busiest senders', 'delivered_from'), ('Busiest recipients', 'delivered_to')):
+        print(f"\n{title}:")
+        for agent, counts in report['agents'][key].items():
+            print(f"  {agent:<30} {counts['messages']:>8} delivered  {counts['per_hour']:>8.1f}/h")
+
+    backlog = report['backlog']
+    print(f"\nBacklog: {backlog['undelivered']} undelivered, {backlog['uncollected']} of them not collected yet")
+    if backlog['undelivered']:
+        age = backlog['age']
+        print(f"  age p50 {_seconds(age['p50_s'])}, p99 {_seconds(age['p99_s'])}, oldest {_seconds(age['max_s'])}")
+        for agent, count in backlog['pending_for'].items():
+            print(f"  {agent:<30} {count:>8} waiting")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyzes Agent Post message history.")
+    parser.add_argument('--db-url', help="SQLAlchemy URL of the exchange database (default: DATABASE_URL)")
+    parser.add_argument('--chunk-size', type=int, default=50000, help="Rows loaded per chunk (default: 50000)")
+    parser.add_argument('--top', type=int, default=10, help="Agents listed per table (default: 10)")
+    parser.add_argument('--partitions', type=int,
+                        help="Read the partitioned recipient_messages table (default: MESSAGE_PARTITIONS)")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args()
+
+    load_dotenv(dotenv_path=os.path.join(BASE_DIR, '.env'))
+    db_url = args.db_url or os.getenv('DATABASE_URL')
+    if not db_url:
+        print("❌ DATABASE_URL environment variable not set in .env. Exiting.")
+        sys.exit(1)
+
+    engine = create_engine(db_url)
+    try:
+        partitions = args.partitions if args.partitions is not None else int(os.getenv('MESSAGE_PARTITIONS') or 0)
+        report = analyze(engine, chunk_size=args.chunk_size, top=args.top, partitions=partitions)
+    finally:
+        engine.dispose()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,116 @@
-from flask import Flask, request, jsonify
+import hashlib
+import json
+import os
+import sys
+import threading
+
+from dotenv import load_dotenv
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask_socketio import SocketIO, join_room, leave_room
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+# The exchange modules import their siblings from 'src' directly
+sys.path.insert(0, os.path.join(BASE_DIR, 'src'))
+
+from src.ingestion import IngestionWorker, outbox_entries, token_matches
+from src.message_store import create_message_store
+from src.push import ALL_RECIPIENTS, PushBroker, recipients_of
+from src.response_cache import ResponseCache
+from src.routing import normalize_address
+
+load_dotenv(dotenv_path=os.path.join(BASE_DIR, '.env'))
 
 app = Flask(__name__)
+socketio = SocketIO(app)
+
+# Messages posted to /messages. With MESSAGE_STORE_URL (a SQLAlchemy URL) they are kept in
+# a database shared by all server workers; without it, in this process.
+store = create_message_store(os.getenv('MESSAGE_STORE_URL'))
+
+# Serialized GET /messages bodies for the store's current version, per filter and page
+response_cache = ResponseCache()
+MAX_PAGE_SIZE = 1000
+
+# Subscribers waiting for new messages over server-sent events
+broker = PushBroker()
+
+# Seconds between keep-alive comments on idle event streams
+STREAM_KEEPALIVE = 15
+
+# Agents push outgoing messages to /outbox with the exchange's EXTERNAL_API_TOKEN;
+# the directory used to route them is refreshed every INGEST_DIRECTORY_TTL seconds.
+# Accepted messages are journaled in INGEST_JOURNAL_PATH (one file per server worker) and
+# delivered after a restart; with EXCHANGE_PERSIST_MESSAGES they are also saved to DATABASE_URL.
+INGEST_DIRECTORY_TTL = int(os.getenv('INGEST_DIRECTORY_TTL', '60'))
+INGEST_JOURNAL_PATH = os.getenv('INGEST_JOURNAL_PATH') or os.path.join(BASE_DIR, 'ingestion.journal')
+# Pushed bodies get the exchange's size limits: MESSAGE_SPOOL_THRESHOLD, MESSAGE_MAX_BYTES, and
+# OUTBOX_MAX_RESPONSE_BYTES for a whole request (to any endpoint), which is refused with a 413
+# before it is read
+MESSAGE_SPOOL_THRESHOLD = int(os.getenv('MESSAGE_SPOOL_THRESHOLD') or 0) or None
+MESSAGE_MAX_BYTES = int(os.getenv('MESSAGE_MAX_BYTES') or 0) or None
+OUTBOX_MAX_RESPONSE_BYTES = int(os.getenv('OUTBOX_MAX_RESPONSE_BYTES') or 0) or None
+app.config['MAX_CONTENT_LENGTH'] = OUTBOX_MAX_RESPONSE_BYTES
+ingestion = None
+ingestion_lock = threading.Lock()
+
 
-# In-memory storage for messages
-messages = []
+def get_ingestion() -> IngestionWorker:
+    """Creates the delivery worker for pushed messages on first use."""
+    global ingestion
+    with ingestion_lock:
+        if ingestion is None:
+            ingestion = _create_ingestion()
+    return ingestion
+
+
+def _create_ingestion() -> IngestionWorker:
+    from src.async_message_repository import AsyncMessageRepository, BackgroundPersistence
+    from src.city_api import CityAPI
+    from src.external_api import ExternalAPI
+    from src.journal import Journal
+    from src.message_service import MessageService
+    from src.state import create_state_backend
+
+    # serve.py numbers its forked workers; each one keeps its own journal
+    worker_index = os.getenv('WEB_WORKER_INDEX')
+    journal_path = f"{INGEST_JOURNAL_PATH}.{worker_index}" if worker_index else INGEST_JOURNAL_PATH
+    persistence = None
+    if os.getenv('EXCHANGE_PERSIST_MESSAGES', '').lower() in ('1', 'true', 'yes') and os.getenv('DATABASE_URL'):
+        persistence = BackgroundPersistence(AsyncMessageRepository(os.getenv('DATABASE_URL')))
+
+    # Shared with the exchange workers, so that a message both pushed here and collected from
+    # an outbox is delivered once, and that inboxes skipped by the exchange are skipped here too
+    state = create_state_backend(os.getenv('STATE_BACKEND_URL'))
+
+    compress_threshold = os.getenv('INBOX_COMPRESS_THRESHOLD')
+    service = MessageService(
+        city_api=CityAPI(api_url=os.getenv('CITY_API_URL')),
+        external_api=ExternalAPI(
+            token=os.getenv('EXTERNAL_API_TOKEN'),
+            compress_threshold=int(compress_threshold) if compress_threshold else None,
+            spool_threshold=MESSAGE_SPOOL_THRESHOLD,
+            max_message_bytes=MESSAGE_MAX_BYTES,
+            max_response_bytes=OUTBOX_MAX_RESPONSE_BYTES,
+            state=state,
+            circuit_failures=int(os.getenv('CIRCUIT_FAILURES') or 5),
+            circuit_seconds=int(os.getenv('CIRCUIT_SECONDS') or 60),
+        ),
+        journal=Journal(journal_path),
+        persistence=persistence,
+        state=state,
+        dedup_seconds=int(os.getenv('DEDUP_SECONDS') or 86400),
+        claim_seconds=int(os.getenv('DEDUP_CLAIM_SECONDS') or 600),
+    )
+    return IngestionWorker(service, directory_ttl=INGEST_DIRECTORY_TTL)
+
+
+def publish(message) -> None:
+    """Pushes a newly stored message to its recipients' Socket.IO rooms and event streams."""
+    recipients = recipients_of(message)
+    broker.publish(message, recipients)
+    rooms = {f"inbox:{normalize_address(recipient)}" for recipient in recipients} | {f"inbox:{ALL_RECIPIENTS}"}
+    # A single emit to all rooms reaches each client once even if it joined several of them
+    socketio.emit('new_message', message, to=sorted(rooms))
 
 
 @app.route('/messages', methods=['GET', 'POST'])
@@ -12,11 +119,137 @@ def handle_messages():
         data = request.json
         if not data or 'message' not in data:
             return jsonify({"error": "Invalid input, 'message' key is required"}), 400
-        messages.append(data['message'])
+        store.append(data['message'])
+        publish(data['message'])
         return jsonify({"message": "Message added successfully!"}), 201
     elif request.method == 'GET':
-        return jsonify({"messages": messages}), 200
+        return list_messages()
+
+
+def list_messages():
+    """
+    Answers GET /messages from the response cache, or with 304 when the client's
+    If-None-Match already names the current version.
+
+    Optional query parameters: `recipient` (repeatable) keeps the messages addressed to
+    those recipients; `page` (from 1) with `per_page` returns one page of the result.
+    """
+    recipients = tuple(sorted({normalize_address(recipient) for recipient in request.args.getlist('recipient')}))
+    try:
+        page = int(request.args['page']) if 'page' in request.args else None
+        per_page = int(request.args.get('per_page', 100))
+    except ValueError:
+        return jsonify({"error": "page and per_page must be integers"}), 400
+    if (page is not None and page < 1) or not 1 <= per_page <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"page must be at least 1 and per_page between 1 and {MAX_PAGE_SIZE}"}), 400
+    key = (recipients, page, per_page if page else None)
+
+    version = store.version()
+    if request.if_none_match.contains(_etag(version, key)):
+        response = Response(status=304)
+        response.set_etag(_etag(version, key))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    body = response_cache.get(version, key)
+    if body is None:
+        version, stored = store.snapshot()
+        if recipients:
+            stored = [message for message in stored
+                      if any(normalize_address(recipient) in recipients for recipient in recipients_of(message))]
+        payload = {"messages": stored}
+        if page:
+            payload = {"messages": stored[(page - 1) * per_page:page * per_page], "page": page,
+                       "per_page": per_page, "total": len(stored)}
+        body = (app.json.dumps(payload) + "\n").encode('utf-8')
+        response_cache.put(version, key, body)
+
+    response = Response(body, status=200, mimetype='application/json')
+    response.set_etag(_etag(version, key))
+    # Clients may keep the body but must revalidate it on every poll
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _etag(version: str, key) -> str:
+    # Strong: one store version and one request key always produce the same bytes
+    return hashlib.sha1(f"{version}|{key}".encode('utf-8')).hexdigest()[:24]
+
+
+@app.route('/outbox', methods=['POST'])
+def ingest_outbox():
+    """
+    Accepts outgoing messages pushed by agents or the city backend and delivers them
+    without waiting for the next outbox poll.
+
+    Requires `Authorization: Bearer <EXTERNAL_API_TOKEN>`. The body is an outbox tree as
+    returned by the agents' outbox endpoints, {"message": {...}} or {"messages": [...]}.
+    """
+    if not token_matches(request.headers.get('Authorization'), os.getenv('EXTERNAL_API_TOKEN')):
+        return jsonify({"error": "Invalid or missing token"}), 401
+    if not os.getenv('CITY_API_URL'):
+        return jsonify({"error": "Message ingestion is not configured (CITY_API_URL is not set)"}), 503
+
+    entries = outbox_entries(request.get_json(silent=True))
+    if entries is None:
+        return jsonify({"error": "Invalid input, expected outbox messages"}), 400
+
+    worker = get_ingestion()
+    pushed = worker.service.external_api.parse_outbox(entries, 'push')
+    if not pushed:
+        return jsonify({"error": "No messages found"}), 400
+    if not worker.submit(pushed):
+        return jsonify({"error": "Too many pending messages, retry later"}), 503
+
+    for msg in pushed:
+        publish({'id': msg.id, 'from': msg.from_address, 'to': msg.to_address,
+                 'data': None if msg.is_spooled else msg.data})
+    return jsonify({"accepted": len(pushed)}), 202
+
+
+@app.route('/messages/stream', methods=['GET'])
+def stream_messages():
+    """
+    Server-sent events feed of new messages.
+
+    Pass one or more `recipient` query parameters to receive only their mail; without
+    any, every new message is streamed.
+    """
+    subscription = broker.subscribe(request.args.getlist('recipient'))
+
+    def events():
+        try:
+            yield ": connected\n\n"
+            while True:
+                message = subscription.get(timeout=STREAM_KEEPALIVE)
+                if message is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield f"event: message\ndata: {json.dumps(message)}\n\n"
+        finally:
+            subscription.close()
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@socketio.on('subscribe')
+def handle_subscribe(data):
+    """Joins the rooms of the given recipients: {"recipients": ["FRBG/cityhall", ...]}, or all mail if empty."""
+    recipients = (data or {}).get('recipients') or [ALL_RECIPIENTS]
+    for recipient in recipients:
+        join_room(f"inbox:{normalize_address(recipient)}")
+    return {"subscribed": recipients}
+
+
+@socketio.on('unsubscribe')
+def handle_unsubscribe(data):
+    recipients = (data or {}).get('recipients') or [ALL_RECIPIENTS]
+    for recipient in recipients:
+        leave_room(f"inbox:{normalize_address(recipient)}")
+    return {"unsubscribed": recipients}
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    # Development server; production runs serve.py
+    socketio.run(app, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True)
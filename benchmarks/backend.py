@@ -0,0 +1,146 @@
+"""
+A local stand-in for the agent backend, used by the transport benchmark and tests.
+
+It answers every request with a small JSON body after `delay` seconds, over HTTP/1.1
+keep-alive connections and, when `http2` is enabled, over cleartext HTTP/2 with prior
+knowledge (h2c) on the same port. With `http2=False` it rejects the HTTP/2 preface the
+way an HTTP/1.1-only server does.
+"""
+import json
+import socket
+import threading
+import time
+from typing import Dict, Optional
+
+import h2.config
+import h2.connection
+import h2.events
+
+H2_PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+
+class LocalBackend:
+    def __init__(self, delay: float = 0.0, http2: bool = True, host: str = '127.0.0.1'):
+        self.delay = delay
+        self.http2 = http2
+        self.requests = 0
+        self.connections = 0
+        self.max_concurrent = 0
+        self.protocols: Dict[str, int] = {}
+        self._active = 0
+        self._lock = threading.Lock()
+        self._socket = socket.create_server((host, 0))
+        self.port = self._socket.getsockname()[1]
+        self.url = f"http://{host}:{self.port}"
+        self._closed = False
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+
+    def _respond(self, method: str, path: str, body: bytes, protocol: str) -> bytes:
+        with self._lock:
+            self.requests += 1
+            self.protocols[protocol] = self.protocols.get(protocol, 0) + 1
+            self._active += 1
+            self.max_concurrent = max(self.max_concurrent, self._active)
+        try:
+            if self.delay:
+                time.sleep(self.delay)
+            return json.dumps({'data': {'method': method, 'path': path, 'received': len(body)}}).encode('utf-8')
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def _accept(self) -> None:
+        while not self._closed:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connections += 1
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection: socket.socket) -> None:
+        try:
+            preface = connection.recv(len(H2_PREFACE), socket.MSG_PEEK)
+            if preface.startswith(b'PRI '):
+                if self.http2:
+                    self._serve_h2(connection)
+                else:
+                    connection.sendall(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            else:
+                self._serve_h1(connection)
+        except (OSError, ValueError):
+            pass
+        finally:
+            connection.close()
+
+    def _serve_h1(self, connection: socket.socket) -> None:
+        reader = connection.makefile('rb')
+        while True:
+            request_line = reader.readline()
+            if not request_line:
+                return
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            for line in iter(reader.readline, b'\r\n'):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            if headers.get('transfer-encoding', '').lower() == 'chunked':
+                body = b''
+                while True:
+                    size = int(reader.readline().split(b';')[0], 16)
+                    chunk = reader.read(size + 2)[:size]
+                    if size == 0:
+                        break
+                    body += chunk
+            else:
+                body = reader.read(int(headers.get('content-length', '0')))
+
+            payload = self._respond(method, path, body, 'HTTP/1.1')
+            connection.sendall(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                               + f'Content-Length: {len(payload)}\r\n\r\n'.encode('latin-1') + payload)
+
+    def _serve_h2(self, connection: socket.socket) -> None:
+        h2_connection = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        h2_connection.initiate_connection()
+        send_lock = threading.Lock()
+        connection.sendall(h2_connection.data_to_send())
+        streams: Dict[int, Dict] = {}
+
+        def answer(stream_id: int, request: Dict) -> None:
+            payload = self._respond(request['method'], request['path'], request['body'], 'HTTP/2')
+            with send_lock:
+                h2_connection.send_headers(stream_id, [(':status', '200'), ('content-type', 'application/json'),
+                                                       ('content-length', str(len(payload)))])
+                h2_connection.send_data(stream_id, payload, end_stream=True)
+                connection.sendall(h2_connection.data_to_send())
+
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                return
+            with send_lock:
+                events = h2_connection.receive_data(data)
+                connection.sendall(h2_connection.data_to_send())
+            for event in events:
+                if isinstance(event, h2.events.RequestReceived):
+                    headers = {name.decode() if isinstance(name, bytes) else name:
+                               value.decode() if isinstance(value, bytes) else value for name, value in event.headers}
+                    streams[event.stream_id] = {'method': headers[':method'], 'path': headers[':path'], 'body': b''}
+                elif isinstance(event, h2.events.DataReceived):
+                    streams[event.stream_id]['body'] += event.data
+                    with send_lock:
+                        h2_connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                        connection.sendall(h2_connection.data_to_send())
+                elif isinstance(event, h2.events.StreamEnded):
+                    request: Optional[Dict] = streams.pop(event.stream_id, None)
+                    if request is not None:
+                        threading.Thread(target=answer, args=(event.stream_id, request), daemon=True).start()
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    return
+
+    def close(self) -> None:
+        self._closed = True
+        self._socket.close()
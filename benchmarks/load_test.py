@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Load generator for the /messages API of app.py.
+
+Concurrent clients send a mix of POST /messages and GET /messages requests and the run
+reports requests per second, latency percentiles and error rates, overall and per
+operation. It runs against the app in-process through Flask's test client (the default,
+suitable for CI) or against a real server with --url, optionally from several processes
+so that the client side is not the bottleneck:
+
+    python benchmarks/load_test.py --requests 2000 --clients 16 --write-ratio 0.2
+    python benchmarks/load_test.py --url http://localhost:5000 --duration 30 --clients 64 --processes 4
+
+Message bodies are drawn from --payload-bytes, a comma-separated list of sizes.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# (operation, latency in seconds, succeeded)
+Sample = Tuple[str, float, bool]
+
+
+class InProcessTarget:
+    """Sends requests to a Flask app in-process; every client thread gets its own test client."""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def _client(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.app.test_client()
+        return self._local.client
+
+    def post_message(self, body: str) -> bool:
+        response = self._client().post('/messages', json={'message': body})
+        return response.status_code == 201
+
+    def get_messages(self) -> bool:
+        response = self._client().get('/messages')
+        response.get_data()
+        return response.status_code == 200
+
+
+class HttpTarget:
+    """Sends requests to a running server, over one keep-alive session per client thread."""
+
+    def __init__(self, url: str, timeout: float = 30.0):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def post_message(self, body: str) -> bool:
+        response = self._session().post(f"{self.url}/messages", json={'message': body}, timeout=self.timeout)
+        return response.status_code == 201
+
+    def get_messages(self) -> bool:
+        response = self._session().get(f"{self.url}/messages", timeout=self.timeout)
+        return response.status_code == 200
+
+
+def _client(target, count: Optional[int], deadline: Optional[float], write_ratio: float,
+            payload_sizes: Sequence[int], seed: int) -> List[Sample]:
+    rng = random.Random(seed)
+    samples: List[Sample] = []
+    while (count is None or len(samples) < count) and (deadline is None or time.monotonic() < deadline):
+        if rng.random() < write_ratio:
+            operation = 'write'
+            body = f"load test {seed}-{len(samples)} ".ljust(rng.choice(payload_sizes), 'x')
+            send: Callable[[], bool] = lambda: target.post_message(body)
+        else:
+            operation = 'read'
+            send = target.get_messages
+        start = time.perf_counter()
+        try:
+            ok = send()
+        except Exception:
+            ok = False
+        samples.append((operation, time.perf_counter() - start, ok))
+    return samples
+
+
+def run_clients(target, clients: int, requests_total: Optional[int] = None, duration: Optional[float] = None,
+                write_ratio: float = 0.2, payload_sizes: Sequence[int] = (256,), seed: int = 0) -> List[Sample]:
+    """
+    Runs `clients` concurrent clients against the target until `requests_total` requests
+    are done or `duration` seconds have passed.
+
+    Returns:
+        One sample per request, in no particular order
+    """
+    if requests_total is None and duration is None:
+        raise Exception("Either requests_total or duration is required")
+    deadline = time.monotonic() + duration if duration is not None else None
+    counts = [None] * clients
+    if requests_total is not None:
+        counts = [requests_total // clients + (1 if n < requests_total % clients else 0) for n in range(clients)]
+
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        futures = [executor.submit(_client, target, counts[n], deadline, write_ratio, payload_sizes, seed + n)
+                   for n in range(clients)]
+        return [sample for future in futures for sample in future.result()]
+
+
+def _run_process(args: Tuple) -> Tuple[List[Sample], float]:
+    url, clients, requests_total, duration, write_ratio, payload_sizes, seed = args
+    start = time.perf_counter()
+    samples = run_clients(HttpTarget(url), clients, requests_total, duration, write_ratio, payload_sizes, seed)
+    return samples, time.perf_counter() - start
+
+
+def _percentile(latencies: List[float], fraction: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] if latencies else 0.0
+
+
+def summarize(samples: List[Sample], wall_seconds: float) -> Dict:
+    """Requests per second, latency percentiles in milliseconds and error rates, overall and per operation."""
+
+    def stats(subset: List[Sample]) -> Dict:
+        latencies = sorted(latency for _, latency, _ in subset)
+        errors = sum(1 for _, _, ok in subset if not ok)
+        return {
+            'requests': len(subset),
+            'requests_per_second': round(len(subset) / wall_seconds, 1) if wall_seconds else 0.0,
+            'p50_ms': round(_percentile(latencies, 0.50) * 1000, 2),
+            'p90_ms': round(_percentile(latencies, 0.90) * 1000, 2),
+            'p99_ms': round(_percentile(latencies, 0.99) * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            'errors': errors,
+            'error_rate': round(errors / len(subset), 4) if subset else 0.0,
+        }
+
+    summary = {'wall_seconds': round(wall_seconds, 3), 'all': stats(samples)}
+    for operation in ('write', 'read'):
+        summary[operation] = stats([sample for sample in samples if sample[0] == operation])
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="Base URL of a running server; the app is loaded in-process when omitted")
+    parser.add_argument('--clients', type=int, default=16, help="Concurrent clients (per process)")
+    parser.add_argument('--processes', type=int, default=1, help="Client processes, with --url only")
+    parser.add_argument('--requests', type=int, help="Total requests (default 2000 unless --duration is given)")
+    parser.add_argument('--duration', type=float, help="Seconds to run instead of a request count")
+    parser.add_argument('--write-ratio', type=float, default=0.2, help="Fraction of requests that are POSTs")
+    parser.add_argument('--payload-bytes', default='256', help="Comma-separated message sizes to draw from")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    requests_total = args.requests if args.requests or args.duration else 2000
+    payload_sizes = [int(size) for size in args.payload_bytes.split(',')]
+
+    start = time.perf_counter()
+    if args.url and args.processes > 1:
+        per_process = None if requests_total is None else -(-requests_total // args.processes)
+        jobs = [(args.url, args.clients, per_process, args.duration, args.write_ratio, payload_sizes,
+                 args.seed + n * args.clients) for n in range(args.processes)]
+        with Pool(args.processes) as pool:
+            results = pool.map(_run_process, jobs)
+        samples = [sample for process_samples, _ in results for sample in process_samples]
+    else:
+        if args.url:
+            target = HttpTarget(args.url)
+        else:
+            from app import app
+            target = InProcessTarget(app)
+        samples = run_clients(target, args.clients, requests_total, args.duration, args.write_ratio,
+                              payload_sizes, args.seed)
+    summary = summarize(samples, time.perf_counter() - start)
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"{summary['all']['requests']} requests from {args.clients * args.processes} clients "
+          f"in {summary['wall_seconds']}s against {args.url or 'the in-process app'}")
+    columns = ['requests', 'requests_per_second', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'errors', 'error_rate']
+    print('operation  ' + '  '.join(column.ljust(len(column)) for column in columns))
+    for operation in ('all', 'write', 'read'):
+        print(operation.ljust(11) + '  '.join(str(summary[operation][column]).ljust(len(column)) for column in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Replays a traffic capture through MessageService.
+
+Record one with EXCHANGE_CAPTURE_PATH=capture.jsonl.gz when running
+run_message_exchange.py; every run appends a cycle. The replay answers the cities, outbox
+and inbox requests of each cycle from the capture, so parsing and delivery run on the
+real data shapes without the agent backend:
+
+    python benchmarks/replay_capture.py capture.jsonl.gz              # as fast as possible
+    python benchmarks/replay_capture.py capture.jsonl.gz --speed 1    # at the captured speed
+
+Pipeline and coalescing settings are read from the same environment variables as
+run_message_exchange.py, so a replay can compare them on the same traffic.
+"""
+import argparse
+import json
+import os
+import sys
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, os.path.join(BASE_DIR, 'src'))
+
+from src.capture import replay_cycles
+from src.city_api import CityAPI
+from src.coalescing import CoalescingBuffer
+from src.external_api import ExternalAPI
+from src.message_service import MessageService
+from src.metrics import Metrics
+
+
+def _int_env(name: str):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', help="Capture file written with EXCHANGE_CAPTURE_PATH")
+    parser.add_argument('--speed', type=float, help="Replay speed relative to the capture; as fast as possible if omitted")
+    args = parser.parse_args()
+
+    stage_workers = {}
+    for setting in filter(None, os.getenv('PIPELINE_WORKERS', '').split(',')):
+        stage, workers = setting.split('=')
+        stage_workers[stage.strip()] = int(workers)
+
+    def service_factory(http, cities_url):
+        external_api = ExternalAPI(
+            token='replay',
+            compress_threshold=_int_env('INBOX_COMPRESS_THRESHOLD'),
+            spool_threshold=_int_env('MESSAGE_SPOOL_THRESHOLD'),
+            max_message_bytes=_int_env('MESSAGE_MAX_BYTES'),
+            max_response_bytes=_int_env('OUTBOX_MAX_RESPONSE_BYTES'),
+            metrics=Metrics(),
+            http=http,
+        )
+        coalescer = None
+        if os.getenv('COALESCE_MAX_DELAY'):
+            # In memory only: a replay must not leave files for a real run to deliver
+            coalescer = CoalescingBuffer(external_api, max_delay=float(os.getenv('COALESCE_MAX_DELAY')),
+                                         max_messages=_int_env('COALESCE_MAX_MESSAGES') or 20,
+                                         max_bytes=_int_env('COALESCE_MAX_BYTES') or 256 * 1024)
+        return MessageService(CityAPI(cities_url, http=http), external_api, coalescer=coalescer,
+                              stage_workers=stage_workers, queue_size=_int_env('PIPELINE_QUEUE_SIZE') or 100)
+
+    # The service logs every message; keep stdout for the report
+    report = sys.stdout
+    results = []
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            for result in replay_cycles(args.capture, service_factory, speed=args.speed):
+                results.append(result)
+        finally:
+            sys.stdout = report
+
+    for result in results:
+        traffic = result['traffic']
+        rate = traffic['messages'] / result['seconds'] if result['seconds'] else 0.0
+        print(json.dumps({
+            'cycle': result['cycle'],
+            'seconds': round(result['seconds'], 3),
+            'captured_seconds': round(result['captured_seconds'], 3),
+            'messages': traffic['messages'],
+            'deliveries': traffic['deliveries'],
+            'failed_deliveries': traffic['failed_deliveries'],
+            'messages_per_second': round(rate, 1),
+            'requests_served': result['requests_served'],
+            'requests_unmatched': result['requests_unmatched'],
+            'requests_not_replayed': result['requests_not_replayed'],
+        }))
+
+
+if __name__ == '__main__':
+    main()
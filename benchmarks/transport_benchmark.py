@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Compares the transports for requests to the agent backend.
+
+Sends the same number of concurrent POSTs through:
+  - requests with a pooled, blocking HTTP/1.1 session of --connections sockets
+  - Http2Session speaking HTTP/2 (prior knowledge) with the same connection limit
+  - Http2Session against a local HTTP/1.1-only backend, i.e. after falling back
+
+By default the requests go to a local backend that answers after --delay seconds; pass
+--url to measure against a real one, e.g. http://loopai_web:5000/api/.
+
+    python benchmarks/transport_benchmark.py --requests 400 --concurrency 64 --connections 4
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks.backend import LocalBackend
+from src.metrics import Metrics
+from src.transport import Http2Session
+
+PAYLOAD = b'{"updated_files": [{"path": "./benchmark.json", "file_content": "{}"}]}'
+
+
+def pooled_requests(connections: int):
+    session = requests.Session()
+    # pool_block makes the pool a hard cap on sockets, like a connection limit
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def run(name: str, client, url: str, total: int, concurrency: int, backend=None) -> dict:
+    connections_before = backend.connections if backend else 0
+    latencies = []
+
+    def send(i):
+        start = time.perf_counter()
+        response = client.post(f"{url}/inbox/{i}", data=PAYLOAD, headers={'Content-Type': 'application/json'})
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+        return getattr(response, 'http_version', 'HTTP/1.1')
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        versions = set(executor.map(send, range(total)))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'transport': name,
+        'protocol': ','.join(sorted(versions)),
+        'wall_seconds': round(wall, 3),
+        'requests_per_second': round(total / wall, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 1),
+        'connections_opened': backend.connections - connections_before if backend else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="Backend base URL; a local backend is started when omitted")
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--delay', type=float, default=0.02, help="Response delay of the local backend")
+    args = parser.parse_args()
+
+    backend = None
+    url = args.url
+    if url is None:
+        backend = LocalBackend(delay=args.delay)
+        url = backend.url
+    url = url.rstrip('/')
+
+    def session():
+        return Http2Session(prior_knowledge=True, max_connections=args.connections, metrics=Metrics())
+
+    clients = [
+        ('requests pooled', pooled_requests(args.connections), url, backend),
+        ('Http2Session', session(), url, backend),
+    ]
+    http1_backend = None
+    if backend:
+        http1_backend = LocalBackend(delay=args.delay, http2=False)
+        clients.append(('Http2Session, fallback', session(), http1_backend.url, http1_backend))
+
+    print(f"{args.requests} POSTs to {url}, {args.concurrency} in flight, {args.connections} connections")
+    results = []
+    for name, client, client_url, client_backend in clients:
+        results.append(run(name, client, client_url, args.requests, args.concurrency, client_backend))
+        client.close()
+
+    columns = list(results[0])
+    widths = {column: max(len(column), *(len(str(result[column])) for result in results)) for column in columns}
+    print('  '.join(column.ljust(widths[column]) for column in columns))
+    for result in results:
+        print('  '.join(str(result[column]).ljust(widths[column]) for column in columns))
+
+    for local in (backend, http1_backend):
+        if local:
+            local.close()
+
+
+if __name__ == '__main__':
+    main()
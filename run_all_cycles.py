@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
+import argparse
 import json
 import os
 import sys
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from src.city_api import CityAPI
+from src.polling import record_wakes
+from src.profiling import CycleProfiler
+from src.transport import Http2Session
 
 
 # Define the base directory of the project, assuming the script is in agent_post/
@@ -15,6 +20,7 @@ sys.path.insert(0, SRC_DIR)
 
 
 AGENT_POST_CONFIG_JSON = "agent_post_config.json"
+WAKE_ACTIONS = ["READ_POSTS", "DO_TASK_1"]
 
 def load_config(config_path: str) -> dict:
     """Load and return configuration from a JSON file."""
@@ -27,45 +33,103 @@ def load_config(config_path: str) -> dict:
         return {}
 
 
+def wake_with_curl(citizen_name: str, recipient_url: str) -> bool:
+    """Runs the wake actions of one citizen with curl; returns whether any of them succeeded."""
+    woken = False
+    for action in WAKE_ACTIONS:
+        # Replace "WAKEUP" with "RECEIVE_POST" in the recipient URL
+        modified_url = recipient_url.replace("WAKEUP", action)
+        print(f"Citizen: {citizen_name}, Action: {action}, URL: {modified_url}")
+
+        # Execute the curl command against the modified URL
+        try:
+            result = subprocess.run(
+                ["curl", modified_url],
+                capture_output=True,
+                text=True,
+                check=True
+            )
+            print(f"curl output: {result.stdout}")
+            woken = True
+        except subprocess.CalledProcessError as e:
+            print(f"Error executing curl on {modified_url}: {e}")
+    return woken
+
+
+def wake_with_session(http: Http2Session, citizen_name: str, recipient_url: str) -> bool:
+    """Runs the wake actions of one citizen, in order, over the shared HTTP/2 session."""
+    woken = False
+    for action in WAKE_ACTIONS:
+        modified_url = recipient_url.replace("WAKEUP", action)
+        print(f"Citizen: {citizen_name}, Action: {action}, URL: {modified_url}")
+        try:
+            response = http.get(modified_url)
+            print(f"{citizen_name} {action}: {response.status_code} {response.text}")
+            woken = woken or response.status_code < 400
+        except Exception as e:
+            print(f"Error requesting {modified_url}: {e}")
+    return woken
+
+
 def run():
     # Load configuration from agent_post_config.json
     config = load_config(AGENT_POST_CONFIG_JSON)
     # Extract the cities_url from the config and assign it as api_url (fallback provided)
     api_url = config.get("cities_url", "http://example-city-api.com/cities")
     print(f"Using API URL: {api_url}")
-    city_api = CityAPI(api_url)
 
-    # Get the cities data
+    # With AGENT_HTTP2 set, citizens are woken concurrently (WAKE_CONCURRENCY at a time) over a
+    # few multiplexed HTTP/2 connections instead of one curl process per request.
+    http = None
+    if os.getenv('AGENT_HTTP2', '').lower() in ('1', 'true', 'yes'):
+        http = Http2Session(
+            prior_knowledge=os.getenv('HTTP2_PRIOR_KNOWLEDGE', '1').lower() in ('1', 'true', 'yes'),
+            max_connections=int(os.getenv('HTTP_MAX_CONNECTIONS', '4')),
+            timeout=float(os.getenv('WAKE_TIMEOUT', '300')),
+        )
+    city_api = CityAPI(api_url, http=http)
+
     try:
-        cities_data = city_api.get_cities()
-    except Exception as e:
-        print(f"Error fetching cities: {e}")
-        return
-
-    # Extract addresses (assuming cities_data includes an "addresses" key with a list of dictionaries)
-    addresses = {}
-    for address_dict in cities_data.get("addresses", []):
-        addresses.update(address_dict)
-
-    # Loop through each citizen's address and run the actions
-    for citizen_name, recipient_url in addresses.items():
-        for action in ["READ_POSTS", "DO_TASK_1"]:
-            # Replace "WAKEUP" with "RECEIVE_POST" in the recipient URL
-            modified_url = recipient_url.replace("WAKEUP", action)
-            print(f"Citizen: {citizen_name}, Action: {action}, URL: {modified_url}")
-
-            # Execute the curl command against the modified URL
-            try:
-                result = subprocess.run(
-                    ["curl", modified_url],
-                    capture_output=True,
-                    text=True,
-                    check=True
-                )
-                print(f"curl output: {result.stdout}")
-            except subprocess.CalledProcessError as e:
-                print(f"Error executing curl on {modified_url}: {e}")
+        # Get the cities data
+        try:
+            cities_data = city_api.get_cities()
+        except Exception as e:
+            print(f"Error fetching cities: {e}")
+            return
+
+        # Extract addresses (assuming cities_data includes an "addresses" key with a list of dictionaries)
+        addresses = {}
+        for address_dict in cities_data.get("addresses", []):
+            addresses.update(address_dict)
+
+        # Loop through each citizen's address and run the actions
+        if http:
+            with ThreadPoolExecutor(max_workers=int(os.getenv('WAKE_CONCURRENCY', '16'))) as executor:
+                results = list(executor.map(lambda item: wake_with_session(http, *item), addresses.items()))
+        else:
+            results = [wake_with_curl(citizen_name, recipient_url) for citizen_name, recipient_url in addresses.items()]
+    finally:
+        if http:
+            http.close()
+
+    woken = [citizen_name for citizen_name, ok in zip(addresses, results) if ok]
+
+    # Woken agents may have written new outgoing messages; let the exchange poll them next
+    poll_state_path = os.getenv('POLL_STATE_PATH')
+    if poll_state_path and woken:
+        record_wakes(poll_state_path, sorted(set(woken)))
 
 
 if __name__ == "__main__":
-    run()
+    parser = argparse.ArgumentParser(description="Wakes every citizen for one cycle.")
+    parser.add_argument('--profile', nargs='?', const=os.path.join(BASE_DIR, 'profiles'), metavar='DIR',
+                        help="Profile the cycle and write the results to a timestamped directory in DIR "
+                             "(default: ./profiles)")
+    args = parser.parse_args()
+    if args.profile:
+        current = sys.modules[__name__]
+        with CycleProfiler(args.profile, functions=[(CityAPI, 'get_cities'), (current, 'wake_with_curl'),
+                                                    (current, 'wake_with_session')]):
+            run()
+    else:
+        run()
@@ -1,3 +1,4 @@
+import argparse
 import os
 import sys
 from dotenv import load_dotenv
@@ -13,11 +14,33 @@ sys.path.insert(0, SRC_DIR)
 from src.city_api import CityAPI
 from src.external_api import ExternalAPI
 from src.message_service import MessageService
+from src.coordination import LeaseCoordinator
+from src.journal import Journal
+from src.transport import Http2Session
+from src.capture import CaptureWriter, RecordingHttp
+from src.coalescing import CoalescingBuffer
+from src.cycle_stats import CycleStats
+from src.dead_letters import DeadLetterStore
+from src.polling import AdaptivePoller
+from src.profiling import CycleProfiler
+from src.async_message_repository import AsyncMessageRepository, BackgroundPersistence
+from src.partitioned_repository import PartitionedMessageRepository
+from src.scheduling import parse_priority_weights
+from src.state import create_state_backend
 
-def run_message_processing_job():
+def _int_env(name: str):
+    """Returns an integer environment variable, or None when it is not set."""
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def run_message_processing_job(reprocess_dead_letters: bool = False):
     """
     Executes the message processing and cleanup logic for the Agent Post service.
     This function is designed to be run as a scheduled cron job.
+
+    Args:
+        reprocess_dead_letters: Retry the dead letters instead of running an exchange cycle
     """
     print("🚀 Starting Agent Post message processing cron job...")
 
@@ -51,35 +74,229 @@ def run_message_processing_job():
               "Using a placeholder 'default_token'. Please configure it in .env for production environments.")
         external_api_token = "default_token" # Placeholder, replace with actual token in .env
 
+    # Closed in the finally block below, whether or not the cycle succeeds
+    http = state = persistence = coalescer = None
     try:
+        # **Optional HTTP/2 transport:**
+        # With AGENT_HTTP2 set, requests to the agent backend are multiplexed as HTTP/2 streams
+        # over at most HTTP_MAX_CONNECTIONS connections (default 4). The backend is plain http,
+        # so HTTP/2 is spoken with prior knowledge unless HTTP2_PRIOR_KNOWLEDGE=0; a backend that
+        # only speaks HTTP/1.1 is detected on the first request and used over HTTP/1.1.
+        if os.getenv('AGENT_HTTP2', '').lower() in ('1', 'true', 'yes'):
+            http = Http2Session(
+                prior_knowledge=os.getenv('HTTP2_PRIOR_KNOWLEDGE', '1').lower() in ('1', 'true', 'yes'),
+                max_connections=_int_env('HTTP_MAX_CONNECTIONS') or 4,
+            )
+
+        # **Traffic capture:**
+        # With EXCHANGE_CAPTURE_PATH set, the cities document, every outbox and inbox response
+        # and their timings are appended to that gzip file as one cycle, for replaying offline
+        # with benchmarks/replay_capture.py.
+        capture_path = os.getenv('EXCHANGE_CAPTURE_PATH')
+        if capture_path:
+            http = RecordingHttp(CaptureWriter(capture_path), http)
+            print(f"🎙️ Capturing agent backend traffic to {capture_path}.")
+
+        # **Shared state:**
+        # Collected-message deduplication, the inbox circuit breakers and the cached cities
+        # document live in this process unless STATE_BACKEND_URL points to a Redis server
+        # (redis://host:6379/0), where every exchange worker shares them. A message is delivered
+        # once per DEDUP_SECONDS (default 86400); while it is being delivered it is claimed for
+        # DEDUP_CLAIM_SECONDS (default 600, a few cycles), so the messages of a worker that dies
+        # mid-cycle are collected again once that runs out. An inbox failing CIRCUIT_FAILURES times
+        # (default 5) within CIRCUIT_SECONDS (default 60) is skipped for the rest of that window;
+        # with DIRECTORY_CACHE_SECONDS set, the cities document is fetched once per that period.
+        state = create_state_backend(os.getenv('STATE_BACKEND_URL'))
+
         # **Initialize core components:**
         # The `CityAPI` is used to retrieve cloud agent endpoints for citizens [9, 16].
-        city_api = CityAPI(api_url=city_api_url)
+        city_api = CityAPI(api_url=city_api_url, http=http, state=state,
+                           cache_seconds=_int_env('DIRECTORY_CACHE_SECONDS'))
         # The `ExternalAPI` handles pulling messages from outboxes and delivering them to inboxes [7, 8, 17-19].
-        external_api = ExternalAPI(token=external_api_token)
+        # Inbox bodies of at least INBOX_COMPRESS_THRESHOLD bytes are sent gzip-compressed.
+        # Message bodies above MESSAGE_SPOOL_THRESHOLD bytes are kept in temporary files and
+        # streamed to recipients; MESSAGE_MAX_BYTES and OUTBOX_MAX_RESPONSE_BYTES reject
+        # pathological payloads.
+        external_api = ExternalAPI(
+            token=external_api_token,
+            compress_threshold=_int_env('INBOX_COMPRESS_THRESHOLD'),
+            spool_threshold=_int_env('MESSAGE_SPOOL_THRESHOLD'),
+            max_message_bytes=_int_env('MESSAGE_MAX_BYTES'),
+            max_response_bytes=_int_env('OUTBOX_MAX_RESPONSE_BYTES'),
+            http=http,
+            state=state,
+            circuit_failures=_int_env('CIRCUIT_FAILURES') or 5,
+            circuit_seconds=_int_env('CIRCUIT_SECONDS') or 60,
+        )
 
         # **Instantiate MessageService:**
         # `MessageService` orchestrates the entire message flow, using the above components [1].
-        service = MessageService(city_api=city_api, external_api=external_api)
+        # **Optional multi-instance coordination:**
+        # When several exchange instances run against the same DATABASE_URL, each one only
+        # polls the agents it holds a lease on. Leases expire after EXCHANGE_LEASE_TTL seconds
+        # so the agents of a crashed instance are picked up by the others, and are renewed while
+        # a cycle runs; an agent whose lease is lost mid-cycle is no longer collected. With
+        # EXCHANGE_LEASE_BATCH set, each instance leases at most that many agents per cycle,
+        # least recently polled first, leaving the rest to the other instances.
+        coordinator = None
+        if os.getenv('EXCHANGE_COORDINATION', '').lower() in ('1', 'true', 'yes'):
+            coordinator = LeaseCoordinator(
+                db_url=db_url,
+                ttl_seconds=int(os.getenv('EXCHANGE_LEASE_TTL', '300')),
+                max_agents=_int_env('EXCHANGE_LEASE_BATCH'),
+            )
+            print(f"🔒 Lease coordination enabled as {coordinator.owner}.")
+
+        # **Pipeline tuning:**
+        # PIPELINE_WORKERS sets per-stage concurrency, e.g. "collect=8,deliver=4";
+        # PIPELINE_QUEUE_SIZE bounds the queues between stages.
+        stage_workers = {}
+        for setting in filter(None, os.getenv('PIPELINE_WORKERS', '').split(',')):
+            stage, workers = setting.split('=')
+            stage_workers[stage.strip()] = int(workers)
+
+        # **Priority lanes:**
+        # Outbox messages may carry "priority": "high" | "normal" | "low". PRIORITY_WEIGHTS sets
+        # each lane's share of delivery capacity when there is a backlog, e.g. "high=8,normal=3,low=1";
+        # a weight that is not above zero stops the job.
+        priority_weights = parse_priority_weights(os.getenv('PRIORITY_WEIGHTS', ''))
+
+        # **Crash recovery:**
+        # With EXCHANGE_JOURNAL_PATH set, collected and delivered messages are journaled so a
+        # cycle interrupted by a crash is finished by the next run instead of being lost. Spooled
+        # bodies are kept in the <path>.spool directory, not in the journal, until delivered.
+        journal_path = os.getenv('EXCHANGE_JOURNAL_PATH')
+        journal = Journal(journal_path) if journal_path else None
+
+        # **Message persistence:**
+        # With EXCHANGE_PERSIST_MESSAGES set, collected messages and their delivery times are
+        # written to DATABASE_URL through the async repository, off the collection and delivery
+        # path. DB_POOL_SIZE and DB_MAX_OVERFLOW size its connection pool.
+        # With MESSAGE_PARTITIONS set, messages are stored per recipient in the partitioned
+        # recipient_messages table instead (PostgreSQL, after `alembic upgrade head` with the
+        # same MESSAGE_PARTITIONS), or in that many shard files next to a SQLite DATABASE_URL.
+        if os.getenv('EXCHANGE_PERSIST_MESSAGES', '').lower() in ('1', 'true', 'yes'):
+            repository_class = AsyncMessageRepository
+            repository_options = {}
+            if _int_env('MESSAGE_PARTITIONS'):
+                repository_class = PartitionedMessageRepository
+                repository_options = {'partitions': _int_env('MESSAGE_PARTITIONS')}
+            persistence = BackgroundPersistence(repository_class(
+                db_url,
+                pool_size=_int_env('DB_POOL_SIZE') or 10,
+                max_overflow=_int_env('DB_MAX_OVERFLOW') or 20,
+                **repository_options,
+            ))
+
+        # **Adaptive polling:**
+        # With POLL_STATE_PATH set, each agent's outbox is polled only when it is due: active
+        # agents every POLL_MIN_INTERVAL seconds (default 60), idle ones backing off up to
+        # POLL_MAX_INTERVAL (default 3600). Run this job at least every POLL_MIN_INTERVAL.
+        poll_state_path = os.getenv('POLL_STATE_PATH')
+        poller = None
+        if poll_state_path:
+            poller = AdaptivePoller(
+                min_interval=_int_env('POLL_MIN_INTERVAL') or 60,
+                max_interval=_int_env('POLL_MAX_INTERVAL') or 3600,
+                path=poll_state_path,
+            )
+
+        # **Delivery coalescing:**
+        # With COALESCE_MAX_DELAY set (seconds), inbox files are held per recipient for up to
+        # that long, or until COALESCE_MAX_MESSAGES files or COALESCE_MAX_BYTES are queued, and
+        # delivered as one batch. Files that have not waited that long when the job ends stay in
+        # COALESCE_PATH and are batched with the next run's files; so do failed posts, which the
+        # next run retries.
+        coalesce_max_delay = os.getenv('COALESCE_MAX_DELAY')
+        if coalesce_max_delay:
+            coalescer = CoalescingBuffer(
+                external_api,
+                path=os.getenv('COALESCE_PATH') or os.path.join(BASE_DIR, 'coalesce.jsonl'),
+                max_delay=float(coalesce_max_delay),
+                max_messages=_int_env('COALESCE_MAX_MESSAGES') or 20,
+                max_bytes=_int_env('COALESCE_MAX_BYTES') or 256 * 1024,
+            )
+
+        # **Dead letters:**
+        # With EXCHANGE_DEAD_LETTERS set, messages that could not be delivered to a recipient
+        # (unknown address, failed or rejected post) are kept in the dead_letters table of
+        # DATABASE_URL. `--reprocess-dead-letters` retries them against the current directory,
+        # DEAD_LETTER_BATCH_SIZE (default 100) at a time.
+        dead_letters = None
+        if reprocess_dead_letters or os.getenv('EXCHANGE_DEAD_LETTERS', '').lower() in ('1', 'true', 'yes'):
+            dead_letters = DeadLetterStore(db_url)
 
-        print("🔄 Processing messages (fetching, saving, delivering)...")
-        # **Get list of API endpoints of citizens, receive, and send messages:**
-        # The `process_messages` method within `MessageService` performs these exact steps:
-        # 1. Calls `city_api.get_cities()` to get all citizen addresses (API endpoints) [1].
-        # 2. Iterates through these URLs [20].
-        # 3. For each URL, it calls `external_api.collect_from_outbox()` to **receive** messages [18, 20].
-        # 4. It then saves these collected messages to the local database using `message_repo.save()` [21].
-        # 5. Finally, it calls `external_api.add_to_inbox()` for each resolved recipient to **send** messages [7, 19, 21].
-        # It also handles multi-recipient delivery by splitting the 'to' field [18, 19, 22].
-        service.process_messages()
-        print("✅ Messages processed and delivered successfully.")
+        service = MessageService(
+            dead_letters=dead_letters,
+            coalescer=coalescer,
+            poller=poller,
+            persistence=persistence,
+            journal=journal,
+            city_api=city_api,
+            external_api=external_api,
+            coordinator=coordinator,
+            stage_workers=stage_workers,
+            queue_size=_int_env('PIPELINE_QUEUE_SIZE') or 100,
+            priority_weights=priority_weights,
+            # STATS_TOP_K sets how many of the busiest senders and recipients each cycle reports
+            cycle_stats=CycleStats(top_k=_int_env('STATS_TOP_K') or 10),
+            state=state,
+            dedup_seconds=_int_env('DEDUP_SECONDS') or 86400,
+            claim_seconds=_int_env('DEDUP_CLAIM_SECONDS') or 600,
+        )
 
+        if reprocess_dead_letters:
+            print("🔁 Reprocessing dead letters...")
+            print(f"📊 Dead letters before: {dead_letters.counts()}")
+            print(f"📊 Reprocessed: {service.reprocess_dead_letters(batch_size=_int_env('DEAD_LETTER_BATCH_SIZE') or 100)}")
+        else:
+            print("🔄 Processing messages (fetching, saving, delivering)...")
+            # **Get list of API endpoints of citizens, receive, and send messages:**
+            # The `process_messages` method within `MessageService` performs these exact steps:
+            # 1. Calls `city_api.get_cities()` to get all citizen addresses (API endpoints) [1].
+            # 2. Iterates through these URLs [20].
+            # 3. For each URL, it calls `external_api.collect_from_outbox()` to **receive** messages [18, 20].
+            # 4. It then saves these collected messages to the local database using `message_repo.save()` [21].
+            # 5. Finally, it calls `external_api.add_to_inbox()` for each resolved recipient to **send** messages [7, 19, 21].
+            # It also handles multi-recipient delivery by splitting the 'to' field [18, 19, 22].
+            service.process_messages()
+            print("✅ Messages processed and delivered successfully.")
+            print(f"📊 Transfer metrics: {external_api.metrics.snapshot()}")
+            print(f"📊 Traffic: {service.cycle_stats.reset()}")
+            for stage, stats in service.pipeline_stats().items():
+                print(f"📊 Stage {stage}: {stats}")
+        if poller:
+            print(f"📊 Polling: {poller.stats()}")
+        if dead_letters:
+            print(f"📊 Dead letters: {dead_letters.counts()}")
 
     except Exception as e:
         print(f"❌ An unexpected error occurred during the cron job: {e}")
         sys.exit(1)
+    finally:
+        # Buffered batches are posted before the connections they use are closed
+        if coalescer:
+            coalescer.close()
+            print(f"📊 Coalescing: {coalescer.stats()}")
+        if persistence:
+            persistence.close()
+        if http:
+            http.close()
+        if state:
+            state.close()
 
     print("🎉 Agent Post message processing cron job completed.")
 
 if __name__ == "__main__":
-    run_message_processing_job()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Runs one Agent Post message exchange cycle.")
+    parser.add_argument('--profile', nargs='?', const=os.path.join(BASE_DIR, 'profiles'), metavar='DIR',
+                        help="Profile the cycle and write the results to a timestamped directory in DIR "
+                             "(default: ./profiles)")
+    parser.add_argument('--reprocess-dead-letters', action='store_true',
+                        help="Redeliver the dead letters in batches instead of running an exchange cycle")
+    args = parser.parse_args()
+    if args.profile:
+        with CycleProfiler(args.profile):
+            run_message_processing_job(args.reprocess_dead_letters)
+    else:
+        run_message_processing_job(args.reprocess_dead_letters)
\ No newline at end of file
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Production entry point for app.py: serves the API with gevent's WSGI server.
+
+Each worker process handles up to WEB_GREENLETS requests concurrently as greenlets, so
+long-lived event streams and slow clients do not tie up threads; Socket.IO clients are
+upgraded to WebSockets by gevent-websocket's handler. With WEB_WORKERS above 1, the
+workers are forked from one process and share its listening socket; they then need a
+shared message store, so MESSAGE_STORE_URL defaults to a SQLite file next to this script. Subscribers of /messages/stream and Socket.IO are served by the worker they are
+connected to and only see messages posted to that worker, so keep WEB_WORKERS at 1 when
+push delivery matters.
+
+    WEB_HOST (0.0.0.0)  WEB_PORT (5000)  WEB_WORKERS (1)  WEB_GREENLETS (1000)  WEB_BACKLOG (2048)
+"""
+from gevent import monkey
+
+# Before anything else imports socket, threading or ssl
+monkey.patch_all()
+
+import os
+import signal
+import socket
+import sys
+
+import gevent
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from geventwebsocket.handler import WebSocketHandler
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+
+def _int_env(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def serve(listener: socket.socket, greenlets: int) -> None:
+    from app import app, store
+
+    # Connections inherited from the parent process must not be shared with it
+    if hasattr(store, 'engine'):
+        store.engine.dispose(close=False)
+
+    # Without the WebSocket handler, Socket.IO clients silently fall back to long-polling
+    server = WSGIServer(listener, app, spawn=Pool(greenlets), log=None, handler_class=WebSocketHandler)
+    # Finish the requests in flight, then exit
+    gevent.signal_handler(signal.SIGTERM, server.stop, timeout=10)
+    gevent.signal_handler(signal.SIGINT, server.stop, timeout=10)
+    print(f"Worker {os.getpid()} serving on {listener.getsockname()} with {greenlets} greenlets")
+    server.serve_forever()
+
+
+def main():
+    host = os.getenv('WEB_HOST', '0.0.0.0')
+    port = _int_env('WEB_PORT', 5000)
+    workers = _int_env('WEB_WORKERS', 1)
+    greenlets = _int_env('WEB_GREENLETS', 1000)
+
+    if workers > 1 and not os.getenv('MESSAGE_STORE_URL'):
+        os.environ['MESSAGE_STORE_URL'] = f"sqlite:///{os.path.join(BASE_DIR, 'api_messages.db')}"
+        print(f"MESSAGE_STORE_URL not set; sharing messages between workers in {os.environ['MESSAGE_STORE_URL']}")
+
+    listener = socket.create_server((host, port), backlog=_int_env('WEB_BACKLOG', 2048))
+    if workers == 1:
+        serve(listener, greenlets)
+        return
+
+    # Load the app once so that setup errors surface here rather than in every worker
+    import app  # noqa: F401
+
+    children = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # Lets the app keep per-worker files, such as the ingestion journal, stable across restarts
+            os.environ['WEB_WORKER_INDEX'] = str(index)
+            try:
+                serve(listener, greenlets)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(signum, _frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"Serving on {host}:{port} with {workers} workers")
+    status = 0
+    for child in children:
+        _, child_status = os.waitpid(child, 0)
+        status = status or os.waitstatus_to_exitcode(child_status)
+    sys.stdout.flush()
+    # The workers have shut the app down; skip interpreter teardown of the patched modules
+    os._exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ from dotenv import load_dotenv
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 SRC_DIR = os.path.join(BASE_DIR, 'src')
 sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, BASE_DIR)
 
 # ✅ Import after setting sys.path
 from message_repository import MessageRepository
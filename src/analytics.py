@@ -0,0 +1,256 @@
+from datetime import datetime
+from typing import Dict, Iterator, Optional
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, inspect, select, tuple_
+from sqlalchemy.engine import Engine
+
+from src.message_repository import MessageModel
+from src.partitioned_repository import RecipientMessageModel, shard_url
+
+# Latency histogram bin edges in seconds: 0, then 20 bins per decade from 1 ms to ~115 days.
+# Percentiles read from it are the upper edge of their bin, within 12% of the exact value.
+LATENCY_EDGES = np.concatenate(([0.0], np.logspace(-3, 7, 201)))
+
+STAGES = {
+    'created_to_collected': ('created_at', 'collected_at'),
+    'collected_to_delivered': ('collected_at', 'delivered_at'),
+    'created_to_delivered': ('created_at', 'delivered_at'),
+}
+
+_COLUMNS = [MessageModel.id, MessageModel.created_at, MessageModel.collected_at, MessageModel.delivered_at,
+            MessageModel.from_address, MessageModel.to_address]
+_TIMESTAMPS = ['created_at', 'collected_at', 'delivered_at']
+_RECIPIENT_TABLE = RecipientMessageModel.__table__
+# A recipient row is one message to that recipient, so the recipient stands in for to_address
+_RECIPIENT_COLUMNS = [_RECIPIENT_TABLE.c.recipient, _RECIPIENT_TABLE.c.delivery_key, _RECIPIENT_TABLE.c.created_at,
+                      _RECIPIENT_TABLE.c.collected_at, _RECIPIENT_TABLE.c.delivered_at,
+                      _RECIPIENT_TABLE.c.from_address, _RECIPIENT_TABLE.c.recipient.label('to_address')]
+
+
+def iter_message_frames(engine: Engine, chunk_size: int = 50000) -> Iterator[pd.DataFrame]:
+    """
+    Reads the messages table in id order, `chunk_size` rows at a time, without the message
+    bodies. Each chunk is its own keyset query (`id > last id`), so no driver ever buffers
+    more than one chunk, whatever the size of the table.
+
+    Args:
+        engine: SQLAlchemy engine of the exchange database.
+        chunk_size: Rows per DataFrame.
+
+    Returns:
+        An iterator of DataFrames with the id, timestamp and address columns.
+    """
+    last_id = 0
+    with engine.connect() as conn:
+        while True:
+            query = select(*_COLUMNS).where(MessageModel.id > last_id).order_by(MessageModel.id).limit(chunk_size)
+            frame = pd.read_sql_query(query, conn)
+            if frame.empty:
+                return
+            for column in _TIMESTAMPS:
+                frame[column] = pd.to_datetime(frame[column])
+            last_id = int(frame['id'].iloc[-1])
+            yield frame
+
+
+def iter_recipient_frames(engine: Engine, chunk_size: int = 50000) -> Iterator[pd.DataFrame]:
+    """
+    Reads the recipient_messages table of partitioned storage like iter_message_frames(),
+    in (recipient, delivery key) order. Each row is one message to one recipient, whose name
+    is in the `to_address` column. A SQLite shard that was never written to yields nothing.
+
+    Args:
+        engine: SQLAlchemy engine of the database, or of one SQLite shard.
+        chunk_size: Rows per DataFrame.
+
+    Returns:
+        An iterator of DataFrames with the key, timestamp and address columns.
+    """
+    if not inspect(engine).has_table(_RECIPIENT_TABLE.name):
+        return
+    key = tuple_(_RECIPIENT_TABLE.c.recipient, _RECIPIENT_TABLE.c.delivery_key)
+    last = None
+    with engine.connect() as conn:
+        while True:
+            query = select(*_RECIPIENT_COLUMNS)
+            if last is not None:
+                query = query.where(key > tuple_(*last))
+            frame = pd.read_sql_query(query.order_by(*key.clauses).limit(chunk_size), conn)
+            if frame.empty:
+                return
+            for column in _TIMESTAMPS:
+                frame[column] = pd.to_datetime(frame[column])
+            last = (frame['recipient'].iloc[-1], frame['delivery_key'].iloc[-1])
+            yield frame
+
+
+class LatencyHistogram:
+    """A fixed-size distribution of durations in seconds, filled from NumPy arrays."""
+
+    def __init__(self):
+        self.counts = np.zeros(len(LATENCY_EDGES), dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, seconds: np.ndarray) -> None:
+        seconds = seconds[~np.isnan(seconds)]
+        if not len(seconds):
+            return
+        # Clock skew between hosts can make a later stage look earlier
+        seconds = np.clip(seconds, 0.0, None)
+        bins = np.minimum(np.searchsorted(LATENCY_EDGES, seconds), len(LATENCY_EDGES) - 1)
+        self.counts += np.bincount(bins, minlength=len(LATENCY_EDGES))
+        self.count += len(seconds)
+        self.total += float(seconds.sum())
+        self.min = min(self.min, float(seconds.min()))
+        self.max = max(self.max, float(seconds.max()))
+
+    def percentile(self, q: float) -> Optional[float]:
+        """The upper bound of the bin holding the q-th percentile (0-100), capped at the maximum."""
+        if not self.count:
+            return None
+        rank = max(1, int(np.ceil(self.count * q / 100.0)))
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        if index == len(LATENCY_EDGES) - 1:
+            # The last bin also holds everything beyond the last edge
+            return self.max
+        return min(float(LATENCY_EDGES[index]), self.max)
+
+    def summary(self) -> Dict:
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean_s': self.total / self.count,
+            'min_s': self.min,
+            'p50_s': self.percentile(50),
+            'p90_s': self.percentile(90),
+            'p99_s': self.percentile(99),
+            'max_s': self.max,
+        }
+
+
+class MessageAnalytics:
+    """
+    Latency distributions, per-agent throughput and backlog age over message history,
+    accumulated one DataFrame chunk at a time. Every step is a column operation; memory
+    grows with the number of agents, not with the number of messages.
+
+    Args:
+        now: The time backlog ages are measured against; defaults to the current time.
+    """
+
+    def __init__(self, now: Optional[datetime] = None):
+        self.now = pd.Timestamp(now or datetime.now())
+        self.latency = {stage: LatencyHistogram() for stage in STAGES}
+        self.backlog_age = LatencyHistogram()
+        self.messages = 0
+        self.uncollected = 0
+        self.undelivered = 0
+        self.first_delivery = None
+        self.last_delivery = None
+        empty = pd.Series(dtype=np.int64)
+        self.sent = empty
+        self.delivered_from = empty
+        self.delivered_to = empty
+        self.pending_for = empty
+
+    def add_frame(self, frame: pd.DataFrame) -> None:
+        """Folds one chunk from iter_message_frames() into the totals."""
+        self.messages += len(frame)
+        for stage, (start, end) in STAGES.items():
+            self.latency[stage].add((frame[end] - frame[start]).dt.total_seconds().to_numpy())
+
+        delivered = frame['delivered_at'].notna()
+        pending = frame[~delivered]
+        self.uncollected += int(pending['collected_at'].isna().sum())
+        self.undelivered += len(pending)
+        self.backlog_age.add((self.now - pending['created_at']).dt.total_seconds().to_numpy())
+
+        if delivered.any():
+            times = frame.loc[delivered, 'delivered_at']
+            first, last = times.min(), times.max()
+            self.first_delivery = first if self.first_delivery is None else min(self.first_delivery, first)
+            self.last_delivery = last if self.last_delivery is None else max(self.last_delivery, last)
+
+        self.sent = self._add(self.sent, frame['from_address'].value_counts())
+        self.delivered_from = self._add(self.delivered_from, frame.loc[delivered, 'from_address'].value_counts())
+        self.delivered_to = self._add(self.delivered_to, self._recipients(frame.loc[delivered, 'to_address']).value_counts())
+        self.pending_for = self._add(self.pending_for, self._recipients(pending['to_address']).value_counts())
+
+    @staticmethod
+    def _add(total: pd.Series, counts: pd.Series) -> pd.Series:
+        return total.add(counts, fill_value=0).astype(np.int64)
+
+    @staticmethod
+    def _recipients(to_address: pd.Series) -> pd.Series:
+        # The same split as split_addresses(): ';', ',' and whitespace separate recipients
+        return to_address.dropna().str.replace(r'[;,]', ' ', regex=True).str.split().explode().dropna()
+
+    def report(self, top: int = 10) -> Dict:
+        """The accumulated figures; per-agent tables keep the `top` busiest agents."""
+        hours = None
+        if self.first_delivery is not None:
+            hours = max((self.last_delivery - self.first_delivery).total_seconds() / 3600.0, 1.0 / 3600.0)
+
+        def busiest(series: pd.Series, rate: bool = False) -> Dict:
+            series = series.sort_values(ascending=False, kind='stable').head(top)
+            if rate and hours:
+                return {agent: {'messages': int(count), 'per_hour': float(count) / hours} for agent, count in series.items()}
+            return {agent: int(count) for agent, count in series.items()}
+
+        return {
+            'messages': self.messages,
+            'latency': {stage: histogram.summary() for stage, histogram in self.latency.items()},
+            'delivery_window': {
+                'first': self.first_delivery.isoformat() if self.first_delivery is not None else None,
+                'last': self.last_delivery.isoformat() if self.last_delivery is not None else None,
+                'hours': hours,
+            },
+            'agents': {
+                'sent': busiest(self.sent),
+                'delivered_from': busiest(self.delivered_from, rate=True),
+                'delivered_to': busiest(self.delivered_to, rate=True),
+            },
+            'backlog': {
+                'undelivered': self.undelivered,
+                'uncollected': self.uncollected,
+                'age': self.backlog_age.summary(),
+                'pending_for': busiest(self.pending_for),
+            },
+        }
+
+
+def _partitioned_frames(engine: Engine, partitions: int, chunk_size: int) -> Iterator[pd.DataFrame]:
+    if engine.dialect.name != 'sqlite':
+        yield from iter_recipient_frames(engine, chunk_size)
+        return
+    # SQLite keeps each partition in its own shard file next to the database
+    for index in range(partitions):
+        shard = create_engine(shard_url(engine.url.render_as_string(hide_password=False), index))
+        try:
+            yield from iter_recipient_frames(shard, chunk_size)
+        finally:
+            shard.dispose()
+
+
+def analyze(engine: Engine, chunk_size: int = 50000, now: Optional[datetime] = None, top: int = 10,
+            partitions: Optional[int] = None) -> Dict:
+    """
+    Runs MessageAnalytics over the whole messages table and returns its report.
+
+    With `partitions` (MESSAGE_PARTITIONS), the history is read from the recipient_messages
+    table of partitioned storage instead, where messages are counted once per recipient.
+    """
+    analytics = MessageAnalytics(now=now)
+    if partitions:
+        frames = _partitioned_frames(engine, partitions, chunk_size)
+    else:
+        frames = iter_message_frames(engine, chunk_size)
+    for frame in frames:
+        analytics.add_frame(frame)
+    return analytics.report(top=top)
@@ -0,0 +1,203 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import AsyncIterator, List, Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from src.message import Message
+from src.message_repository import MessageModel
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_database_url(db_url: str, statement_cache_size: int = 500) -> str:
+    """Maps a synchronous DATABASE_URL onto its asyncio driver (asyncpg or aiosqlite)."""
+    url = make_url(db_url)
+    url = url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+    if url.drivername == 'postgresql+asyncpg':
+        # Cache of server-side prepared statements per connection
+        url = url.update_query_dict({'prepared_statement_cache_size': str(statement_cache_size)})
+    return url.render_as_string(hide_password=False)
+
+
+class AsyncMessageRepository:
+    """
+    Asyncio counterpart of MessageRepository for the exchange cycle.
+
+    The engine is created with an explicit pool (size, overflow, timeout, recycle, pre-ping)
+    and statement caching, and `cycle()` keeps one session open for a whole exchange cycle
+    instead of opening one per write. Collected messages are inserted with database-assigned
+    ids, since the ids agents put in their outboxes are not unique across agents; the row id
+    is stored on `Message.record_id`.
+    """
+
+    def __init__(self, db_url: str, pool_size: int = 10, max_overflow: int = 20, pool_timeout: int = 30,
+                 pool_recycle: int = 1800, statement_cache_size: int = 500):
+        url = async_database_url(db_url, statement_cache_size)
+        options = {'pool_pre_ping': True, 'query_cache_size': statement_cache_size}
+        if ':memory:' not in url and url.rstrip('/') != 'sqlite+aiosqlite:':
+            options.update(pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout,
+                           pool_recycle=pool_recycle)
+        self.engine = create_async_engine(url, **options)
+        self.Session = async_sessionmaker(self.engine, expire_on_commit=False)
+        self._session: Optional[AsyncSession] = None
+
+    @asynccontextmanager
+    async def cycle(self) -> AsyncIterator[AsyncSession]:
+        """Opens the session shared by every repository call until the block exits."""
+        async with self.Session() as session:
+            self._session = session
+            try:
+                yield session
+            finally:
+                self._session = None
+
+    @asynccontextmanager
+    async def _use_session(self) -> AsyncIterator[AsyncSession]:
+        if self._session is not None:
+            yield self._session
+        else:
+            async with self.Session() as session:
+                yield session
+
+    async def save_many(self, messages: List[Message], recipients: Optional[List[Optional[List[str]]]] = None) -> None:
+        """
+        Inserts collected messages in one transaction and records their row ids.
+
+        `recipients` is accepted for PartitionedMessageRepository; one row covers all of them.
+        """
+        if not messages:
+            return
+        async with self._use_session() as session:
+            models = [MessageModel.from_message(message, keep_id=False) for message in messages]
+            session.add_all(models)
+            try:
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+            for message, model in zip(messages, models):
+                message.record_id = model.id
+
+    async def mark_delivered(self, messages: List[Message],
+                             recipients: Optional[List[Optional[List[str]]]] = None) -> None:
+        """Stores delivered_at for messages that were saved earlier, in a single executemany."""
+        rows = [{'id': message.record_id, 'delivered_at': message.delivered_at or datetime.now()}
+                for message in messages if message.record_id is not None]
+        if not rows:
+            return
+        async with self._use_session() as session:
+            try:
+                await session.execute(update(MessageModel), rows)
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+
+    async def find_by_id(self, message_id: int) -> Optional[Message]:
+        async with self._use_session() as session:
+            model = await session.get(MessageModel, message_id)
+            return model.to_message() if model else None
+
+    async def find_all(self) -> List[Message]:
+        async with self._use_session() as session:
+            result = await session.execute(select(MessageModel).order_by(MessageModel.id))
+            return [model.to_message() for model in result.scalars()]
+
+    async def dispose(self) -> None:
+        await self.engine.dispose()
+
+
+class BackgroundPersistence:
+    """
+    Runs an AsyncMessageRepository on its own event loop thread.
+
+    Pipeline threads hand messages over with `saved()` and `delivered()` and continue at
+    once; the loop drains the hand-off queue in batches, so database round-trips never sit
+    on the collection or delivery path. Writes for one message are applied in the order
+    they were handed over.
+    """
+
+    def __init__(self, repository: AsyncMessageRepository, batch_size: int = 100):
+        self.repository = repository
+        self.batch_size = batch_size
+        self.errors = 0
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='persistence', daemon=True)
+        self._thread.start()
+        self._queue: asyncio.Queue = self._call(self._make_queue())
+        self._worker = None
+
+    async def _make_queue(self) -> asyncio.Queue:
+        return asyncio.Queue()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def begin_cycle(self) -> None:
+        self._worker = asyncio.run_coroutine_threadsafe(self._run(), self._loop)
+
+    def saved(self, message: Message, recipients: Optional[List[str]] = None) -> None:
+        """Hands over a collected message; `recipients` are the agents it is routed to."""
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, ('save', message, recipients))
+
+    def delivered(self, message: Message, recipients: Optional[List[str]] = None) -> None:
+        """Hands over a delivered message; `recipients` are the agents that received it."""
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, ('delivered', message, recipients))
+
+    def end_cycle(self) -> None:
+        """Waits until everything handed over during the cycle has been written."""
+        if self._worker is None:
+            return
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+        self._worker.result()
+        self._worker = None
+
+    async def _run(self) -> None:
+        async with self.repository.cycle():
+            finished = False
+            while not finished:
+                batch = []
+                item = await self._queue.get()
+                while item is not None:
+                    batch.append(item)
+                    if len(batch) >= self.batch_size or self._queue.empty():
+                        break
+                    item = self._queue.get_nowait()
+                finished = item is None
+                await self._write(batch)
+
+    async def _write(self, batch) -> None:
+        # Consecutive operations of the same kind are written together, preserving order
+        start = 0
+        while start < len(batch):
+            kind = batch[start][0]
+            end = start
+            while end < len(batch) and batch[end][0] == kind:
+                end += 1
+            messages = [message for _, message, _ in batch[start:end]]
+            recipients = [names for _, _, names in batch[start:end]]
+            try:
+                if kind == 'save':
+                    await self.repository.save_many(messages, recipients)
+                else:
+                    await self.repository.mark_delivered(messages, recipients)
+            except Exception as e:
+                self.errors += 1
+                print(f"Error persisting {len(messages)} messages: {e}")
+            start = end
+
+    def close(self) -> None:
+        self.end_cycle()
+        self._call(self.repository.dispose())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
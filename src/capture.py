@@ -0,0 +1,252 @@
+import base64
+import gzip
+import json
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+import requests
+from requests.exceptions import ConnectionError, HTTPError
+from requests.structures import CaseInsensitiveDict
+
+# Response headers kept in a capture; the rest do not affect parsing or delivery
+CAPTURED_HEADERS = ('Content-Type', 'Content-Encoding')
+
+
+class CaptureWriter:
+    """
+    Appends captured requests to a gzip-compressed JSON-lines file.
+
+    Every writer starts a new cycle in the file, so one capture path can collect several
+    runs of the exchange. Records are written as they complete, from any thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records = 0
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self.started = time.monotonic()
+        self._write({'cycle': time.time()})
+
+    def _write(self, record: Dict) -> None:
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+
+    def write(self, record: Dict) -> None:
+        record['offset'] = time.monotonic() - self.started
+        self._write(record)
+        self.records += 1
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path: str) -> List[List[Dict]]:
+    """Returns the captured request records of every cycle in the file, in order."""
+    cycles: List[List[Dict]] = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if 'cycle' in record:
+                cycles.append([])
+            elif cycles:
+                cycles[-1].append(record)
+    return cycles
+
+
+class _CapturedBody:
+    """The `response.raw` of a captured response; reads return the body as it came over the wire."""
+
+    def __init__(self, wire: bytes, encoding: str):
+        self._wire = wire
+        self._encoding = encoding
+        self._buffer: Optional[bytes] = None
+
+    def read(self, amt: Optional[int] = None, decode_content: bool = True) -> bytes:
+        if self._buffer is None:
+            self._buffer = self._decode() if decode_content else self._wire
+        if amt is None:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def _decode(self) -> bytes:
+        if self._encoding == 'gzip':
+            return zlib.decompress(self._wire, 16 + zlib.MAX_WBITS)
+        if self._encoding == 'deflate':
+            return zlib.decompress(self._wire)
+        return self._wire
+
+
+class CapturedResponse:
+    """A response rebuilt from a capture record, with the parts of requests.Response the APIs use."""
+
+    def __init__(self, record: Dict):
+        self.status_code = record['status']
+        self.url = record['url']
+        self.headers = CaseInsensitiveDict(record.get('headers', {}))
+        self.elapsed_seconds = record.get('elapsed', 0.0)
+        self._wire = base64.b64decode(record.get('body', ''))
+        self.raw = _CapturedBody(self._wire, self.headers.get('Content-Encoding', '').strip().lower())
+
+    @property
+    def content(self) -> bytes:
+        return _CapturedBody(self._wire, self.headers.get('Content-Encoding', '').strip().lower()).read()
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+    def close(self) -> None:
+        pass
+
+
+class RecordingHttp:
+    """
+    Sends requests through `http` (the requests module by default, or an Http2Session)
+    and writes every response, with its status, body as sent on the wire and timing, to
+    `capture`. Pass it as the `http` client of CityAPI and ExternalAPI to record a cycle.
+
+    Responses are read completely before they are returned, so streamed outbox bodies are
+    held in memory while recording.
+    """
+
+    def __init__(self, capture: CaptureWriter, http=None):
+        self.capture = capture
+        self.http = http or requests
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def request(self, method: str, url: str, data=None, stream: bool = False, **kwargs):
+        record = {'method': method, 'url': url,
+                  'request_bytes': len(data) if isinstance(data, (bytes, str)) else None}
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, url, data=data, stream=stream, **kwargs)
+            if stream:
+                # As sent on the wire, so that replays decompress it like the original run did
+                wire = response.raw.read(decode_content=False)
+                headers = {name: response.headers[name] for name in CAPTURED_HEADERS if name in response.headers}
+            else:
+                wire = response.content
+                # requests has already decoded the body
+                headers = {'Content-Type': response.headers['Content-Type']} if 'Content-Type' in response.headers else {}
+        except Exception as e:
+            record.update(elapsed=time.perf_counter() - start, error=str(e))
+            self.capture.write(record)
+            raise
+        record.update(elapsed=time.perf_counter() - start, status=response.status_code, headers=headers,
+                      body=base64.b64encode(wire).decode('ascii'))
+        self.capture.write(record)
+        return CapturedResponse(record)
+
+    def close(self) -> None:
+        """Closes the capture file, and the wrapped client if it is a session."""
+        self.capture.close()
+        if self.http is not requests:
+            self.http.close()
+
+
+class ReplayHttp:
+    """
+    Answers requests from a captured cycle instead of the network.
+
+    Requests are matched to the records with the same method and URL in the order they
+    were captured. With `speed`, every response takes its captured time divided by
+    `speed` (1.0 is the original speed); without it, responses come back at once.
+    Requests with nothing left to match, such as inbox posts of a cycle that routed
+    differently, are answered with an empty 200.
+    """
+
+    def __init__(self, records: List[Dict], speed: Optional[float] = None):
+        self.speed = speed
+        self.served = 0
+        self.unmatched = 0
+        self._lock = threading.Lock()
+        self._records: Dict[Tuple[str, str], Deque[Dict]] = {}
+        for record in records:
+            self._records.setdefault((record['method'], record['url']), deque()).append(record)
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def request(self, method: str, url: str, data=None, **kwargs):
+        if data is not None and not isinstance(data, (bytes, str)):
+            # Streamed bodies are consumed as the real transport would
+            for _ in data:
+                pass
+        with self._lock:
+            records = self._records.get((method, url))
+            record = records.popleft() if records else None
+            if record is None:
+                self.unmatched += 1
+            else:
+                self.served += 1
+        if record is None:
+            return CapturedResponse({'status': 200, 'url': url, 'headers': {'Content-Type': 'application/json'},
+                                     'body': base64.b64encode(b'{}').decode('ascii')})
+
+        if self.speed:
+            time.sleep(record.get('elapsed', 0.0) / self.speed)
+        if 'error' in record:
+            raise ConnectionError(f"{method} {url} failed: {record['error']}")
+        return CapturedResponse(record)
+
+    def pending(self) -> int:
+        """Number of captured requests that the replay has not made."""
+        with self._lock:
+            return sum(len(records) for records in self._records.values())
+
+
+def replay_cycles(path: str, service_factory, speed: Optional[float] = None) -> Iterator[Dict]:
+    """
+    Replays every cycle of a capture through a fresh MessageService.
+
+    Args:
+        path: Capture file written by CaptureWriter
+        service_factory: Called with a ReplayHttp and the cycle's cities URL; returns the
+            MessageService to run, with its CityAPI and ExternalAPI sending through that client
+        speed: Replay speed relative to the capture, or None for as fast as possible
+
+    Returns:
+        Per cycle, the wall time, the requests served and left unmatched, and the service's
+        cycle statistics
+    """
+    for cycle, records in enumerate(read_capture(path), 1):
+        http = ReplayHttp(records, speed=speed)
+        # Every cycle starts with the cities document
+        cities_url = next((record['url'] for record in records if record['method'] == 'GET'), None)
+        service = service_factory(http, cities_url)
+        start = time.perf_counter()
+        service.process_messages()
+        service.fanout.close()
+        if service.coalescer:
+            service.coalescer.close()
+        yield {
+            'cycle': cycle,
+            'seconds': time.perf_counter() - start,
+            'captured_seconds': max((record['offset'] for record in records), default=0.0),
+            'requests_served': http.served,
+            'requests_unmatched': http.unmatched,
+            'requests_not_replayed': http.pending(),
+            'traffic': service.cycle_stats.reset(),
+        }
@@ -1,16 +1,45 @@
+import json
 import requests
-from typing import Dict, List
+from typing import Dict, List, Optional
 from requests import Response
 from requests.exceptions import RequestException
 
 class CityAPI:
-    def __init__(self, api_url: str):
+    def __init__(self, api_url: str, http=None, state=None, cache_seconds: Optional[float] = None):
         self.api_url = api_url
+        # Anything with requests' get(), e.g. an Http2Session
+        self.http = http or requests
+        # With a shared state backend, workers reuse one another's fetch for `cache_seconds`
+        self.state = state
+        self.cache_seconds = cache_seconds
 
     def get_cities(self) -> Dict:
+        cached = self._cached()
+        if cached is not None:
+            return cached
         try:
-            response: Response = requests.get(self.api_url)
+            response: Response = self.http.get(self.api_url)
             response.raise_for_status()
-            return response.json().get('data')
+            data = response.json().get('data')
         except RequestException as e:
             raise Exception(f"Error fetching cities data: {e}")
+        self._cache(data)
+        return data
+
+    def _cached(self) -> Optional[Dict]:
+        if self.state is None or not self.cache_seconds:
+            return None
+        try:
+            cached = self.state.get_many([f"cities:{self.api_url}"])[0]
+        except Exception as e:
+            print(f"Error reading cached cities data: {e}")
+            return None
+        return json.loads(cached) if cached is not None else None
+
+    def _cache(self, data: Dict) -> None:
+        if self.state is None or not self.cache_seconds:
+            return
+        try:
+            self.state.set_many({f"cities:{self.api_url}": json.dumps(data)}, ttl=self.cache_seconds)
+        except Exception as e:
+            print(f"Error caching cities data: {e}")
@@ -0,0 +1,244 @@
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from src.external_api import ExternalAPI
+from src.fanout import DeliveryResult
+from src.idempotency import batch_key, recipient_key
+from src.journal import AppendLog
+from src.routing import Route
+
+
+@dataclass
+class _Pending:
+    seq: int
+    agent_name: str
+    updated_file: Dict
+    size: int
+    queued_at: float
+    attempts: int = 0
+
+
+class CoalescingBuffer:
+    """
+    Holds outgoing inbox files per recipient and delivers them in batches.
+
+    A recipient's files are posted as one `updated_files` blob once the oldest of them has
+    waited `max_delay` seconds, or as soon as `max_messages` files or `max_bytes` of file
+    content are queued for it. A background thread flushes recipients when their window
+    ends.
+
+    With a `path`, every queued file is written to an append-only log before `add()`
+    returns (once, with the list of its routes), and flushed batches are marked in it, so
+    files that were still buffered when the process stopped are delivered by the next
+    process that opens the same path. This is also how batches span runs: `close()` leaves
+    files that have not waited `max_delay` yet in the log. A failed post is retried with
+    the recipient's next batch, up to `max_attempts` times; attempts are logged too, so a
+    restart does not reset them. Files that used up their attempts are handed to
+    `on_drop(agent_name, updated_files, error)`, e.g. to record them as dead letters.
+    """
+
+    def __init__(self, external_api: ExternalAPI, path: Optional[str] = None, max_delay: float = 5.0,
+                 max_messages: int = 20, max_bytes: int = 256 * 1024, max_attempts: int = 3,
+                 on_drop: Optional[Callable[[str, List[Dict], str], None]] = None):
+        self.external_api = external_api
+        self.on_drop = on_drop
+        self.max_delay = max_delay
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_attempts = max_attempts
+        self.flushes = 0
+        self.files_sent = 0
+        self.files_dropped = 0
+        self._pending: Dict[str, List[_Pending]] = {}
+        self._agents: Dict[str, str] = {}
+        self._seq = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._log = AppendLog(path) if path else None
+        if self._log:
+            self._recover()
+        self._flusher = threading.Thread(target=self._run_flusher, name='coalescing', daemon=True)
+        self._flusher.start()
+
+    def add(self, routes: List[Route], updated_file: Dict) -> List[DeliveryResult]:
+        """
+        Queues one inbox file for every route, posting the batches that reached their size limits.
+
+        Returns:
+            A DeliveryResult per route; files that are still buffered have no status code yet
+        """
+        now = time.time()
+        size = len(updated_file.get('file_content', ''))
+        with self._condition:
+            first = self._seq + 1
+            self._seq += len(routes)
+        entries = [_Pending(first + offset, route.agent_name, updated_file, size, now) for offset, route in enumerate(routes)]
+
+        # Durable before it counts as handed over; the log's group commit batches concurrent adds
+        if self._log:
+            self._log.append({'event': 'queued', 'file': updated_file, 'at': now,
+                              'routes': [{'seq': entry.seq, 'agent': route.agent_name, 'url': route.inbox_url}
+                                         for route, entry in zip(routes, entries)]})
+
+        full = []
+        with self._condition:
+            for route, entry in zip(routes, entries):
+                queue = self._pending.setdefault(route.inbox_url, [])
+                queue.append(entry)
+                self._agents[route.inbox_url] = route.agent_name
+                if len(queue) >= self.max_messages or sum(pending.size for pending in queue) >= self.max_bytes:
+                    full.append(route.inbox_url)
+            self._condition.notify_all()
+
+        results = {url: self._flush(url) for url in dict.fromkeys(full)}
+        return [results.get(route.inbox_url) or DeliveryResult(agent_name=route.agent_name, inbox_url=route.inbox_url)
+                for route in routes]
+
+    def flush_due(self, now: Optional[float] = None) -> List[DeliveryResult]:
+        """Posts the batches of every recipient whose oldest file has waited `max_delay` seconds."""
+        now = time.time() if now is None else now
+        with self._condition:
+            due = [url for url, queue in self._pending.items() if queue and queue[0].queued_at + self.max_delay <= now]
+        return [result for result in map(self._flush, due) if result is not None]
+
+    def flush_all(self) -> List[DeliveryResult]:
+        with self._condition:
+            urls = [url for url, queue in self._pending.items() if queue]
+        return [result for result in map(self._flush, urls) if result is not None]
+
+    def pending(self) -> Dict[str, int]:
+        """Number of buffered files per recipient."""
+        with self._condition:
+            return {self._agents[url]: len(queue) for url, queue in self._pending.items() if queue}
+
+    def stats(self) -> Dict[str, int]:
+        with self._condition:
+            buffered = sum(len(queue) for queue in self._pending.values())
+        return {'flushes': self.flushes, 'files_sent': self.files_sent, 'files_dropped': self.files_dropped,
+                'buffered': buffered}
+
+    def _flush(self, url: str) -> Optional[DeliveryResult]:
+        with self._condition:
+            batch = self._pending.pop(url, [])
+        if not batch:
+            return None
+
+        agent_name = self._agents[url]
+        result = DeliveryResult(agent_name=agent_name, inbox_url=url)
+        try:
+            files = [entry.updated_file for entry in batch]
+            key = recipient_key(batch_key(file.get('path', '') for file in files), agent_name)
+            response = self.external_api.add_to_inbox(url, {"updated_files": files}, idempotency_key=key)
+            result.status_code = getattr(response, 'status_code', None)
+            if result.status_code is not None and result.status_code >= 400:
+                result.error = f"HTTP {result.status_code}"
+        except Exception as e:
+            result.error = str(e)
+        result.delivered_at = datetime.now()
+
+        done = batch
+        if result.error is not None:
+            print(f"Error delivering {len(batch)} buffered messages to {agent_name}: {result.error}")
+            retry_at = time.time()
+            for entry in batch:
+                entry.attempts += 1
+                # Wait another window before the retry
+                entry.queued_at = retry_at
+            done = [entry for entry in batch if entry.attempts >= self.max_attempts]
+            retry = [entry for entry in batch if entry.attempts < self.max_attempts]
+            if self._log and retry:
+                self._log.append({'event': 'failed', 'seqs': [entry.seq for entry in retry], 'at': retry_at})
+            self.files_dropped += len(done)
+            with self._condition:
+                self._pending[url] = retry + self._pending.get(url, [])
+            if done:
+                self._drop(agent_name, done, result.error)
+        else:
+            self.flushes += 1
+            self.files_sent += len(batch)
+
+        if self._log and done:
+            self._log.append({'event': 'flushed', 'seqs': [entry.seq for entry in done]})
+        return result
+
+    def _drop(self, agent_name: str, entries: List[_Pending], error: str) -> None:
+        print(f"Dropping {len(entries)} buffered messages to {agent_name} after {self.max_attempts} attempts")
+        if self.on_drop is None:
+            return
+        try:
+            self.on_drop(agent_name, [entry.updated_file for entry in entries], error)
+        except Exception as e:
+            print(f"Error handing over {len(entries)} dropped messages to {agent_name}: {e}")
+
+    def _run_flusher(self) -> None:
+        while True:
+            with self._condition:
+                if self._closed:
+                    return
+                deadlines = [queue[0].queued_at + self.max_delay for queue in self._pending.values() if queue]
+                wait = max(0.0, min(deadlines) - time.time()) if deadlines else None
+                if wait is None or wait > 0:
+                    self._condition.wait(timeout=wait)
+                    continue
+            self.flush_due()
+
+    def _recover(self) -> None:
+        queued: Dict[int, Dict] = {}
+        for record in self._log.read():
+            if record['event'] == 'queued':
+                # One record per file; logs written before routes were grouped have one per route
+                for route in record.get('routes') or [record]:
+                    queued[route['seq']] = {'agent': route['agent'], 'url': route['url'], 'file': record['file'],
+                                            'at': route.get('at', record['at']), 'attempts': route.get('attempts', 0)}
+            elif record['event'] == 'failed':
+                for seq in record['seqs']:
+                    if seq in queued:
+                        queued[seq]['attempts'] += 1
+                        queued[seq]['at'] = record['at']
+            elif record['event'] == 'flushed':
+                for seq in record['seqs']:
+                    queued.pop(seq, None)
+
+        for seq, record in sorted(queued.items()):
+            entry = _Pending(seq, record['agent'], record['file'], len(record['file'].get('file_content', '')),
+                             record['at'], record['attempts'])
+            self._pending.setdefault(record['url'], []).append(entry)
+            self._agents[record['url']] = record['agent']
+        self._seq = max(queued, default=0)
+        self._compact()
+        if queued:
+            print(f"Recovered {len(queued)} buffered inbox files from {self._log.path}")
+
+    def _compact(self) -> None:
+        # The routes of one file share its dict, before and after a restart
+        records: Dict[int, Dict] = {}
+        with self._condition:
+            entries = sorted(((url, entry) for url, queue in self._pending.items() for entry in queue),
+                             key=lambda item: item[1].seq)
+            for url, entry in entries:
+                record = records.setdefault(id(entry.updated_file), {
+                    'event': 'queued', 'file': entry.updated_file, 'at': entry.queued_at, 'routes': []})
+                record['routes'].append({'seq': entry.seq, 'agent': entry.agent_name, 'url': url,
+                                         'at': entry.queued_at, 'attempts': entry.attempts})
+        self._log.rewrite(records.values())
+
+    def close(self) -> None:
+        """
+        Stops the flusher and posts the batches that are due. With a log, files that have not
+        waited `max_delay` yet stay in it, with their queue times and attempt counts, and are
+        batched with the files the next process queues for the same recipients. Without a log
+        every buffered batch is posted, since nothing else would deliver it.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._flusher.join()
+        if self._log:
+            self.flush_due()
+            self._compact()
+            self._log.close()
+        else:
+            self.flush_all()
@@ -0,0 +1,161 @@
+import os
+import random
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional
+
+from sqlalchemy import Column, DateTime, String, create_engine, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+
+from src.message_repository import Base
+
+
+def _utcnow() -> datetime:
+    # The lease columns hold naive UTC times
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class AgentLease(Base):
+    __tablename__ = 'agent_leases'
+
+    agent_name = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class LeaseCoordinator:
+    """
+    Hands out time-limited leases on agents through the shared database so that several
+    exchange instances can run side by side without collecting the same outbox twice.
+
+    A lease is taken with a single conditional upsert: a row is (re)assigned to this owner
+    only when it is free, already ours, or expired. An instance that dies simply stops
+    renewing, and its agents become claimable again once `ttl_seconds` has passed.
+
+    With `max_agents` set, an instance leases at most that many agents per cycle, so the
+    directory is spread over all running instances instead of going to the first one. A
+    released lease is kept as an expired row, so agents are then taken least recently polled
+    first and every agent gets its turn.
+    """
+
+    def __init__(self, db_url: str = None, owner: Optional[str] = None, ttl_seconds: int = 300,
+                 engine: Optional[Engine] = None, max_agents: Optional[int] = None):
+        self.engine = engine or create_engine(db_url, pool_pre_ping=True)
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.max_agents = max_agents
+
+        dialect = self.engine.dialect.name
+        if dialect == 'postgresql':
+            self._insert = postgresql.insert
+        elif dialect == 'sqlite':
+            self._insert = sqlite.insert
+        else:
+            raise Exception(f"Lease coordination is not supported on {dialect}")
+
+    @property
+    def ttl_seconds(self) -> float:
+        return self.ttl.total_seconds()
+
+    def claim(self, agent_names: Iterable[str]) -> List[str]:
+        """
+        Claims the agents that are not leased by another live instance, at most `max_agents`.
+
+        Args:
+            agent_names: Names of the agents this instance would like to poll
+
+        Returns:
+            The subset of agent names now leased to this instance
+        """
+        names = list(dict.fromkeys(agent_names))
+        if not names:
+            return []
+
+        now = _utcnow()
+        expires_at = now + self.ttl
+        table = AgentLease.__table__
+
+        if self.max_agents is not None:
+            names = self._claimable(names, now)
+            if not names:
+                return []
+
+        stmt = self._insert(table).values(
+            [{'agent_name': name, 'owner': self.owner, 'expires_at': expires_at} for name in names]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.agent_name],
+            set_={'owner': stmt.excluded.owner, 'expires_at': stmt.excluded.expires_at},
+            where=(table.c.owner == self.owner) | (table.c.expires_at < now),
+        )
+
+        with self.engine.begin() as conn:
+            conn.execute(stmt)
+            owned = conn.execute(
+                select(table.c.agent_name).where(table.c.owner == self.owner, table.c.agent_name.in_(names))
+            ).scalars().all()
+
+        owned = set(owned)
+        return [name for name in names if name in owned]
+
+    def _claimable(self, names: List[str], now: datetime) -> List[str]:
+        """
+        Picks up to `max_agents` of the names that are free, expired or already ours. Free
+        agents are taken least recently leased first, agents that were never leased before
+        all others; ties are broken at random, so instances starting together rarely compete
+        for the same ones. An agent taken by another instance in between is simply not claimed.
+        """
+        table = AgentLease.__table__
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(table.c.agent_name, table.c.owner, table.c.expires_at).where(table.c.agent_name.in_(names))
+            ).all()
+        taken = {name: owner for name, owner, expires_at in rows if expires_at >= now}
+        last_leased = {name: expires_at for name, owner, expires_at in rows if expires_at < now}
+        ours = [name for name in names if taken.get(name) == self.owner]
+        free = [name for name in names if name not in taken]
+        random.shuffle(free)
+        free.sort(key=lambda name: (name in last_leased, last_leased.get(name, now)))
+        return (ours + free)[:self.max_agents]
+
+    def renew(self, agent_names: Iterable[str]) -> List[str]:
+        """
+        Extends this instance's leases by another `ttl_seconds`, for cycles that run longer
+        than one lease.
+
+        Returns:
+            The agent names that are still leased to this instance
+        """
+        names = list(agent_names)
+        if not names:
+            return []
+
+        table = AgentLease.__table__
+        with self.engine.begin() as conn:
+            conn.execute(
+                table.update().where(table.c.owner == self.owner, table.c.agent_name.in_(names))
+                .values(expires_at=_utcnow() + self.ttl)
+            )
+            owned = set(conn.execute(
+                select(table.c.agent_name).where(table.c.owner == self.owner, table.c.agent_name.in_(names))
+            ).scalars().all())
+        return [name for name in names if name in owned]
+
+    def release(self, agent_names: Iterable[str]) -> None:
+        """
+        Gives up this instance's leases so other instances can claim the agents immediately.
+        The rows are expired rather than deleted; their time tells `_claimable()` when each
+        agent was last polled.
+        """
+        names = list(agent_names)
+        if not names:
+            return
+
+        table = AgentLease.__table__
+        with self.engine.begin() as conn:
+            conn.execute(
+                table.update().where(table.c.owner == self.owner, table.c.agent_name.in_(names))
+                .values(expires_at=_utcnow() - timedelta(microseconds=1))
+            )
@@ -0,0 +1,158 @@
+import hashlib
+import heapq
+import threading
+import time
+from typing import Dict, List, Tuple
+
+
+class CountMinSketch:
+    """
+    Approximate counts of arbitrarily many keys in `width * depth` counters.
+
+    An estimate is never below the true count and exceeds it by at most about
+    2 / width of the total added, with probability 1 - (1/2) ** depth.
+    """
+
+    def __init__(self, width: int = 1024, depth: int = 4):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self._rows = [[0] * width for _ in range(depth)]
+
+    def _columns(self, key: str) -> List[int]:
+        # Two independent 64-bit hashes give every row its own column (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + row * second) % self.width for row in range(self.depth)]
+
+    def add(self, key: str, count: int = 1) -> int:
+        """Adds `count` to the key and returns its new estimate."""
+        self.total += count
+        estimate = None
+        for row, column in zip(self._rows, self._columns(key)):
+            row[column] += count
+            estimate = row[column] if estimate is None else min(estimate, row[column])
+        return estimate
+
+    def estimate(self, key: str) -> int:
+        return min(row[column] for row, column in zip(self._rows, self._columns(key)))
+
+    def clear(self) -> None:
+        self.total = 0
+        for row in self._rows:
+            row[:] = [0] * self.width
+
+
+class TopK:
+    """
+    The `k` keys with the highest counts reported to it, kept in a dict with a min-heap
+    over it so the smallest member can be replaced in O(log k).
+    """
+
+    def __init__(self, k: int = 10):
+        self.k = k
+        self._counts: Dict[str, int] = {}
+        self._heap: List[Tuple[int, str]] = []
+
+    def offer(self, key: str, count: int) -> None:
+        if key in self._counts or len(self._counts) < self.k:
+            self._counts[key] = count
+        elif count > self._min()[0]:
+            del self._counts[heapq.heappop(self._heap)[1]]
+            self._counts[key] = count
+        else:
+            return
+        heapq.heappush(self._heap, (count, key))
+        # Updated counts leave stale heap entries behind; rebuild before they add up
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(count, key) for key, count in self._counts.items()]
+            heapq.heapify(self._heap)
+
+    def _min(self) -> Tuple[int, str]:
+        while self._counts.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0]
+
+    def items(self) -> List[Tuple[str, int]]:
+        """The tracked keys and counts, highest first."""
+        return sorted(self._counts.items(), key=lambda item: (-item[1], item[0]))
+
+    def clear(self) -> None:
+        self._counts.clear()
+        self._heap.clear()
+
+
+class CycleStats:
+    """
+    Thread-safe traffic statistics for the exchange in constant memory: message and
+    delivery counters, plus per-agent counts in count-min sketches with the top `top_k`
+    senders and recipients tracked on top of them.
+
+    `snapshot()` reports the statistics since the last `reset()`; `reset()` returns the
+    final snapshot of the period it ends, so a service can report and start over after
+    every cycle.
+    """
+
+    def __init__(self, top_k: int = 10, width: int = 1024, depth: int = 4):
+        self._lock = threading.Lock()
+        self._senders = CountMinSketch(width, depth)
+        self._recipients = CountMinSketch(width, depth)
+        self._top_senders = TopK(top_k)
+        self._top_recipients = TopK(top_k)
+        self._clear()
+
+    def _clear(self) -> None:
+        self.messages = 0
+        self.deliveries = 0
+        self.failed_deliveries = 0
+        self.started_at = time.time()
+        for structure in (self._senders, self._recipients, self._top_senders, self._top_recipients):
+            structure.clear()
+
+    def record_message(self, recipients: List[str]) -> None:
+        """Counts a collected message and each distinct address it was sent to."""
+        with self._lock:
+            self.messages += 1
+            for recipient in set(recipients):
+                self._top_recipients.offer(recipient, self._recipients.add(recipient))
+
+    def record_delivery(self, sender: str, delivered: bool) -> None:
+        """Counts one delivery attempt of a message from `sender` to a single recipient."""
+        with self._lock:
+            if not delivered:
+                self.failed_deliveries += 1
+                return
+            self.deliveries += 1
+            self._top_senders.offer(sender, self._senders.add(sender))
+
+    def sent_by(self, sender: str) -> int:
+        """Estimated number of deliveries from the sender in this period."""
+        with self._lock:
+            return self._senders.estimate(sender)
+
+    def addressed_to(self, recipient: str) -> int:
+        """Estimated number of messages addressed to the recipient in this period."""
+        with self._lock:
+            return self._recipients.estimate(recipient)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return self._snapshot()
+
+    def reset(self) -> Dict:
+        """Starts a new period and returns the snapshot of the one that ended."""
+        with self._lock:
+            snapshot = self._snapshot()
+            self._clear()
+        return snapshot
+
+    def _snapshot(self) -> Dict:
+        return {
+            'since': self.started_at,
+            'messages': self.messages,
+            'recipients': self._recipients.total,
+            'deliveries': self.deliveries,
+            'failed_deliveries': self.failed_deliveries,
+            'top_senders': self._top_senders.items(),
+            'top_recipients': self._top_recipients.items(),
+        }
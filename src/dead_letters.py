@@ -0,0 +1,144 @@
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import Column, DateTime, Integer, String, Text, UniqueConstraint, create_engine, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+
+from src.idempotency import message_key
+from src.message import Message
+from src.message_repository import Base
+
+UNRESOLVED = 'unresolved'
+DELIVERY_FAILED = 'delivery_failed'
+
+
+class DeadLetterModel(Base):
+    """One message that could not be delivered to one recipient."""
+    __tablename__ = 'dead_letters'
+    __table_args__ = (UniqueConstraint('delivery_key', 'recipient', name='uq_dead_letters_delivery_key_recipient'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    delivery_key = Column(String, nullable=False)
+    recipient = Column(String, nullable=False)
+    message = Column(Text, nullable=False)
+    reason = Column(String, nullable=False, index=True)
+    attempts = Column(Integer, nullable=False)
+    last_error = Column(Text)
+    first_failed_at = Column(DateTime, nullable=False)
+    last_failed_at = Column(DateTime, nullable=False)
+
+
+@dataclass
+class DeadLetter:
+    id: int
+    message: Message
+    recipient: str
+    reason: str
+    attempts: int
+    last_error: Optional[str]
+
+
+class DeadLetterStore:
+    """
+    Keeps the (message, recipient) pairs the exchange could not deliver, so that they can
+    be retried later instead of being dropped.
+
+    A pair is recorded once, keyed by the message's delivery key and the recipient; every
+    further failure is a single upsert that increments its attempt count and replaces the
+    reason and last error. The message is stored as it was collected, body included.
+    """
+
+    def __init__(self, db_url: str = None, engine: Optional[Engine] = None):
+        self.engine = engine or create_engine(db_url, pool_pre_ping=True)
+
+        dialect = self.engine.dialect.name
+        if dialect == 'postgresql':
+            self._insert = postgresql.insert
+        elif dialect == 'sqlite':
+            self._insert = sqlite.insert
+        else:
+            raise Exception(f"Dead letters are not supported on {dialect}")
+
+    def record(self, msg: Message, recipients: Iterable[str], reason: str, error: Optional[str] = None) -> None:
+        """
+        Records a failed delivery of `msg` to each of `recipients`.
+
+        Args:
+            msg: The message that was not delivered
+            recipients: Agent names, or the addresses that did not resolve to an agent
+            reason: UNRESOLVED or DELIVERY_FAILED
+            error: What went wrong, for operators
+        """
+        recipients = list(dict.fromkeys(recipients))
+        if not recipients:
+            return
+
+        now = datetime.utcnow()
+        key = message_key(msg)
+        body = json.dumps(msg.to_dict())
+        table = DeadLetterModel.__table__
+        stmt = self._insert(table).values([
+            {'delivery_key': key, 'recipient': recipient, 'message': body, 'reason': reason, 'attempts': 1,
+             'last_error': error, 'first_failed_at': now, 'last_failed_at': now}
+            for recipient in recipients
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.delivery_key, table.c.recipient],
+            set_={'reason': stmt.excluded.reason, 'last_error': stmt.excluded.last_error,
+                  'last_failed_at': stmt.excluded.last_failed_at, 'attempts': table.c.attempts + 1},
+        )
+        with self.engine.begin() as conn:
+            conn.execute(stmt)
+
+    def batch(self, after_id: int = 0, limit: int = 100, max_attempts: Optional[int] = None) -> List[DeadLetter]:
+        """
+        Returns up to `limit` dead letters with an id above `after_id`, in id order.
+
+        Args:
+            after_id: The last id of the previous batch
+            limit: Batch size
+            max_attempts: Leave out letters that have already failed this many times
+        """
+        table = DeadLetterModel.__table__
+        query = select(table).where(table.c.id > after_id).order_by(table.c.id).limit(limit)
+        if max_attempts is not None:
+            query = query.where(table.c.attempts < max_attempts)
+        with self.engine.connect() as conn:
+            rows = conn.execute(query).mappings().all()
+
+        letters = []
+        for row in rows:
+            msg = Message.from_dict(json.loads(row['message']))
+            msg.delivery_key = row['delivery_key']
+            letters.append(DeadLetter(row['id'], msg, row['recipient'], row['reason'], row['attempts'],
+                                      row['last_error']))
+        return letters
+
+    def remove(self, ids: Iterable[int]) -> None:
+        """Deletes dead letters that have since been delivered."""
+        ids = list(ids)
+        if not ids:
+            return
+        table = DeadLetterModel.__table__
+        with self.engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.id.in_(ids)))
+
+    def remove_delivered(self, msg: Message, recipients: Iterable[str]) -> None:
+        """Deletes the dead letters of `msg` for recipients it was delivered to some other way."""
+        recipients = list(dict.fromkeys(recipients))
+        if not recipients:
+            return
+        table = DeadLetterModel.__table__
+        with self.engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.delivery_key == message_key(msg),
+                                              table.c.recipient.in_(recipients)))
+
+    def counts(self) -> Dict[str, int]:
+        """Number of dead letters per reason."""
+        table = DeadLetterModel.__table__
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(table.c.reason, func.count()).group_by(table.c.reason)).all()
+        return {reason: count for reason, count in rows}
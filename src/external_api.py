@@ -1,46 +1,177 @@
+import gzip
 import json
+import threading
+import time
+import zlib
 from datetime import datetime
 
 import requests
-from typing import Dict, List
+from typing import Dict, Iterable, List, Optional, Set, Union
 from requests import Response
 from requests.exceptions import RequestException
 
-from app import messages
+from src.idempotency import IDEMPOTENCY_HEADER, message_key
 from src.message import Message
+from src.metrics import Metrics, metrics as default_metrics
+from src.payload import InboxStream, SpooledData
+from src.scheduling import priority_lane
+
+ACCEPT_ENCODING = 'gzip, deflate'
 
 
 class ExternalAPI:
-    def __init__(self, token: str):
+    def __init__(self, token: str, compress_threshold: Optional[int] = None, metrics: Optional[Metrics] = None,
+                 spool_threshold: Optional[int] = None, max_message_bytes: Optional[int] = None,
+                 max_response_bytes: Optional[int] = None, spool_dir: Optional[str] = None, http=None,
+                 state=None, circuit_failures: int = 5, circuit_seconds: float = 60):
+        """
+        Args:
+            token: API token for the agent backend
+            compress_threshold: Gzip inbox bodies of at least this many bytes; None disables request compression
+            metrics: Registry for transfer sizes and compression timings
+            spool_threshold: Message bodies larger than this many bytes are moved to a temporary file
+            max_message_bytes: Message bodies larger than this are rejected at collection
+            max_response_bytes: Outbox responses that decode to more than this are rejected
+            spool_dir: Directory for spool files, defaults to the system temp directory
+            http: Client to send requests with, e.g. an Http2Session; defaults to the requests module
+            state: State backend holding the inbox circuit breakers (see src/state.py); None disables them
+            circuit_failures: Failed posts to one inbox within `circuit_seconds` that open its circuit
+            circuit_seconds: How long failures are counted, and so how long an open circuit stays open
+        """
         self.token = token
+        self.compress_threshold = compress_threshold
+        self.metrics = metrics or default_metrics
+        self.spool_threshold = spool_threshold
+        self.max_message_bytes = max_message_bytes
+        self.max_response_bytes = max_response_bytes
+        self.spool_dir = spool_dir
+        self.http = http or requests
+        self.state = state
+        self.circuit_failures = circuit_failures
+        self.circuit_seconds = circuit_seconds
+        # A broadcast posts the same bytes object to every recipient, so compress it only once
+        self._compress_lock = threading.Lock()
+        self._last_compressed = None
 
     def collect_from_outbox(self, url: str) -> List[Message]:
         try:
-            response: Response = requests.post(url)
+            response: Response = self.http.post(url, headers={'Accept-Encoding': ACCEPT_ENCODING}, stream=True)
             response.raise_for_status()
-            file_entries = self._extract_file_entries(response.json())
-
-            # Transform the file entries into Message objects
-            messages = []
-            for entry in file_entries:
-                if 'file_content' in entry and 'message' in entry['file_content']:
-                    msg_data = entry['file_content']['message']
-
-                    # Create a Message object directly
-                    message = Message(
-                        id=msg_data.get('id', None),  # Use None if id is missing
-                        created_at=msg_data.get('created_at', datetime.now()),  # Set current time as created_at
-                        collected_at=datetime.now(),  # Set current time as collected_at
-                        from_address=msg_data.get('from', ''),
-                        to_address=msg_data.get('to', ''),
-                        data=msg_data.get('data', '')
-                    )
-                    messages.append(message)
-
-            return messages
-        except (RequestException, json.JSONDecodeError) as e:
+            return self.parse_outbox(self._read_json(response), url)
+        except (RequestException, json.JSONDecodeError, zlib.error) as e:
             raise Exception(f"Error collecting messages from {url}: {e}")
 
+    def parse_outbox(self, data, source: str) -> List[Message]:
+        """
+        Turns an outbox tree into Message objects, applying the message size limits.
+
+        Args:
+            data: A decoded outbox response, or any structure with 'file_content' entries
+            source: Where the data came from, used in log lines
+        """
+        file_entries = self._extract_file_entries(data)
+
+        # Transform the file entries into Message objects
+        messages = []
+        for entry in file_entries:
+            if 'file_content' in entry and 'message' in entry['file_content']:
+                msg_data = entry['file_content']['message']
+                body = self._prepare_data(msg_data.get('data', ''), source)
+                if body is None:
+                    continue
+
+                # Create a Message object directly
+                message = Message(
+                    id=msg_data.get('id', None),  # Use None if id is missing
+                    created_at=msg_data.get('created_at'),
+                    collected_at=datetime.now(),  # Set current time as collected_at
+                    from_address=msg_data.get('from', ''),
+                    to_address=msg_data.get('to', ''),
+                    data=body,
+                    priority=priority_lane(msg_data['priority']) if msg_data.get('priority') is not None else None
+                )
+                # Keyed on what the sender wrote: a creation time filled in here would differ
+                # every time the message is collected, and so would the key
+                message_key(message)
+                if message.created_at is None:
+                    message.created_at = datetime.now()
+                messages.append(message)
+
+        return messages
+
+    def _prepare_data(self, data, url: str):
+        """
+        Applies the size limits to a collected message body.
+
+        Returns the body unchanged, a SpooledData for bodies above `spool_threshold`, or None
+        when the body exceeds `max_message_bytes` and the message is rejected.
+        """
+        if not isinstance(data, str) or (self.spool_threshold is None and self.max_message_bytes is None):
+            return data
+
+        # Characters are a lower bound and four times the characters an upper bound of the UTF-8 size,
+        # so the body only has to be encoded when it is close to one of the limits
+        limits = [limit for limit in (self.spool_threshold, self.max_message_bytes) if limit is not None]
+        if len(data) * 4 <= min(limits):
+            return data
+        size = len(data.encode('utf-8'))
+
+        if self.max_message_bytes is not None and size > self.max_message_bytes:
+            print(f"Rejecting message from {url}: body of {size} bytes exceeds {self.max_message_bytes}")
+            self.metrics.increment('outbox.messages_rejected')
+            return None
+        if self.spool_threshold is not None and size > self.spool_threshold:
+            self.metrics.increment('outbox.messages_spooled')
+            self.metrics.increment('outbox.bytes_spooled', size)
+            return SpooledData.from_text(data, directory=self.spool_dir)
+        return data
+
+    def _read_json(self, response: Response):
+        """
+        Reads a streamed response body as sent on the wire, decompresses it ourselves so the
+        compression ratio and the CPU spent inflating it can be recorded, and parses the JSON.
+        """
+        encoding = response.headers.get('Content-Encoding', '').strip().lower()
+        limit = self.max_response_bytes
+        if limit is None:
+            wire = response.raw.read(decode_content=encoding not in ('gzip', 'deflate'))
+        else:
+            wire = response.raw.read(limit + 1, decode_content=encoding not in ('gzip', 'deflate'))
+
+        start = time.perf_counter()
+        if encoding == 'gzip':
+            body = self._inflate(wire, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            try:
+                body = self._inflate(wire, zlib.MAX_WBITS)
+            except zlib.error:
+                # Some servers send raw deflate streams without the zlib header
+                body = self._inflate(wire, -zlib.MAX_WBITS)
+        else:
+            body = wire
+        elapsed = time.perf_counter() - start
+
+        if limit is not None and len(body) > limit:
+            self.metrics.increment('outbox.responses_rejected')
+            raise Exception(f"Outbox response exceeds {limit} bytes")
+
+        self.metrics.increment('outbox.bytes_wire', len(wire))
+        self.metrics.increment('outbox.bytes_decoded', len(body))
+        if body is not wire:
+            self.metrics.increment(f'outbox.responses_{encoding}')
+            self.metrics.observe('outbox.decompress_seconds', elapsed)
+            if body:
+                self.metrics.observe('outbox.compression_ratio', len(wire) / len(body))
+
+        return json.loads(body)
+
+    def _inflate(self, wire: bytes, wbits: int) -> bytes:
+        # Bounded so that a small compressed response cannot expand past max_response_bytes
+        decompressor = zlib.decompressobj(wbits)
+        if self.max_response_bytes is None:
+            return decompressor.decompress(wire) + decompressor.flush()
+        return decompressor.decompress(wire, self.max_response_bytes + 1)
+
     def _extract_file_entries(self, data, results=None):
         """
         Recursively searches through a dictionary or list and collects all dictionaries
@@ -71,12 +202,105 @@ class ExternalAPI:
 
         return results
 
-    def add_to_inbox(self, url: str, message: dict) -> Response:
-        print(f"Sending message to {url}...payload = {message}")
-        response = requests.post(url, json=message)
+    def open_circuits(self, urls: Iterable[str]) -> Set[str]:
+        """
+        Returns the inbox URLs whose circuit is open, i.e. that failed `circuit_failures` times
+        within the last `circuit_seconds`, as seen by every worker sharing the state backend.
+        One state lookup covers all the URLs.
+        """
+        urls = list(dict.fromkeys(urls))
+        if self.state is None or not urls:
+            return set()
+        try:
+            failures = self.state.get_many([f"circuit:{url}" for url in urls])
+        except Exception as e:
+            # Without the shared state every inbox is tried, as if no breakers were configured
+            print(f"Error reading inbox circuits: {e}")
+            return set()
+        return {url for url, count in zip(urls, failures) if count is not None and int(count) >= self.circuit_failures}
+
+    def _record_failure(self, url: str) -> None:
+        if self.state is None:
+            return
+        try:
+            if self.state.incr(f"circuit:{url}", self.circuit_seconds) == self.circuit_failures:
+                print(f"Opening circuit for {url} for up to {self.circuit_seconds}s")
+                self.metrics.increment('inbox.circuits_opened')
+        except Exception as e:
+            print(f"Error recording failure of {url}: {e}")
+
+    def add_to_inbox(self, url: str, message: Union[dict, bytes], idempotency_key: Optional[str] = None) -> Response:
+        """
+        Posts an inbox blob to a recipient.
+
+        Args:
+            url: The recipient's RECEIVE_POST URL
+            message: The blob as a dict, already JSON-encoded bytes shared between recipients,
+                or an InboxStream for spooled bodies, which is sent with chunked transfer encoding
+            idempotency_key: Sent as the Idempotency-Key header, so the backend can recognize a retry
+
+        Bodies of at least `compress_threshold` bytes are sent gzip-compressed with a
+        Content-Encoding header. Connection errors and 5xx responses count towards the inbox's
+        circuit breaker.
+        """
+        if self.state is None:
+            return self._post_to_inbox(url, message, idempotency_key)
+        try:
+            response = self._post_to_inbox(url, message, idempotency_key)
+        except Exception:
+            self._record_failure(url)
+            raise
+        if response.status_code >= 500:
+            self._record_failure(url)
+        return response
+
+    def _post_to_inbox(self, url: str, message: Union[dict, bytes], idempotency_key: Optional[str]) -> Response:
+        if isinstance(message, dict) and self.compress_threshold is not None:
+            message = json.dumps(message).encode('utf-8')
+
+        extra_headers = {IDEMPOTENCY_HEADER: idempotency_key} if idempotency_key else {}
+        if isinstance(message, InboxStream):
+            print(f"Sending message to {url}...payload = streamed from {message.data.path}")
+            headers = {'Content-Type': 'application/json', **extra_headers}
+            body = message
+            if self.compress_threshold is not None and message.size_hint >= self.compress_threshold:
+                body = message.gzip()
+                headers['Content-Encoding'] = 'gzip'
+                self.metrics.increment('inbox.requests_gzip')
+            self.metrics.increment('inbox.requests_streamed')
+            response = self.http.post(url, data=body, headers=headers)
+        elif isinstance(message, bytes):
+            print(f"Sending message to {url}...payload = {len(message)} bytes")
+            headers = {'Content-Type': 'application/json', **extra_headers}
+            body = message
+            if self.compress_threshold is not None and len(message) >= self.compress_threshold:
+                body = self._compress(message)
+                headers['Content-Encoding'] = 'gzip'
+            self.metrics.increment('inbox.bytes_raw', len(message))
+            self.metrics.increment('inbox.bytes_wire', len(body))
+            response = self.http.post(url, data=body, headers=headers)
+        else:
+            print(f"Sending message to {url}...payload = {message}")
+            if extra_headers:
+                response = self.http.post(url, json=message, headers=extra_headers)
+            else:
+                response = self.http.post(url, json=message)
         print(f"Response: {response.status_code} {response.text}")
         return response
 
+    def _compress(self, body: bytes) -> bytes:
+        self.metrics.increment('inbox.requests_gzip')
+        with self._compress_lock:
+            if self._last_compressed is not None and self._last_compressed[0] is body:
+                return self._last_compressed[1]
+
+            start = time.perf_counter()
+            compressed = gzip.compress(body, compresslevel=6)
+            self.metrics.observe('inbox.compress_seconds', time.perf_counter() - start)
+            self.metrics.observe('inbox.compression_ratio', len(compressed) / len(body))
+            self._last_compressed = (body, compressed)
+            return compressed
+
     def serialize_message(self, obj):
         # Handle datetime conversion for JSON
         if isinstance(obj, datetime):
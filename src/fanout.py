@@ -0,0 +1,132 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Union
+
+from src.external_api import ExternalAPI
+from src.idempotency import inbox_path, message_key, recipient_key
+from src.message import Message
+from src.payload import InboxStream
+from src.routing import Route
+
+
+@dataclass
+class DeliveryResult:
+    agent_name: str
+    inbox_url: str
+    delivered_at: Optional[datetime] = None
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.status_code is not None and self.status_code < 400
+
+
+class BroadcastFanout:
+    """
+    Delivers one message to many inboxes.
+
+    The inbox blob is built and serialized once per message; every recipient is sent the
+    same bytes, and the posts run concurrently on a shared thread pool so a broadcast to a
+    whole city takes roughly one round-trip of wall time.
+
+    The inbox file is named after the message's delivery key, and each post carries an
+    Idempotency-Key header for its (message, recipient) pair, so a retried delivery writes
+    the same file again instead of a second one. Inboxes whose circuit is open in
+    ExternalAPI are not posted to; their results carry a "circuit open" error.
+    """
+
+    def __init__(self, external_api: ExternalAPI, max_workers: int = 8):
+        self.external_api = external_api
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Several deliver workers share the fanout; only one of them may create the pool
+        self._executor_lock = threading.Lock()
+
+    def encode(self, msg: Message) -> Union[bytes, InboxStream]:
+        """
+        Returns the inbox payload shared by all recipients.
+
+        Spooled bodies are not loaded; each recipient streams them from the spool file.
+        """
+        if msg.is_spooled:
+            return InboxStream(inbox_path(msg), self._sent(msg.to_dict(include_data=False)), msg.data)
+
+        blob = {
+            "updated_files": [self.updated_file(msg)]
+        }
+        return json.dumps(blob).encode('utf-8')
+
+    def updated_file(self, msg: Message) -> Dict:
+        """Returns the message's entry for an `updated_files` blob."""
+        return {
+            "path": inbox_path(msg),
+            "file_content": json.dumps(self._sent(msg.to_dict()))
+        }
+
+    @staticmethod
+    def _sent(content: Dict) -> Dict:
+        # The inbox file carries the time it was sent; msg.delivered_at is only set by the
+        # caller once a post has succeeded, so that a failed delivery is not recorded as one
+        return dict(content, delivered_at=datetime.now().isoformat())
+
+    def deliver(self, msg: Message, routes: List[Route]) -> List[DeliveryResult]:
+        """
+        Sends the message to every route in parallel.
+
+        Args:
+            msg: The message to deliver
+            routes: Resolved recipients of the message
+
+        Returns:
+            One DeliveryResult per route, in the order of `routes`
+        """
+        if not routes:
+            return []
+        return self.send(routes, self.encode(msg), message_key(msg))
+
+    def send(self, routes: List[Route], payload: Union[bytes, InboxStream],
+             key: Optional[str] = None) -> List[DeliveryResult]:
+        """
+        Posts an already encoded payload to every route in parallel.
+
+        Args:
+            routes: Resolved recipients
+            payload: The output of encode()
+            key: The message's delivery key; each post is sent with its recipient's idempotency key
+        """
+        if not routes:
+            return []
+        open_circuits = self.external_api.open_circuits(route.inbox_url for route in routes)
+        if len(routes) == 1:
+            return [self._send(routes[0], payload, key, open_circuits)]
+
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='fanout')
+            executor = self._executor
+        return list(executor.map(lambda route: self._send(route, payload, key, open_circuits), routes))
+
+    def _send(self, route: Route, payload: Union[bytes, InboxStream], key: Optional[str],
+              open_circuits: Set[str]) -> DeliveryResult:
+        result = DeliveryResult(agent_name=route.agent_name, inbox_url=route.inbox_url)
+        if route.inbox_url in open_circuits:
+            result.error = "circuit open"
+            return result
+        try:
+            idempotency_key = recipient_key(key, route.agent_name) if key else None
+            response = self.external_api.add_to_inbox(route.inbox_url, payload, idempotency_key=idempotency_key)
+            result.status_code = getattr(response, 'status_code', None)
+        except Exception as e:
+            result.error = str(e)
+        result.delivered_at = datetime.now()
+        return result
+
+    def close(self) -> None:
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
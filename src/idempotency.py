@@ -0,0 +1,58 @@
+import hashlib
+import json
+from datetime import datetime
+from typing import Iterable
+
+from src.message import Message
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+
+def _timestamp(value):
+    # A creation time given as an ISO string and as a datetime hashes the same
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return value
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def message_key(msg: Message) -> str:
+    """
+    Returns the message's delivery key, computing it on first use.
+
+    The key is a hash of what the sender put in the outbox: id, sender, recipients, creation
+    time (when the sender gave one) and body. Collecting or recovering the same message again
+    yields the same key, while two messages stamped in the same microsecond still get
+    different ones.
+    """
+    if msg.delivery_key is None:
+        created_at = _timestamp(msg.created_at)
+        digest = hashlib.sha256(json.dumps([msg.id, msg.from_address, msg.to_address, created_at],
+                                           default=str).encode('utf-8'))
+        digest.update(b'\0')
+        if msg.is_spooled:
+            for chunk in msg.data.iter_text():
+                digest.update(chunk.encode('utf-8'))
+        elif isinstance(msg.data, str):
+            digest.update(msg.data.encode('utf-8'))
+        else:
+            digest.update(json.dumps(msg.data, sort_keys=True, default=str).encode('utf-8'))
+        msg.delivery_key = digest.hexdigest()[:32]
+    return msg.delivery_key
+
+
+def inbox_path(msg: Message) -> str:
+    """The file the message is written to in a recipient's inbox; the same on every retry."""
+    return f"./{message_key(msg)}.json"
+
+
+def recipient_key(key: str, agent_name: str) -> str:
+    """The idempotency key of delivering the message with delivery key `key` to one recipient."""
+    return hashlib.sha256(f"{key}\0{agent_name}".encode('utf-8')).hexdigest()[:32]
+
+
+def batch_key(paths: Iterable[str]) -> str:
+    """A delivery key for a batch of inbox files, from their paths in order."""
+    return hashlib.sha256('\0'.join(paths).encode('utf-8')).hexdigest()[:32]
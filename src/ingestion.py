@@ -0,0 +1,120 @@
+import hmac
+import queue
+import threading
+from typing import List, Optional
+
+from src.idempotency import message_key
+from src.message import Message
+
+
+def token_matches(authorization: Optional[str], token: Optional[str]) -> bool:
+    """
+    Checks an `Authorization: Bearer <token>` header against the exchange token.
+
+    Without a configured token nothing is accepted.
+    """
+    if not token or not authorization:
+        return False
+    scheme, _, presented = authorization.partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(presented.strip(), token)
+
+
+def outbox_entries(payload) -> Optional[List]:
+    """
+    Returns the outbox entries of a pushed payload, or None if it has none.
+
+    Agents push either the same tree their outbox endpoint returns (entries with a
+    'file_content' key), or plain message dicts as {"message": {...}} or {"messages": [...]}.
+    """
+    if isinstance(payload, dict):
+        if isinstance(payload.get('message'), dict):
+            return [{'file_content': {'message': payload['message']}}]
+        if isinstance(payload.get('messages'), list):
+            return [{'file_content': {'message': message}} for message in payload['messages'] if isinstance(message, dict)]
+    if isinstance(payload, (dict, list)):
+        return [payload]
+    return None
+
+
+class IngestionWorker:
+    """
+    Delivers messages pushed to the service on a background thread.
+
+    The endpoint returns as soon as a batch is queued; the worker routes it through the
+    MessageService delivery stages against a directory that is refreshed at most every
+    `directory_ttl` seconds. When `max_pending` batches are waiting, `submit()` refuses
+    new ones so the caller can retry, and the outbox poll picks up anything not pushed.
+
+    When the service has a journal, accepted messages are journaled before `submit()`
+    returns, and the messages a previous process accepted but did not deliver are
+    delivered first. The journal is compacted every `compact_every` batches.
+    """
+
+    def __init__(self, service, directory_ttl: float = 60, max_pending: int = 1000, compact_every: int = 100):
+        self.service = service
+        self.directory_ttl = directory_ttl
+        self.compact_every = compact_every
+        self.accepted = 0
+        self.errors = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        # Compaction rewrites the journal from what it has read, so it must not overlap an append
+        self._journal_lock = threading.Lock()
+        self._batches = 0
+        if service.journal:
+            self._recover()
+        self._thread = threading.Thread(target=self._run, name='ingestion', daemon=True)
+        self._thread.start()
+
+    def _recover(self) -> None:
+        try:
+            _, routing_table = self.service.load_directory()
+            recovered = self.service.recover_journal(routing_table)
+        except Exception as e:
+            # The messages stay in the journal for the next start
+            print(f"Error recovering pushed messages: {e}")
+            return
+        if recovered:
+            print(f"Recovered {recovered} pushed messages from the journal")
+
+    def submit(self, messages: List[Message]) -> bool:
+        journal = self.service.journal
+        with self._journal_lock:
+            if journal:
+                for msg in messages:
+                    # Keyed first, so that a recovered delivery reuses the inbox path and idempotency keys
+                    message_key(msg)
+                    journal.record_collected(msg)
+            try:
+                self._queue.put_nowait(messages)
+            except queue.Full:
+                if journal:
+                    for msg in messages:
+                        journal.record_done(msg.journal_key)
+                return False
+        self.accepted += len(messages)
+        return True
+
+    def join(self) -> None:
+        """Blocks until every submitted batch has been delivered."""
+        self._queue.join()
+
+    def _run(self) -> None:
+        while True:
+            messages = self._queue.get()
+            try:
+                if messages is None:
+                    return
+                self.service.deliver_messages(messages, max_directory_age=self.directory_ttl)
+                self._batches += 1
+                if self.service.journal and self._batches % self.compact_every == 0:
+                    with self._journal_lock:
+                        self.service.journal.compact()
+            except Exception as e:
+                self.errors += 1
+                print(f"Error delivering {len(messages)} pushed messages: {e}")
+            finally:
+                self._queue.task_done()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,217 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from src.message import Message
+from src.payload import SpooledData
+
+
+class AppendLog:
+    """
+    Durable append-only log of JSON records, one per line.
+
+    Appends use group commit: concurrent writers queue their lines and whichever thread
+    finds no flush in progress writes and fsyncs the whole batch, so many pipeline threads
+    share one fsync.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+        self._cond = threading.Condition()
+        self._buffer: List[str] = []
+        self._appended = 0
+        self._synced = 0
+        self._flushing = False
+        self._error: Optional[Exception] = None
+        self.records = 0
+        self.batches = 0
+
+    def append(self, record: Dict) -> None:
+        """Appends one record and returns once it is on disk."""
+        line = json.dumps(record) + '\n'
+        with self._cond:
+            self._buffer.append(line)
+            self._appended += 1
+            ticket = self._appended
+
+            while self._synced < ticket:
+                if self._error is not None:
+                    raise Exception(f"Write to {self.path} failed: {self._error}")
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+
+                # No flush in progress: this thread commits everything queued so far
+                self._flushing = True
+                batch, self._buffer = self._buffer, []
+                upto = self._appended
+                self._cond.release()
+                try:
+                    self._file.write(''.join(batch))
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                except Exception as e:
+                    self._error = e
+                finally:
+                    self._cond.acquire()
+                    self._flushing = False
+                    self._cond.notify_all()
+                if self._error is None:
+                    self._synced = upto
+                    self.records += len(batch)
+                    self.batches += 1
+
+    def read(self) -> Iterator[Dict]:
+        """Yields the records on disk, skipping lines torn by a crash mid-write."""
+        with open(self.path, 'r', encoding='utf-8') as log:
+            for line in log:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def rewrite(self, records: Iterable[Dict]) -> None:
+        """Atomically replaces the log with `records`."""
+        with self._cond:
+            tmp_path = f"{self.path}.compact"
+            with open(tmp_path, 'w', encoding='utf-8') as compacted:
+                for record in records:
+                    compacted.write(json.dumps(record) + '\n')
+                compacted.flush()
+                os.fsync(compacted.fileno())
+            self._file.close()
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, 'a', encoding='utf-8')
+
+    def stats(self) -> Dict[str, int]:
+        return {'records': self.records, 'batches': self.batches}
+
+    def close(self) -> None:
+        with self._cond:
+            self._file.close()
+
+
+class Journal(AppendLog):
+    """
+    Append-only write-ahead journal of the exchange cycle, stored as JSON lines.
+
+    Three events are recorded: 'collected' (with the full message) before a message is
+    delivered, 'delivered' for each recipient that accepted it, and 'done' once the message
+    needs no further work. Appends are group-committed (see AppendLog). After a crash,
+    `recover()` replays the file and returns only the unfinished messages.
+
+    Spooled bodies are not written into the journal: the spool file is linked (or copied)
+    into the `<path>.spool` directory and the record refers to it, so journaling a large
+    message costs neither memory nor journal space. The copy is removed once the message is
+    done.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.spool_dir = f"{path}.spool"
+
+    def record_collected(self, msg: Message) -> str:
+        """Durably records a collected message and returns the key that identifies it in the journal."""
+        msg.journal_key = msg.journal_key or uuid.uuid4().hex
+        self.append(self._collected(msg))
+        return msg.journal_key
+
+    def _collected(self, msg: Message) -> Dict:
+        record = {'event': 'collected', 'key': msg.journal_key, 'message': msg.to_dict(include_data=not msg.is_spooled)}
+        if msg.is_spooled:
+            body = self._spool_path(msg.journal_key)
+            if not os.path.exists(body):
+                os.makedirs(self.spool_dir, exist_ok=True)
+                _link_or_copy(msg.data.path, body)
+            record['spooled'] = msg.data.size
+        if msg.delivery_key is not None:
+            # A recovered message must keep its inbox file name and idempotency keys
+            record['delivery_key'] = msg.delivery_key
+        return record
+
+    def _spool_path(self, key: str) -> str:
+        return os.path.join(self.spool_dir, f"{key}.body")
+
+    def record_delivered(self, key: str, agent_name: str) -> None:
+        self.append({'event': 'delivered', 'key': key, 'recipient': agent_name})
+
+    def record_done(self, key: str) -> None:
+        self.append({'event': 'done', 'key': key})
+        _remove(self._spool_path(key))
+
+    def _replay(self) -> Dict[str, Tuple[Dict, Set[str]]]:
+        """The 'collected' record of every unfinished message, with the recipients that already received it."""
+        pending: Dict[str, Tuple[Dict, Set[str]]] = {}
+        # A line torn by a crash mid-write is skipped; its message was never acknowledged
+        for record in self.read():
+            key = record.get('key')
+            if record['event'] == 'collected':
+                pending[key] = (record, set())
+            elif record['event'] == 'delivered' and key in pending:
+                pending[key][1].add(record['recipient'])
+            elif record['event'] == 'done':
+                pending.pop(key, None)
+        # A spooled body that is gone cannot be delivered any more
+        for key in [key for key, (record, _) in pending.items()
+                    if 'spooled' in record and not os.path.exists(self._spool_path(key))]:
+            print(f"Spooled body of journaled message {key} is missing; dropping it")
+            del pending[key]
+        return pending
+
+    def recover(self) -> List[Tuple[Message, Set[str]]]:
+        """
+        Replays the journal.
+
+        Returns:
+            Every collected message without a 'done' record, with the set of recipients that already received it
+        """
+        recovered = []
+        for key, (record, delivered) in self._replay().items():
+            msg = Message.from_dict(record['message'])
+            msg.journal_key = key
+            msg.delivery_key = record.get('delivery_key')
+            if 'spooled' in record:
+                msg.data = self._reopen(key, record['spooled'])
+            recovered.append((msg, delivered))
+        return recovered
+
+    def _reopen(self, key: str, size: int) -> SpooledData:
+        # The recovered message gets its own spool file, which it removes when it is done with
+        # it; the journal's copy stays until the message is done
+        fd, path = tempfile.mkstemp(prefix='agent_post_', suffix='.body')
+        os.close(fd)
+        os.remove(path)
+        _link_or_copy(self._spool_path(key), path)
+        return SpooledData(path, size)
+
+    def compact(self) -> None:
+        """Rewrites the journal so that it only holds the unfinished messages, and removes the other spooled bodies."""
+        records = []
+        pending = self._replay()
+        for key, (record, delivered) in pending.items():
+            records.append(record)
+            records.extend({'event': 'delivered', 'key': key, 'recipient': recipient} for recipient in sorted(delivered))
+        self.rewrite(records)
+        if os.path.isdir(self.spool_dir):
+            for name in set(os.listdir(self.spool_dir)) - {f"{key}.body" for key in pending}:
+                _remove(os.path.join(self.spool_dir, name))
+
+
+def _link_or_copy(source: str, target: str) -> None:
+    try:
+        os.link(source, target)
+    except OSError:
+        # Another filesystem, or links are not supported
+        shutil.copyfile(source, target)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -1,35 +1,67 @@
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Union
 import json
 
+from src.payload import SpooledData
+
+
+def split_addresses(to_address: str) -> List[str]:
+    """Splits a 'to' field that lists several recipients separated by ';', ',' or spaces."""
+    to_list = [to_address]  # Default to single address
+
+    # Check for common delimiters and split if found
+    for delim in [';', ',', ' ']:
+        if delim in to_address:
+            # Split by whitespace after normalizing delimiters to spaces
+            to_list = [addr.strip() for addr in
+                       to_address.replace(';', ' ').replace(',', ' ').split()]
+            # Remove empty items
+            to_list = [addr for addr in to_list if addr]
+            break
+
+    return to_list
+
 
 @dataclass
 class Message:
     from_address: str
     to_address: str
-    data: str
+    data: Union[str, SpooledData]
     id: int = None
     created_at: datetime = field(default_factory=datetime.now)
     collected_at: Optional[datetime] = None
     delivered_at: Optional[datetime] = None
+    # Identifies the message in the exchange journal; not part of the message itself
+    journal_key: Optional[str] = field(default=None, repr=False, compare=False)
+    # Primary key of the message's row in the local database, once it has been persisted
+    record_id: Optional[int] = field(default=None, repr=False, compare=False)
+    # Content hash that names the message's inbox file and its idempotency keys; see src/idempotency.py
+    delivery_key: Optional[str] = field(default=None, repr=False, compare=False)
+    # Delivery lane from the outbox message's 'priority' ('high', 'normal' or 'low'); None is 'normal'
+    priority: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Message':
+        """Rebuild a message from the output of to_dict()."""
+        def parse(value):
+            return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+        return cls(
+            id=data.get('id'),
+            created_at=parse(data.get('created_at')),
+            collected_at=parse(data.get('collected_at')),
+            delivered_at=parse(data.get('delivered_at')),
+            from_address=data.get('from_address', ''),
+            to_address=data.get('to_address', ''),
+            data=data.get('data', ''),
+            priority=data.get('priority'),
+        )
 
     @property
     def address_list(self) -> List[str]:
         """Process to_address and return address_list"""
-        to_list = [self.to_address]  # Default to single address
-
-        # Check for common delimiters and split if found
-        for delim in [';', ',', ' ']:
-            if delim in self.to_address:
-                # Split by whitespace after normalizing delimiters to spaces
-                to_list = [addr.strip() for addr in
-                           self.to_address.replace(';', ' ').replace(',', ' ').split()]
-                # Remove empty items
-                to_list = [addr for addr in to_list if addr]
-                break
-
-        return to_list
+        return split_addresses(self.to_address)
 
     def is_old(self, days: int = 3) -> bool:
         return self.collected_at and (datetime.now() - self.collected_at).days > days
@@ -45,8 +77,16 @@ class Message:
             # Intentionally not comparing datetime fields as they might have microsecond differences
         )
 
-    def to_dict(self):
-        """Convert the message to a dictionary with serialized datetime values."""
+    @property
+    def is_spooled(self) -> bool:
+        return isinstance(self.data, SpooledData)
+
+    def to_dict(self, include_data: bool = True):
+        """
+        Convert the message to a dictionary with serialized datetime values.
+
+        A spooled body is read back from disk; pass include_data=False to leave it out.
+        """
         result = {
             'id': self.id,
             'created_at': self.created_at.isoformat() if self.created_at else None,
@@ -54,8 +94,11 @@ class Message:
             'delivered_at': self.delivered_at.isoformat() if self.delivered_at else None,
             'from_address': self.from_address,
             'to_address': self.to_address,
-            'data': self.data,
         }
+        if self.priority is not None:
+            result['priority'] = self.priority
+        if include_data:
+            result['data'] = self.data.read() if self.is_spooled else self.data
         return result
 
     def to_json(self):
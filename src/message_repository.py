@@ -0,0 +1,67 @@
+from typing import List, Optional
+
+from sqlalchemy import Column, DateTime, Integer, String, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from src.message import Message
+
+Base = declarative_base()
+
+
+class MessageModel(Base):
+    __tablename__ = 'messages'
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime)
+    collected_at = Column(DateTime)
+    delivered_at = Column(DateTime)
+    from_address = Column(String)
+    to_address = Column(String)
+    data = Column(String)
+
+    @classmethod
+    def from_message(cls, message: Message, keep_id: bool = True) -> 'MessageModel':
+        return cls(
+            id=message.id if keep_id else None,
+            created_at=message.created_at,
+            collected_at=message.collected_at,
+            delivered_at=message.delivered_at,
+            from_address=message.from_address,
+            to_address=message.to_address,
+            data=message.data.read() if message.is_spooled else message.data,
+        )
+
+    def to_message(self) -> Message:
+        return Message(
+            id=self.id,
+            created_at=self.created_at,
+            collected_at=self.collected_at,
+            delivered_at=self.delivered_at,
+            from_address=self.from_address,
+            to_address=self.to_address,
+            data=self.data,
+            record_id=self.id,
+        )
+
+
+class MessageRepository:
+    def __init__(self, db_url: str):
+        self.engine = create_engine(db_url, pool_pre_ping=True)
+        self.Session = sessionmaker(bind=self.engine)
+
+    def save(self, message: Message) -> Message:
+        """Insert or update a message and return it with its database id."""
+        with self.Session() as session:
+            model = session.merge(MessageModel.from_message(message))
+            session.commit()
+            message.id = model.id
+        return message
+
+    def find_by_id(self, message_id: int) -> Optional[Message]:
+        with self.Session() as session:
+            model = session.get(MessageModel, message_id)
+            return model.to_message() if model else None
+
+    def find_all(self) -> List[Message]:
+        with self.Session() as session:
+            return [model.to_message() for model in session.query(MessageModel).order_by(MessageModel.id)]
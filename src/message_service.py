@@ -1,18 +1,65 @@
-from datetime import datetime, timedelta
+import json
+import threading
+import time
 from city_api import CityAPI
 from external_api import ExternalAPI
-from typing import Dict
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
+from src.async_message_repository import BackgroundPersistence
+from src.coalescing import CoalescingBuffer
+from src.coordination import LeaseCoordinator
+from src.cycle_stats import CycleStats
+from src.dead_letters import DELIVERY_FAILED, UNRESOLVED, DeadLetter, DeadLetterStore
+from src.fanout import BroadcastFanout
+from src.idempotency import message_key
+from src.journal import Journal
 from src.message import Message
+from src.pipeline import Pipeline
+from src.polling import AdaptivePoller
+from src.routing import RoutingTable, directory_version
+from src.scheduling import PRIORITY_WEIGHTS, WeightedFairQueue, priority_lane
+
+DEFAULT_STAGE_WORKERS = {'collect': 4, 'parse': 1, 'resolve': 1, 'encode': 1, 'deliver': 2}
 
 
 class MessageService:
-    def __init__(self, city_api: CityAPI, external_api: ExternalAPI):
+    def __init__(self, city_api: CityAPI, external_api: ExternalAPI,
+                 coordinator: Optional[LeaseCoordinator] = None, fanout_workers: int = 8,
+                 stage_workers: Optional[Dict[str, int]] = None, queue_size: int = 100,
+                 journal: Optional[Journal] = None, persistence: Optional[BackgroundPersistence] = None,
+                 poller: Optional[AdaptivePoller] = None, priority_weights: Optional[Dict[str, float]] = None,
+                 coalescer: Optional[CoalescingBuffer] = None, cycle_stats: Optional[CycleStats] = None,
+                 dead_letters: Optional[DeadLetterStore] = None, state=None, dedup_seconds: float = 86400,
+                 claim_seconds: float = 600):
         self.city_api = city_api
         self.external_api = external_api
-        self.recipient_list = []
-        self.sender_list = []
-
+        self.coordinator = coordinator
+        self.fanout = BroadcastFanout(external_api, max_workers=fanout_workers)
+        self.cycle_stats = cycle_stats or CycleStats()
+        self.routing_table: Optional[RoutingTable] = None
+        self.directory_loaded_at: Optional[float] = None
+        self.stage_workers = dict(DEFAULT_STAGE_WORKERS, **(stage_workers or {}))
+        self.queue_size = queue_size
+        self.pipeline: Optional[Pipeline] = None
+        self.journal = journal
+        self.persistence = persistence
+        self.poller = poller
+        self.priority_weights = dict(PRIORITY_WEIGHTS, **(priority_weights or {}))
+        self.delivery_queue: Optional[WeightedFairQueue] = None
+        self.coalescer = coalescer
+        self.dead_letters = dead_letters
+        if coalescer is not None and dead_letters is not None and coalescer.on_drop is None:
+            # Buffered files that used up their attempts are kept like any other failed post
+            coalescer.on_drop = self._dead_letter_dropped
+        # Delivery keys of collected messages are claimed here, so that workers sharing the
+        # state backend deliver a message that is collected twice only once. A claim lasts
+        # `claim_seconds` while the message is in flight, so a crashed worker's messages are
+        # collected again, and `dedup_seconds` once the message was delivered.
+        self.state = state
+        self.dedup_seconds = dedup_seconds
+        self.claim_seconds = claim_seconds
+        # Agents whose lease another instance took over during the cycle; they are not collected
+        self.lost_leases: Set[str] = set()
 
     def get_agent_addresses(self, cities_data: Dict) -> Dict[str, str]:
         """
@@ -34,44 +81,411 @@ class MessageService:
 
         return addresses
 
-    def process_messages(self) -> None:
+    def get_routing_table(self, addresses: Dict[str, str], groups: Optional[Dict] = None) -> RoutingTable:
+        """
+        Returns the routing table for the given directory, rebuilding it only when the
+        directory has changed since the previous cycle.
+        """
+        if self.routing_table is None or self.routing_table.version != directory_version(addresses, groups):
+            self.routing_table = RoutingTable(addresses, groups)
+        return self.routing_table
+
+    def load_directory(self) -> Tuple[Dict[str, str], RoutingTable]:
+        """Fetches the cities directory and returns its agent addresses and routing table."""
         cities_data = self.city_api.get_cities()
         addresses_dict = self.get_agent_addresses(cities_data)
+        routing_table = self.get_routing_table(addresses_dict, cities_data.get('groups'))
+        self.directory_loaded_at = time.monotonic()
+        return addresses_dict, routing_table
+
+    def process_messages(self) -> None:
+        addresses_dict, routing_table = self.load_directory()
+
+        if self.journal:
+            self.recover_journal(routing_table)
+
+        # Only poll the outboxes that are due and that this instance holds a lease on;
+        # recipients are still resolved against the full directory.
+        outboxes = addresses_dict
+        if self.poller:
+            self.poller.prune(addresses_dict.keys())
+            outboxes = {agent_name: addresses_dict[agent_name] for agent_name in self.poller.due(addresses_dict.keys())}
+        if self.coordinator:
+            claimed = self.coordinator.claim(outboxes.keys())
+            outboxes = {agent_name: addresses_dict[agent_name] for agent_name in claimed}
+
+        self.lost_leases = set()
+        stop_renewing = self._renew_leases(outboxes.keys()) if self.coordinator else None
+        if self.persistence:
+            self.persistence.begin_cycle()
+        try:
+            self._process_outboxes(outboxes, routing_table)
+        finally:
+            if self.persistence:
+                self.persistence.end_cycle()
+            if self.coordinator:
+                stop_renewing.set()
+                self.coordinator.release(outboxes.keys())
+            if self.journal:
+                self.journal.compact()
+            if self.poller:
+                self.poller.save()
+
+    def _renew_leases(self, agent_names) -> threading.Event:
+        """
+        Renews the cycle's leases every third of their TTL until the returned event is set,
+        so that a cycle longer than the TTL does not let another instance take its agents.
+        """
+        names = list(agent_names)
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.coordinator.ttl_seconds / 3):
+                try:
+                    kept = self.coordinator.renew(names)
+                except Exception as e:
+                    print(f"Error renewing agent leases: {e}")
+                    continue
+                lost = set(names) - set(kept) - self.lost_leases
+                if lost:
+                    print(f"Lost the leases on {sorted(lost)}")
+                    self.lost_leases |= lost
+
+        if names:
+            threading.Thread(target=renew, name='lease-renewal', daemon=True).start()
+        return stop
 
-        for agent_name, url in addresses_dict.items():
+    def recover_journal(self, routing_table: RoutingTable) -> int:
+        """
+        Finishes the deliveries of messages that an interrupted cycle collected but did not
+        complete, skipping the recipients the journal shows as already delivered.
+
+        Returns:
+            The number of messages recovered
+        """
+        pending = self.journal.recover()
+        for msg, delivered in pending:
+            print(f"Recovering message {msg.journal_key} from {msg.from_address}, already delivered to {sorted(delivered)}")
+            routes, _ = routing_table.resolve(msg.address_list, sender=msg.from_address)
+            routes = [route for route in routes if route.agent_name not in delivered]
+            if routes:
+                for encoded in self._encode_stage((msg, routes)):
+                    self._deliver_stage(encoded)
+            else:
+                self.journal.record_done(msg.journal_key)
+        self.journal.compact()
+        return len(pending)
+
+    def deliver_messages(self, messages: List[Message], max_directory_age: float = 60) -> None:
+        """
+        Delivers messages that were pushed to the service instead of collected from an outbox.
+
+        They go through the same journal, persistence, resolve and deliver steps as polled
+        messages. The directory is fetched again only when it is older than
+        `max_directory_age` seconds.
+
+        Args:
+            messages: The pushed messages
+            max_directory_age: Seconds a previously loaded directory stays valid
+        """
+        if self.routing_table is None or time.monotonic() - self.directory_loaded_at > max_directory_age:
+            self.load_directory()
+        routing_table = self.routing_table
+
+        if self.persistence:
+            self.persistence.begin_cycle()
+        try:
+            for msg in self._unseen(messages):
+                try:
+                    self._accept(msg)
+                    for parsed in self._parse_stage(msg):
+                        for resolved in self._resolve_stage(parsed, routing_table):
+                            for encoded in self._encode_stage(resolved):
+                                self._deliver_stage(encoded)
+                except Exception as e:
+                    print(f"Error delivering pushed message {msg.id} from {msg.from_address}: {e}")
+                    self._release(msg)
+        finally:
+            if self.persistence:
+                self.persistence.end_cycle()
+
+    def reprocess_dead_letters(self, batch_size: int = 100, max_attempts: Optional[int] = None) -> Dict[str, int]:
+        """
+        Retries the dead letters against the current directory, `batch_size` at a time.
+
+        Each message is encoded once and sent to all of its dead-lettered recipients that now
+        resolve, under the same inbox path and idempotency keys as the first attempt. Letters
+        that are delivered are removed; the others have their attempt count increased.
+
+        Args:
+            batch_size: Dead letters loaded and retried together
+            max_attempts: Skip letters that have already failed this many times
+
+        Returns:
+            Counts of 'delivered', 'failed' and 'unresolved' recipients
+        """
+        _, routing_table = self.load_directory()
+        counts = {'delivered': 0, 'failed': 0, 'unresolved': 0}
+        after_id = 0
+        while True:
+            letters = self.dead_letters.batch(after_id, batch_size, max_attempts)
+            if not letters:
+                return counts
+            after_id = letters[-1].id
+
+            by_message: Dict[str, List[DeadLetter]] = {}
+            for letter in letters:
+                by_message.setdefault(letter.message.delivery_key, []).append(letter)
+            done = []
+            for group in by_message.values():
+                done.extend(self._redeliver(group, routing_table, counts))
+            self.dead_letters.remove(done)
+            print(f"Reprocessed {len(letters)} dead letters: {counts}")
+
+    def _redeliver(self, letters: List[DeadLetter], routing_table: RoutingTable, counts: Dict[str, int]) -> List[int]:
+        """Sends one message to its dead-lettered recipients and returns the ids of the letters that are done."""
+        msg = letters[0].message
+        routes, unresolved = routing_table.resolve([letter.recipient for letter in letters], sender=msg.from_address)
+        counts['unresolved'] += len(unresolved)
+        self._dead_letter(msg, unresolved, UNRESOLVED, "recipient could not be resolved")
+
+        failed = set()
+        for result in self.fanout.send(routes, self.fanout.encode(msg), message_key(msg)) if routes else []:
+            if self._failed(result):
+                failed.add(result.agent_name)
+                self._dead_letter(msg, [result.agent_name], DELIVERY_FAILED, self._failure(result))
+            else:
+                counts['delivered'] += 1
+                msg.delivered_at = msg.delivered_at or result.delivered_at
+        counts['failed'] += len(failed)
+        # A letter whose recipient resolved is done unless its own row was just updated;
+        # failures of group members are recorded under the member
+        return [letter.id for letter in letters if letter.recipient not in unresolved and letter.recipient not in failed]
+
+    @staticmethod
+    def _delivered(result, coalesced: bool) -> bool:
+        # A file handed to the coalescing buffer has no status yet; the buffer owns it from here
+        if coalesced and result.status_code is None:
+            return result.error is None
+        return result.ok
+
+    @staticmethod
+    def _failed(result) -> bool:
+        return result.error is not None or (result.status_code is not None and result.status_code >= 400)
+
+    @staticmethod
+    def _failure(result) -> str:
+        return result.error or f"HTTP {result.status_code}"
+
+    def _dead_letter(self, msg: Message, recipients: List[str], reason: str, error: str) -> None:
+        if not self.dead_letters or not recipients:
+            return
+        try:
+            self.dead_letters.record(msg, recipients, reason, error)
+        except Exception as e:
+            print(f"Error recording dead letter for message {msg.id} from {msg.from_address}: {e}")
+
+    def _dead_letter_dropped(self, agent_name: str, updated_files: List[Dict], error: str) -> None:
+        for updated_file in updated_files:
             try:
-                print(f"\n\n url for collect = {url}")
-                messages_data = self.external_api.collect_from_outbox(url)
-                for msg in messages_data:
-                    print(f"msg = {msg}")
-                    for recipient in set(msg.address_list):
-                        print(f"recipient = {recipient}")
-                        self.recipient_list.append(recipient)
-                        recipient_url = addresses_dict.get(recipient)
-                        print(f"recipient_url = {recipient_url}")
-                        if recipient_url:
-                            recipient_url = recipient_url.replace("WAKEUP", "RECEIVE_POST")
-
-                            # Mark the message as delivered
-                            msg.delivered_at = datetime.now()
-                            filepath = f"./{msg.delivered_at}.json"
-                            blob = {
-                                "updated_files": [{
-                                    "path": filepath,
-                                    "file_content": msg.to_json()
-                                }]
-                            }
-                            response = self.external_api.add_to_inbox(recipient_url, blob)
-
-                            print(f"response = {response}")
-
-                            self.sender_list.append(msg.from_address)
-
-
-            except Exception as e:
-                print(f"Error processing messages from {url}: {str(e)}")
-                print(f"Exception type: {type(e).__name__}")
-                print(f"Message details: {msg if 'msg' in locals() else 'No message available'}")
-                import traceback
-                traceback.print_exc()
+                # The file carries the message as it was sent; it was never delivered
+                msg = Message.from_dict(dict(json.loads(updated_file['file_content']), delivered_at=None))
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Error reading dropped inbox file {updated_file.get('path')} for {agent_name}: {e}")
+                continue
+            self._dead_letter(msg, [agent_name], DELIVERY_FAILED, error)
+
+    def _forget_dead_letters(self, msg: Message, recipients: List[str]) -> None:
+        try:
+            self.dead_letters.remove_delivered(msg, recipients)
+        except Exception as e:
+            print(f"Error removing dead letters of message {msg.id} from {msg.from_address}: {e}")
+
+    def _process_outboxes(self, outboxes: Dict[str, str], routing_table: RoutingTable) -> None:
+        """
+        Runs one cycle as a pipeline: collect -> parse -> resolve -> encode -> deliver.
+
+        The stages are joined by bounded queues, so slow deliveries hold back collection.
+        The deliver stage reads from one lane per message priority, served by weighted fair
+        queuing, so urgent messages overtake a delivery backlog of bulk traffic.
+        Per-stage queue depth and throughput are available from `pipeline_stats()`.
+        """
+        self.pipeline = Pipeline([
+            ('collect', self._collect_stage, self.stage_workers['collect']),
+            ('parse', self._parse_stage, self.stage_workers['parse'], None, self._release_failed),
+            ('resolve', lambda item: self._resolve_stage(item, routing_table), self.stage_workers['resolve'],
+             None, self._release_failed),
+            ('encode', self._encode_stage, self.stage_workers['encode'], None, self._release_failed),
+            ('deliver', self._deliver_stage, self.stage_workers['deliver'], self._make_delivery_queue,
+             self._release_failed),
+        ], queue_size=self.queue_size)
+        self.pipeline.run(outboxes.items())
+
+    def pipeline_stats(self) -> Dict[str, Dict]:
+        stats = self.pipeline.stats() if self.pipeline else {}
+        if 'deliver' in stats and self.delivery_queue is not None:
+            stats['deliver']['served_by_priority'] = dict(self.delivery_queue.served)
+        return stats
+
+    def _make_delivery_queue(self, queue_size: int) -> WeightedFairQueue:
+        self.delivery_queue = WeightedFairQueue(self._delivery_lane, self.priority_weights, maxsize=queue_size)
+        return self.delivery_queue
+
+    @staticmethod
+    def _delivery_lane(item) -> Optional[str]:
+        # Only (msg, routes, payload) items have a lane; pipeline markers are served last
+        if isinstance(item, tuple) and isinstance(item[0], Message):
+            return priority_lane(item[0].priority)
+        return None
+
+    def _collect_stage(self, outbox: Tuple[str, str]) -> Iterator[Message]:
+        agent_name, url = outbox
+        if agent_name in self.lost_leases:
+            # Another instance holds the agent now and collects its outbox
+            print(f"Skipping {agent_name}, its lease was lost")
+            return
+        print(f"\n\n url for collect = {url}")
+        polled_at = time.time()
+        # A failed collection says nothing about the agent's activity, so it is not recorded
+        # as an empty poll; the agent stays due and is retried next cycle
+        messages = self.external_api.collect_from_outbox(url)
+        collected = 0
+        try:
+            for msg in self._unseen(messages):
+                self._accept(msg)
+                collected += 1
+                yield msg
+        finally:
+            if self.poller:
+                self.poller.record(agent_name, collected, polled_at=polled_at)
+
+    def _unseen(self, messages: List[Message]) -> List[Message]:
+        """
+        Drops the messages whose delivery key is claimed, by this or another worker, and claims
+        the others for `claim_seconds`. The keys of a whole batch are claimed in one state round
+        trip.
+        """
+        if self.state is None:
+            return messages
+        messages = list(messages)
+        if not messages:
+            return messages
+        try:
+            claimed = self.state.claim([f"seen:{message_key(msg)}" for msg in messages], self.claim_seconds)
+        except Exception as e:
+            # Delivering twice is better than not at all; the idempotency keys cover the rest
+            print(f"Error claiming collected messages: {e}")
+            return messages
+        for msg, new in zip(messages, claimed):
+            if not new:
+                print(f"Skipping message {msg.id} from {msg.from_address}, already collected")
+        return [msg for msg, new in zip(messages, claimed) if new]
+
+    def _remember(self, msg: Message) -> None:
+        # Delivered: the claim is kept for the whole deduplication window
+        if self.state is None:
+            return
+        try:
+            self.state.set_many({f"seen:{message_key(msg)}": '1'}, ttl=self.dedup_seconds)
+        except Exception as e:
+            print(f"Error remembering message {msg.id} from {msg.from_address}: {e}")
+
+    def _release_failed(self, item, error: Exception) -> None:
+        # Pipeline items are the message itself or tuples that start with it
+        self._release(item if isinstance(item, Message) else item[0])
+
+    def _release(self, msg: Message) -> None:
+        # A message that did not reach every recipient may be collected or pushed again; the
+        # per-recipient idempotency keys keep the recipients it did reach from getting it twice
+        if self.state is None:
+            return
+        try:
+            self.state.delete([f"seen:{message_key(msg)}"])
+        except Exception as e:
+            print(f"Error releasing message {msg.id} from {msg.from_address}: {e}")
+
+    def _accept(self, msg: Message) -> None:
+        # Keyed before it is journaled, so that a recovered delivery reuses the key
+        message_key(msg)
+        if self.journal and msg.journal_key is None:
+            # Pushed messages are journaled when they are accepted
+            self.journal.record_collected(msg)
+
+    def _parse_stage(self, msg: Message) -> Iterator[Tuple[Message, list]]:
+        print(f"msg = {msg.id} from {msg.from_address} to {msg.to_address}")
+        addresses = msg.address_list
+        self.cycle_stats.record_message(addresses)
+        yield msg, addresses
+
+    def _resolve_stage(self, item: Tuple[Message, list], routing_table: RoutingTable) -> Iterator[Tuple[Message, list]]:
+        msg, addresses = item
+        routes, unresolved = routing_table.resolve(addresses, sender=msg.from_address)
+        for recipient in unresolved:
+            print(f"recipient = {recipient} could not be resolved")
+        self._dead_letter(msg, unresolved, UNRESOLVED, "recipient could not be resolved")
+        if self.persistence:
+            # Saved under the agents it is routed to, which is where recipients look it up
+            self.persistence.saved(msg, [route.agent_name for route in routes])
+        if routes:
+            yield msg, routes
+        else:
+            # Nothing to deliver; the unresolved recipients were dead-lettered above
+            self._remember(msg)
+            if self.journal:
+                self.journal.record_done(msg.journal_key)
+
+    def _encode_stage(self, item: Tuple[Message, list]) -> Iterator[Tuple[Message, list, object]]:
+        msg, routes = item
+        if self._coalesces(msg):
+            yield msg, routes, self.fanout.updated_file(msg)
+        else:
+            yield msg, routes, self.fanout.encode(msg)
+
+    def _coalesces(self, msg: Message) -> bool:
+        # Spooled bodies are streamed on their own rather than held in a batch
+        return self.coalescer is not None and not msg.is_spooled
 
+    def _deliver_stage(self, item: Tuple[Message, list, object]) -> None:
+        msg, routes, payload = item
+        if self._coalesces(msg):
+            # Handing the file to the buffer counts as delivered; the buffer owns it from here
+            results = self.coalescer.add(routes, payload)
+        else:
+            results = self.fanout.send(routes, payload, message_key(msg))
+        delivered = []
+        undelivered = False
+        first_delivered_at = None
+        for result in results:
+            if self.dead_letters and not self._coalesces(msg) and self._failed(result):
+                # The buffer retries failed batches itself and dead-letters the files it gives up on
+                self._dead_letter(msg, [result.agent_name], DELIVERY_FAILED, self._failure(result))
+            print(f"recipient = {result.agent_name}, recipient_url = {result.inbox_url}, "
+                  f"status = {result.error or result.status_code or 'buffered'}, delivered_at = {result.delivered_at}")
+            ok = self._delivered(result, self._coalesces(msg))
+            self.cycle_stats.record_delivery(msg.from_address, ok)
+            if ok:
+                delivered.append(result.agent_name)
+                # Stamped with the first successful post; persistence stamps buffered files itself
+                if result.delivered_at and (first_delivered_at is None or result.delivered_at < first_delivered_at):
+                    first_delivered_at = result.delivered_at
+                if self.poller:
+                    # A recipient that got mail is likely to answer soon
+                    self.poller.wake(result.agent_name)
+                if self.journal:
+                    self.journal.record_delivered(msg.journal_key, result.agent_name)
+            else:
+                undelivered = True
+        if first_delivered_at is not None:
+            msg.delivered_at = first_delivered_at
+        if delivered and self.persistence:
+            self.persistence.delivered(msg, delivered)
+        if delivered and self.dead_letters:
+            # Delivered by journal recovery, a re-collection or the buffer after failing before
+            self._forget_dead_letters(msg, delivered)
+        if self.journal and not undelivered:
+            # A message with a failed recipient stays pending, so the next cycle's recovery retries it
+            self.journal.record_done(msg.journal_key)
+        if undelivered:
+            self._release(msg)
+        else:
+            self._remember(msg)
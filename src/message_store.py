@@ -0,0 +1,115 @@
+import json
+import threading
+import uuid
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, Text, create_engine, event, func, insert, select
+from sqlalchemy.engine import Engine
+
+from src.message_repository import Base
+
+
+class ApiMessage(Base):
+    """A message posted to the /messages API, stored as the JSON it was posted with."""
+    __tablename__ = 'api_messages'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    body = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class MemoryMessageStore:
+    """
+    Messages posted to the API, kept in this process; safe to use from concurrent requests.
+
+    The version changes with every append. It starts from a random epoch so that versions
+    handed out before a restart are never reused for different contents.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._messages: List[Any] = []
+        self._epoch = uuid.uuid4().hex[:8]
+
+    def append(self, message: Any) -> None:
+        with self._lock:
+            self._messages.append(message)
+
+    def all(self) -> List[Any]:
+        with self._lock:
+            return list(self._messages)
+
+    def version(self) -> str:
+        with self._lock:
+            return f"{self._epoch}-{len(self._messages)}"
+
+    def snapshot(self) -> Tuple[str, List[Any]]:
+        """The current version and the messages it stands for, read together."""
+        with self._lock:
+            return f"{self._epoch}-{len(self._messages)}", list(self._messages)
+
+
+class SqlMessageStore:
+    """
+    Messages posted to the API, kept in a database so that every server worker, in any
+    process, sees the same list. Each append is a single-row insert, so concurrent writers
+    never lose each other's messages.
+
+    The table is managed by Alembic; on SQLite, where the store is a local file shared by
+    the workers of one host, it is created if missing and the database runs in WAL mode so
+    readers do not block the writer.
+    """
+
+    def __init__(self, db_url: Optional[str] = None, engine: Optional[Engine] = None):
+        self.engine = engine or create_engine(db_url, pool_pre_ping=True)
+        if self.engine.dialect.name == 'sqlite':
+            event.listen(self.engine, 'connect', self._configure_sqlite)
+            ApiMessage.__table__.create(self.engine, checkfirst=True)
+        self._table = ApiMessage.__table__
+
+    @staticmethod
+    def _configure_sqlite(connection, _record) -> None:
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        # Wait for a concurrent writer instead of failing with "database is locked"
+        cursor.execute('PRAGMA busy_timeout=5000')
+        cursor.close()
+
+    def append(self, message: Any) -> None:
+        with self.engine.begin() as conn:
+            conn.execute(insert(self._table).values(body=json.dumps(message), created_at=datetime.utcnow()))
+
+    def all(self) -> List[Any]:
+        return self.snapshot()[1]
+
+    def version(self) -> str:
+        """
+        The highest message id and the number of messages, read from the primary key index.
+        Writers share no row, so appends from different workers do not wait for each other.
+        """
+        with self.engine.connect() as conn:
+            return self._read_version(conn)
+
+    def snapshot(self) -> Tuple[str, List[Any]]:
+        """
+        The current version and the messages. The messages are read after the version, so
+        they may include appends the version does not count yet, never the other way round.
+        """
+        with self.engine.connect() as conn:
+            version = self._read_version(conn)
+            rows = conn.execute(select(self._table.c.body).order_by(self._table.c.id)).scalars().all()
+        return version, [json.loads(body) for body in rows]
+
+    def _read_version(self, conn) -> str:
+        # The count as well: concurrent transactions can commit their ids out of order, so a
+        # lower id that commits later leaves the highest id unchanged
+        last, count = conn.execute(select(func.max(self._table.c.id), func.count(self._table.c.id))).one()
+        return f"{last or 0}-{count}"
+
+
+def create_message_store(db_url: Optional[str] = None):
+    """Returns a SqlMessageStore for a SQLAlchemy URL, or a MemoryMessageStore without one."""
+    if not db_url or db_url == 'memory':
+        return MemoryMessageStore()
+    return SqlMessageStore(db_url)
@@ -0,0 +1,49 @@
+import threading
+from typing import Dict
+
+
+class Metrics:
+    """
+    Minimal thread-safe metrics registry.
+
+    Counters accumulate a running total; observations keep count, sum, min and max so the
+    mean and spread of a value (bytes on the wire, seconds of CPU) can be reported per run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._observations: Dict[str, Dict[str, float]] = {}
+
+    def increment(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            stats = self._observations.get(name)
+            if stats is None:
+                self._observations[name] = {'count': 1, 'sum': value, 'min': value, 'max': value}
+            else:
+                stats['count'] += 1
+                stats['sum'] += value
+                stats['min'] = min(stats['min'], value)
+                stats['max'] = max(stats['max'], value)
+
+    def snapshot(self) -> Dict:
+        """Returns a copy of all counters and observations, with the mean added to each observation."""
+        with self._lock:
+            observations = {
+                name: dict(stats, mean=stats['sum'] / stats['count'])
+                for name, stats in self._observations.items()
+            }
+            return {'counters': dict(self._counters), 'observations': observations}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._observations.clear()
+
+
+# Process-wide registry used when a component is not given its own
+metrics = Metrics()
@@ -0,0 +1,237 @@
+import hashlib
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from sqlalchemy import Column, DateTime, Index, String, bindparam, func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from src.async_message_repository import async_database_url
+from src.idempotency import message_key
+from src.message import Message
+from src.message_repository import Base
+from src.routing import normalize_address
+
+
+class RecipientMessageModel(Base):
+    """
+    One message as stored for one of its recipients. On PostgreSQL the table is partitioned
+    by hash of `recipient` (see the recipient_messages migration); the primary key includes
+    the partition key, as PostgreSQL requires.
+    """
+    __tablename__ = 'recipient_messages'
+    __table_args__ = (Index('ix_recipient_messages_recipient_created_at', 'recipient', 'created_at'),)
+
+    recipient = Column(String, primary_key=True)
+    delivery_key = Column(String, primary_key=True)
+    created_at = Column(DateTime)
+    collected_at = Column(DateTime)
+    delivered_at = Column(DateTime)
+    from_address = Column(String)
+    to_address = Column(String)
+    data = Column(String)
+
+
+def partition_of(recipient: str, partitions: int) -> int:
+    """The SQLite shard a recipient's messages are kept in; stable across processes and runs."""
+    digest = hashlib.blake2b(normalize_address(recipient).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % partitions
+
+
+def partition_name(index: int) -> str:
+    return f"recipient_messages_p{index}"
+
+
+def shard_url(db_url: str, index: int) -> str:
+    """`sqlite:///dir/agent_post.db` becomes `sqlite:///dir/agent_post.p3.db` for shard 3."""
+    url = make_url(db_url)
+    if not url.database or url.database == ':memory:':
+        raise Exception("Sharded message storage needs a SQLite file, not an in-memory database")
+    base, ext = os.path.splitext(url.database)
+    return url.set(database=f"{base}.p{index}{ext or '.db'}").render_as_string(hide_password=False)
+
+
+class PartitionedMessageRepository:
+    """
+    Message history split by recipient, so that a recipient's lookups and the maintenance of
+    one partition cost the same however large the whole history grows.
+
+    A collected message is stored once per agent it is routed to, so a broadcast or group
+    message is found under each member; rows are keyed by (recipient, delivery key), so
+    saving a message again is a no-op. On PostgreSQL, rows go to the hash-partitioned
+    `recipient_messages` table and the server routes them; every query names the recipient,
+    so the planner only touches that recipient's partition. On SQLite, each of the
+    `partitions` shards is its own database file next to DATABASE_URL, and the repository
+    routes by `partition_of()`.
+
+    Drop-in for AsyncMessageRepository under BackgroundPersistence.
+    """
+
+    def __init__(self, db_url: str, partitions: int = 16, pool_size: int = 10, max_overflow: int = 20,
+                 statement_cache_size: int = 500):
+        self.partitions = partitions
+        backend = make_url(db_url).get_backend_name()
+        if backend == 'postgresql':
+            self._insert = postgresql.insert
+            self.engines: List[AsyncEngine] = [create_async_engine(
+                async_database_url(db_url, statement_cache_size), pool_pre_ping=True, pool_size=pool_size,
+                max_overflow=max_overflow, query_cache_size=statement_cache_size)]
+        elif backend == 'sqlite':
+            self._insert = sqlite.insert
+            self.engines = [create_async_engine(async_database_url(shard_url(db_url, index)))
+                            for index in range(partitions)]
+        else:
+            raise Exception(f"Partitioned message storage is not supported on {backend}")
+        self.native = backend == 'postgresql'
+        self._created = set()
+        self._table = RecipientMessageModel.__table__
+
+    def _shard(self, recipient: str) -> int:
+        return 0 if self.native else partition_of(recipient, self.partitions)
+
+    async def _engine(self, shard: int) -> AsyncEngine:
+        engine = self.engines[shard]
+        if not self.native and shard not in self._created:
+            # The migration manages the PostgreSQL table; shard files are created on first use
+            async with engine.begin() as conn:
+                await conn.run_sync(self._table.create, checkfirst=True)
+            self._created.add(shard)
+        return engine
+
+    @asynccontextmanager
+    async def cycle(self) -> AsyncIterator[None]:
+        """Kept for BackgroundPersistence; connections are pooled per shard."""
+        yield None
+
+    async def save_many(self, messages: List[Message], recipients: Optional[List[Optional[List[str]]]] = None) -> None:
+        """
+        Stores each message for every agent it is routed to, one insert per shard.
+
+        Args:
+            messages: The collected messages
+            recipients: For each message, the agent names of its delivery routes; without
+                them, the message's own addresses are used
+
+        A spooled body is bound as one parameter and inserted one message at a time, so at
+        most one of them is held in memory.
+        """
+        by_shard: Dict[int, List[Dict]] = {}
+        spooled: List[Tuple[Message, Dict[int, List[Dict]]]] = []
+        for message, names in zip(messages, recipients or [None] * len(messages)):
+            rows = {} if message.is_spooled else by_shard
+            for recipient in self._recipients(message, names):
+                rows.setdefault(self._shard(recipient), []).append({
+                    'recipient': recipient,
+                    'delivery_key': message_key(message),
+                    'created_at': message.created_at,
+                    'collected_at': message.collected_at,
+                    'delivered_at': message.delivered_at,
+                    'from_address': message.from_address,
+                    'to_address': message.to_address,
+                    'data': message.data,
+                })
+            if message.is_spooled and rows:
+                spooled.append((message, rows))
+        await self._insert_new(by_shard)
+        for message, rows in spooled:
+            body = message.data.read()
+            await self._insert_new({shard: [dict(row, data=body) for row in shard_rows]
+                                    for shard, shard_rows in rows.items()})
+
+    async def _insert_new(self, by_shard: Dict[int, List[Dict]]) -> None:
+        for shard, rows in by_shard.items():
+            # Saving a message again is a no-op
+            stmt = self._insert(self._table).values(rows).on_conflict_do_nothing(
+                index_elements=[self._table.c.recipient, self._table.c.delivery_key])
+            async with (await self._engine(shard)).begin() as conn:
+                await conn.execute(stmt)
+
+    @staticmethod
+    def _recipients(message: Message, names: Optional[List[str]]) -> List[str]:
+        return list(dict.fromkeys(normalize_address(name) for name in
+                                  (names if names is not None else message.address_list)))
+
+    async def mark_delivered(self, messages: List[Message],
+                             recipients: Optional[List[Optional[List[str]]]] = None) -> None:
+        """
+        Stores delivered_at on the recipient rows of the messages, one executemany per shard.
+
+        Args:
+            messages: The delivered messages
+            recipients: For each message, the agents that received it; without them, every
+                address of the message is marked
+        """
+        by_shard: Dict[int, List[Dict]] = {}
+        for message, names in zip(messages, recipients or [None] * len(messages)):
+            delivered_at = message.delivered_at or datetime.now()
+            for recipient in self._recipients(message, names):
+                by_shard.setdefault(self._shard(recipient), []).append(
+                    {'r': recipient, 'k': message_key(message), 'd': delivered_at})
+        stmt = update(self._table).where(
+            self._table.c.recipient == bindparam('r'), self._table.c.delivery_key == bindparam('k')
+        ).values(delivered_at=bindparam('d'))
+        for shard, rows in by_shard.items():
+            async with (await self._engine(shard)).begin() as conn:
+                await conn.execute(stmt, rows)
+
+    async def find_for_recipient(self, recipient: str, since: Optional[datetime] = None,
+                                 limit: int = 100) -> List[Message]:
+        """
+        A recipient's messages in creation order, read from its partition only.
+
+        Args:
+            recipient: Agent name, matched like routing does (case-insensitively)
+            since: Only messages created at or after this time
+            limit: Maximum number of messages
+        """
+        recipient = normalize_address(recipient)
+        query = select(self._table).where(self._table.c.recipient == recipient)
+        if since is not None:
+            query = query.where(self._table.c.created_at >= since)
+        query = query.order_by(self._table.c.created_at).limit(limit)
+        async with (await self._engine(self._shard(recipient))).connect() as conn:
+            rows = (await conn.execute(query)).mappings().all()
+        return [self._to_message(row) for row in rows]
+
+    @staticmethod
+    def _to_message(row) -> Message:
+        message = Message(from_address=row['from_address'], to_address=row['to_address'], data=row['data'],
+                          created_at=row['created_at'], collected_at=row['collected_at'],
+                          delivered_at=row['delivered_at'])
+        message.delivery_key = row['delivery_key']
+        return message
+
+    async def count_by_partition(self) -> Dict[str, int]:
+        """Rows per partition (PostgreSQL) or shard (SQLite)."""
+        if self.native:
+            async with self.engines[0].connect() as conn:
+                rows = (await conn.exec_driver_sql(
+                    "SELECT tableoid::regclass::text, count(*) FROM recipient_messages GROUP BY 1")).all()
+            return {name: count for name, count in rows}
+        counts = {}
+        for shard in range(self.partitions):
+            async with (await self._engine(shard)).connect() as conn:
+                counts[partition_name(shard)] = (await conn.execute(select(func.count()).select_from(self._table))).scalar()
+        return counts
+
+    async def maintain(self, partition: Optional[int] = None) -> None:
+        """
+        Vacuums and analyzes one partition, or each in turn, so that maintenance never has to
+        lock or scan the whole history at once.
+        """
+        for index in ([partition] if partition is not None else range(self.partitions)):
+            engine = self.engines[0] if self.native else await self._engine(index)
+            async with engine.connect() as conn:
+                conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+                if self.native:
+                    await conn.exec_driver_sql(f"VACUUM (ANALYZE) {partition_name(index)}")
+                else:
+                    await conn.exec_driver_sql("VACUUM")
+                    await conn.exec_driver_sql("ANALYZE")
+
+    async def dispose(self) -> None:
+        for engine in self.engines:
+            await engine.dispose()
@@ -0,0 +1,115 @@
+import json
+import os
+import tempfile
+import weakref
+import zlib
+from typing import Dict, Iterator, Optional
+
+CHUNK_SIZE = 64 * 1024
+
+_PLACEHOLDER = '\x00agent-post-spooled-data\x00'
+
+
+def _escape(text: str) -> str:
+    """JSON-escapes a string without the surrounding quotes; escaping is per character, so chunks can be escaped independently."""
+    return json.dumps(text)[1:-1]
+
+
+class SpooledData:
+    """
+    A message body that was too large to keep in memory and lives in a temporary file instead.
+
+    The file is removed when the object is closed or garbage collected. Comparing or reading
+    the body materializes it; streaming it to an inbox goes through `iter_text` in chunks.
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._finalizer = weakref.finalize(self, _remove_file, path)
+
+    @classmethod
+    def from_text(cls, text: str, directory: Optional[str] = None) -> 'SpooledData':
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', prefix='agent_post_', suffix='.body',
+                                         dir=directory, delete=False) as spool:
+            spool.write(text)
+            path = spool.name
+        return cls(path, os.path.getsize(path))
+
+    def read(self) -> str:
+        with open(self.path, 'r', encoding='utf-8') as spool:
+            return spool.read()
+
+    def iter_text(self, chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+        with open(self.path, 'r', encoding='utf-8') as spool:
+            while True:
+                chunk = spool.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def close(self) -> None:
+        self._finalizer()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __eq__(self, other):
+        if isinstance(other, SpooledData):
+            return self.path == other.path or self.read() == other.read()
+        if isinstance(other, str):
+            return self.read() == other
+        return NotImplemented
+
+    def __repr__(self):
+        return f"SpooledData(path={self.path!r}, size={self.size})"
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class InboxStream:
+    """
+    An inbox blob whose message body is streamed from a spool file.
+
+    Produces exactly the bytes of `json.dumps({"updated_files": [{"path": ..., "file_content": msg.to_json()}]})`
+    without ever holding the body in memory. The stream can be iterated once per recipient.
+    """
+
+    def __init__(self, filepath: str, message_fields: Dict, data: SpooledData, chunk_size: int = CHUNK_SIZE):
+        self.data = data
+        self.chunk_size = chunk_size
+
+        # file_content is the message JSON, itself embedded as a JSON string in the blob,
+        # so the body is escaped twice
+        message_json = json.dumps(dict(message_fields, data=_PLACEHOLDER))
+        inner_prefix, inner_suffix = message_json.split(json.dumps(_PLACEHOLDER))
+        blob_json = json.dumps({"updated_files": [{"path": filepath, "file_content": _PLACEHOLDER}]})
+        outer_prefix, outer_suffix = blob_json.split(json.dumps(_PLACEHOLDER))
+
+        self._head = (outer_prefix + '"' + _escape(inner_prefix + '"')).encode('utf-8')
+        self._tail = (_escape('"' + inner_suffix) + '"' + outer_suffix).encode('utf-8')
+
+    @property
+    def size_hint(self) -> int:
+        """Lower bound of the encoded size, used to decide whether to compress."""
+        return len(self._head) + self.data.size + len(self._tail)
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield self._head
+        for chunk in self.data.iter_text(self.chunk_size):
+            yield _escape(_escape(chunk)).encode('utf-8')
+        yield self._tail
+
+    def gzip(self) -> Iterator[bytes]:
+        """Yields the stream gzip-compressed."""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in self:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
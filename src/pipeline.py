@@ -0,0 +1,154 @@
+import queue
+import threading
+import time
+import traceback
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of a Pipeline.
+
+    `func` takes one item and returns (or yields) the items for the next stage. It runs on
+    `workers` threads that all read from the stage's bounded input queue. `make_queue`
+    builds that queue from the pipeline's queue size when a stage needs something other
+    than a FIFO, e.g. a WeightedFairQueue. `on_error(item, error)` is called for an item
+    whose `func` raised, e.g. to release what was reserved for it.
+    """
+
+    def __init__(self, name: str, func: Callable[[object], Iterable], workers: int = 1,
+                 make_queue: Optional[Callable[[int], object]] = None,
+                 on_error: Optional[Callable[[object, Exception], None]] = None):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.make_queue = make_queue
+        self.on_error = on_error
+        self.input: Optional[queue.Queue] = None
+
+        self._lock = threading.Lock()
+        self._running = 0
+        self.processed = 0
+        self.emitted = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+
+    def record(self, emitted: int, elapsed: float, failed: bool) -> None:
+        with self._lock:
+            self.processed += 1
+            self.emitted += emitted
+            self.busy_seconds += elapsed
+            if failed:
+                self.errors += 1
+
+    def stats(self, wall_seconds: float) -> Dict:
+        depth = self.input.qsize() if self.input is not None else 0
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+            return {
+                'workers': self.workers,
+                'queue_depth': depth,
+                'max_queue_depth': self.max_queue_depth,
+                'processed': self.processed,
+                'emitted': self.emitted,
+                'errors': self.errors,
+                'busy_seconds': round(self.busy_seconds, 6),
+                'items_per_second': round(self.processed / wall_seconds, 3) if wall_seconds > 0 else 0.0,
+            }
+
+
+class Pipeline:
+    """
+    Runs items through a chain of stages connected by bounded queues.
+
+    A stage blocks when the queue in front of the next stage is full, so a slow stage
+    pushes back all the way to the source instead of letting work pile up in memory.
+    Exceptions raised for one item are reported and counted, and the pipeline moves on.
+    Stages are given as (name, func, workers) tuples, optionally followed by a queue factory
+    and an error callback.
+    """
+
+    def __init__(self, stages: List[Tuple], queue_size: int = 100):
+        self.stages = [Stage(*stage) for stage in stages]
+        self.queue_size = queue_size
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+
+    def run(self, source: Iterable) -> None:
+        """Feeds every item of `source` into the first stage and returns once all stages have drained."""
+        for stage in self.stages:
+            stage.input = stage.make_queue(self.queue_size) if stage.make_queue else queue.Queue(maxsize=self.queue_size)
+            stage._running = stage.workers
+
+        threads = []
+        for index, stage in enumerate(self.stages):
+            downstream = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            for number in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(stage, downstream),
+                                          name=f"pipeline-{stage.name}-{number}", daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        self._started_at = time.monotonic()
+        self._finished_at = None
+        first = self.stages[0]
+        try:
+            for item in source:
+                self._put(first, item)
+        finally:
+            for _ in range(first.workers):
+                first.input.put(_DONE)
+            for thread in threads:
+                thread.join()
+            self._finished_at = time.monotonic()
+
+    def _put(self, stage: Stage, item) -> None:
+        stage.input.put(item)
+        depth = stage.input.qsize()
+        if depth > stage.max_queue_depth:
+            with stage._lock:
+                stage.max_queue_depth = max(stage.max_queue_depth, depth)
+
+    def _work(self, stage: Stage, downstream: Optional[Stage]) -> None:
+        while True:
+            item = stage.input.get()
+            if item is _DONE:
+                break
+
+            start = time.perf_counter()
+            emitted = 0
+            failed = False
+            try:
+                for output in stage.func(item) or ():
+                    emitted += 1
+                    if downstream is not None:
+                        self._put(downstream, output)
+            except Exception as e:
+                failed = True
+                print(f"Error in pipeline stage {stage.name}: {e}")
+                traceback.print_exc()
+                if stage.on_error is not None:
+                    try:
+                        stage.on_error(item, e)
+                    except Exception as callback_error:
+                        print(f"Error handling a failure in pipeline stage {stage.name}: {callback_error}")
+            stage.record(emitted, time.perf_counter() - start, failed)
+
+        # The last worker of a stage to finish tells the next stage there is no more input
+        with stage._lock:
+            stage._running -= 1
+            last = stage._running == 0
+        if last and downstream is not None:
+            for _ in range(downstream.workers):
+                downstream.input.put(_DONE)
+
+    def stats(self) -> Dict[str, Dict]:
+        """Per-stage queue depth and throughput; safe to call while the pipeline is running."""
+        if self._started_at is None:
+            wall = 0.0
+        else:
+            wall = (self._finished_at or time.monotonic()) - self._started_at
+        return {stage.name: stage.stats(wall) for stage in self.stages}
@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, List, Optional
+
+
+def record_wakes(path: str, agent_names: Iterable[str], now: Optional[float] = None) -> None:
+    """
+    Notes that agents were woken up, for the poller stored at `path` to pick up.
+
+    Wakes are appended to a side file rather than written into the poller state, so the
+    wake runner never races the exchange cycle that owns the state file.
+    """
+    now = time.time() if now is None else now
+    with open(f"{path}.wakes", 'a', encoding='utf-8') as wakes:
+        wakes.write(''.join(f"{json.dumps({'agent': name, 'at': now})}\n" for name in agent_names))
+
+
+@dataclass
+class AgentActivity:
+    # EWMA of messages collected per poll; new agents start out as active
+    rate: float = 1.0
+    # Seconds until the agent is polled again
+    interval: float = 0.0
+    next_poll: float = 0.0
+    polls: int = 0
+    # Time of the latest wake, kept so that a poll that started before it cannot postpone it
+    woken_at: Optional[float] = None
+
+
+class AdaptivePoller:
+    """
+    Chooses which outboxes to poll in a cycle from each agent's recent activity.
+
+    Every poll updates an exponentially weighted moving average of the messages it
+    returned, and the agent's next poll is scheduled `min_interval / rate` seconds later,
+    clamped to [min_interval, max_interval]. Busy agents are polled every cycle, while the
+    interval of an idle agent grows by 1 / (1 - alpha) with each empty poll. Activity, or
+    a wake (the agent received mail or was run by the cycle runner), brings it back to
+    the shortest interval.
+
+    With a `path`, the statistics are kept in a JSON file between runs of the exchange.
+    """
+
+    def __init__(self, min_interval: float = 60, max_interval: float = 3600, alpha: float = 0.3,
+                 path: Optional[str] = None):
+        if not 0 < alpha <= 1:
+            raise Exception(f"alpha must be in (0, 1], got {alpha}")
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.alpha = alpha
+        self.path = path
+        self.agents: Dict[str, AgentActivity] = {}
+        self._lock = threading.Lock()
+        if path:
+            self.load()
+
+    def due(self, agent_names: Iterable[str], now: Optional[float] = None) -> List[str]:
+        """Returns the agents whose next poll time has come, in the order given."""
+        now = time.time() if now is None else now
+        with self._lock:
+            return [name for name in agent_names if name not in self.agents or self.agents[name].next_poll <= now]
+
+    def record(self, agent_name: str, message_count: int, now: Optional[float] = None,
+               polled_at: Optional[float] = None) -> float:
+        """
+        Updates an agent's activity after a poll and schedules its next one.
+
+        Args:
+            agent_name: The polled agent
+            message_count: Messages the poll returned
+            now: When the poll finished
+            polled_at: When the poll started; a wake after that time keeps the agent due
+
+        Returns:
+            The interval in seconds until the agent is due again
+        """
+        now = time.time() if now is None else now
+        polled_at = now if polled_at is None else polled_at
+        with self._lock:
+            activity = self.agents.setdefault(agent_name, AgentActivity())
+            activity.rate = self.alpha * message_count + (1 - self.alpha) * activity.rate
+            activity.interval = self._interval(activity.rate)
+            activity.next_poll = now + activity.interval
+            if activity.woken_at is not None and activity.woken_at > polled_at:
+                # Woken while this poll ran, e.g. by a delivery in the same cycle
+                activity.next_poll = min(activity.next_poll, activity.woken_at)
+            activity.polls += 1
+            return activity.interval
+
+    def wake(self, agent_name: str, now: Optional[float] = None) -> None:
+        """Makes an agent due at once and treats it as active again."""
+        now = time.time() if now is None else now
+        with self._lock:
+            activity = self.agents.setdefault(agent_name, AgentActivity())
+            activity.rate = max(activity.rate, 1.0)
+            activity.interval = self.min_interval
+            activity.next_poll = min(activity.next_poll, now)
+            activity.woken_at = max(activity.woken_at or now, now)
+
+    def _interval(self, rate: float) -> float:
+        if rate <= 0:
+            return self.max_interval
+        return min(self.max_interval, max(self.min_interval, self.min_interval / rate))
+
+    def prune(self, agent_names: Iterable[str]) -> None:
+        """Drops the statistics of agents that are no longer in the directory."""
+        keep = set(agent_names)
+        with self._lock:
+            for name in [name for name in self.agents if name not in keep]:
+                del self.agents[name]
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            intervals = [activity.interval for activity in self.agents.values()]
+        return {
+            'agents': len(intervals),
+            'mean_interval': sum(intervals) / len(intervals) if intervals else 0.0,
+            'at_min_interval': sum(1 for interval in intervals if interval <= self.min_interval),
+            'at_max_interval': sum(1 for interval in intervals if interval >= self.max_interval),
+        }
+
+    def load(self) -> None:
+        """Reads the saved statistics and applies the wakes recorded since."""
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as state:
+                    self.agents = {name: AgentActivity(**values) for name, values in json.load(state).items()}
+            except (ValueError, TypeError) as e:
+                print(f"Ignoring unreadable poll state {self.path}: {e}")
+                self.agents = {}
+
+        # Claim the pending wakes before reading them, so new ones go to a fresh file
+        wakes_path = f"{self.path}.wakes"
+        claimed = f"{wakes_path}.{os.getpid()}"
+        try:
+            os.replace(wakes_path, claimed)
+        except FileNotFoundError:
+            return
+        with open(claimed, 'r', encoding='utf-8') as wakes:
+            for line in wakes:
+                try:
+                    wake = json.loads(line)
+                except ValueError:
+                    continue
+                self.wake(wake['agent'], now=wake['at'])
+        os.remove(claimed)
+
+    def save(self) -> None:
+        """Writes the statistics atomically, so a crash never leaves a torn state file."""
+        if not self.path:
+            return
+        with self._lock:
+            data = {name: asdict(activity) for name, activity in self.agents.items()}
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as state:
+            json.dump(data, state)
+        os.replace(temporary, self.path)
@@ -0,0 +1,165 @@
+import cProfile
+import functools
+import inspect
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+
+from src.metrics import Metrics
+
+
+def exchange_functions() -> List[Tuple[object, str]]:
+    """The (owner, attribute) pairs timed in an exchange cycle by default."""
+    # Imported here so that profiling other scripts does not load the message service
+    from src.external_api import ExternalAPI
+    from src.message_service import MessageService
+
+    return [
+        (MessageService, 'process_messages'),
+        (ExternalAPI, 'collect_from_outbox'),
+        (ExternalAPI, '_extract_file_entries'),
+        (ExternalAPI, 'add_to_inbox'),
+    ]
+
+
+class CycleProfiler:
+    """
+    Profiles everything that runs inside it: cProfile for the call graph, tracemalloc for
+    allocation sites, and wall-clock timers around a few named functions.
+
+    The pipeline does its work in worker threads, so every thread started while the
+    profiler is active gets its own cProfile profile and the results are merged. The
+    timers are installed by replacing the functions on their owners for the duration of
+    the `with` block only; nothing is patched or traced when the profiler is not used.
+
+    On exit, the results are written to a timestamped directory under `output_dir`:
+        cycle.prof         the merged profile, for pstats, snakeviz or gprof2dot
+        calls.txt          the top functions by cumulative time and their callers
+        allocations.txt    the top allocation sites still held at the end, and the peak
+        timings.json       count, total, mean and max wall seconds per timed function
+    """
+
+    def __init__(self, output_dir: str, functions: Optional[Sequence[Tuple[object, str]]] = None,
+                 top: int = 30, frames: int = 10):
+        """
+        Args:
+            output_dir: Directory the timestamped result directory is created in
+            functions: (owner, attribute) pairs to time, where the owner is a class or module;
+                defaults to exchange_functions()
+            top: Number of entries in calls.txt and allocations.txt
+            frames: Traceback depth stored by tracemalloc per allocation
+        """
+        self.output_dir = output_dir
+        self.functions = list(exchange_functions() if functions is None else functions)
+        self.top = top
+        self.frames = frames
+        self.timings = Metrics()
+        self.path: Optional[str] = None
+        self._profiles: List[cProfile.Profile] = []
+        self._originals: List[Tuple[object, str, object]] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started = 0.0
+
+    def __enter__(self) -> 'CycleProfiler':
+        for owner, name in self.functions:
+            original = inspect.getattr_static(owner, name)
+            self._originals.append((owner, name, original))
+            setattr(owner, name, self._timed(f"{getattr(owner, '__name__', owner)}.{name}", original))
+
+        tracemalloc.start(self.frames)
+        # Python 3.12+ profiles through sys.monitoring, where the profile enabled below
+        # already covers every thread; per-thread profiles can only be enabled before that
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._profile_thread)
+        self._started = time.perf_counter()
+        self._profile_thread()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        wall = time.perf_counter() - self._started
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+        for profile in self._profiles:
+            profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        for owner, name, original in reversed(self._originals):
+            setattr(owner, name, original)
+        self._originals.clear()
+
+        self.path = os.path.join(self.output_dir, datetime.now().strftime('%Y%m%d-%H%M%S'))
+        os.makedirs(self.path, exist_ok=True)
+        self._write_calls()
+        self._write_allocations(snapshot, peak)
+        with open(os.path.join(self.path, 'timings.json'), 'w') as f:
+            json.dump({'cycle_seconds': wall, **self.timings.snapshot()['observations']}, f, indent=2)
+        print(f"Profile written to {self.path}")
+
+    def _profile_thread(self, *args) -> None:
+        # threading installs this as the profile hook of every new thread; it only has to run
+        # once there, so it removes itself before handing the thread to cProfile
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        profile.enable()
+        with self._lock:
+            self._profiles.append(profile)
+
+    def _timed(self, label: str, original):
+        function = original.__func__ if isinstance(original, (staticmethod, classmethod)) else original
+        local = self._local
+        timings = self.timings
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            # Recursive calls (_extract_file_entries) count once, at the outermost call
+            depth = getattr(local, label, 0)
+            setattr(local, label, depth + 1)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                setattr(local, label, depth)
+                if depth == 0:
+                    timings.observe(label, time.perf_counter() - start)
+
+        return type(original)(timed) if isinstance(original, (staticmethod, classmethod)) else timed
+
+    def _write_calls(self) -> None:
+        stats = None
+        for profile in self._profiles:
+            if stats is None:
+                stats = pstats.Stats(profile, stream=io.StringIO())
+            else:
+                stats.add(profile)
+        if stats is None:
+            return
+        stats.dump_stats(os.path.join(self.path, 'cycle.prof'))
+
+        with open(os.path.join(self.path, 'calls.txt'), 'w') as f:
+            stats.stream = f
+            stats.sort_stats('cumulative').print_stats(self.top)
+            stats.print_callers(self.top)
+
+    def _write_allocations(self, snapshot: tracemalloc.Snapshot, peak: int) -> None:
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+        with open(os.path.join(self.path, 'allocations.txt'), 'w') as f:
+            f.write(f"Peak traced memory: {peak / 1024:.1f} KiB\n\n")
+            for number, stat in enumerate(snapshot.statistics('lineno')[:self.top], 1):
+                frame = stat.traceback[0]
+                f.write(f"#{number} {frame.filename}:{frame.lineno}: {stat.size / 1024:.1f} KiB in {stat.count} blocks\n")
+            f.write("\nLargest sites with their call stacks:\n")
+            for stat in snapshot.statistics('traceback')[:5]:
+                f.write(f"\n{stat.size / 1024:.1f} KiB in {stat.count} blocks\n")
+                f.write('\n'.join(stat.traceback.format()) + '\n')
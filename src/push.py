@@ -0,0 +1,101 @@
+import queue
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+
+from src.message import split_addresses
+from src.routing import normalize_address
+
+# Subscribing to this address receives every message, e.g. for dashboards
+ALL_RECIPIENTS = '*'
+
+
+def recipients_of(message) -> List[str]:
+    """
+    Returns the recipients of a message posted to the API.
+
+    Messages are free-form; dicts carrying a 'to' or 'to_address' field are routed to
+    those recipients, anything else only reaches ALL_RECIPIENTS subscribers.
+    """
+    if isinstance(message, dict):
+        to_address = message.get('to') or message.get('to_address')
+        if isinstance(to_address, str):
+            return split_addresses(to_address)
+    return []
+
+
+class Subscription:
+    """A subscriber's bounded queue of pushed messages."""
+
+    def __init__(self, broker: 'PushBroker', recipients: List[str], max_pending: int):
+        self.broker = broker
+        self.recipients = recipients
+        self.queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+
+    def get(self, timeout: Optional[float] = None):
+        """Returns the next message, or None if nothing arrived within `timeout` seconds."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self) -> None:
+        self.broker.unsubscribe(self)
+
+
+class PushBroker:
+    """
+    Routes newly ingested messages to the subscribers of their recipients.
+
+    Subscriptions are indexed by normalized recipient address, so publishing a message
+    touches only the subscribers of its recipients (plus ALL_RECIPIENTS subscribers) and
+    never the message store. A subscriber that falls `max_pending` messages behind loses
+    the newest ones rather than holding up the publisher.
+    """
+
+    def __init__(self, max_pending: int = 100):
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+
+    def subscribe(self, recipients: Iterable[str]) -> Subscription:
+        keys = [normalize_address(recipient) for recipient in recipients] or [ALL_RECIPIENTS]
+        subscription = Subscription(self, keys, self.max_pending)
+        with self._lock:
+            for key in keys:
+                self._subscribers.setdefault(key, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            for key in subscription.recipients:
+                subscribers = self._subscribers.get(key)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[key]
+
+    def publish(self, message, recipients: Iterable[str]) -> int:
+        """
+        Pushes a message to everyone subscribed to one of its recipients.
+
+        Returns:
+            The number of subscriptions the message was queued for
+        """
+        keys = {normalize_address(recipient) for recipient in recipients}
+        keys.add(ALL_RECIPIENTS)
+        with self._lock:
+            targets = set()
+            for key in keys:
+                targets.update(self._subscribers.get(key, ()))
+
+        for subscription in targets:
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                subscription.dropped += 1
+        return len(targets)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len({subscription for subscribers in self._subscribers.values() for subscription in subscribers})
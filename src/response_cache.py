@@ -0,0 +1,46 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+
+class ResponseCache:
+    """
+    Serialized response bodies for one version of the data they were built from.
+
+    Entries are looked up by the current version and a request key (filters, page). The
+    first lookup or store with a newer version drops every entry, so a write invalidates
+    the cache without having to know which responses it affects. At most `max_entries`
+    keys are kept, least recently used first out.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._version: Optional[str] = None
+        self._entries: 'OrderedDict[Hashable, bytes]' = OrderedDict()
+
+    def _switch(self, version: str) -> None:
+        if version != self._version:
+            self._version = version
+            self._entries.clear()
+
+    def get(self, version: str, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            self._switch(version)
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, version: str, key: Hashable, body: bytes) -> None:
+        with self._lock:
+            self._switch(version)
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,127 @@
+import hashlib
+import json
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+
+WILDCARD = '*'
+
+
+class Route(NamedTuple):
+    agent_name: str
+    inbox_url: str
+
+
+def normalize_address(address: str) -> str:
+    """Addresses are matched case-insensitively and without surrounding whitespace."""
+    return address.strip().casefold()
+
+
+def directory_version(addresses: Dict[str, str], groups: Optional[Dict[str, List[str]]] = None) -> str:
+    """Returns a stable fingerprint of the agent directory, used to decide when to rebuild the table."""
+    payload = json.dumps({'addresses': addresses, 'groups': groups or {}}, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class _TrieNode:
+    __slots__ = ('children', 'routes')
+
+    def __init__(self):
+        self.children: Dict[str, '_TrieNode'] = {}
+        # Every route whose normalized name starts with the prefix leading to this node
+        self.routes: List[Route] = []
+
+
+class RoutingTable:
+    """
+    Precompiled recipient directory for one version of the cities data.
+
+    Inbox URLs are derived from the WAKEUP URLs once, when the table is built. Besides exact
+    agent names, a recipient may be a prefix address ending in '*' (e.g. 'FRBG/*' for a whole
+    city) or the name of a group listed in the directory. Prefix lookups walk a character trie
+    whose nodes already hold their expanded route lists, so resolving a message costs time
+    proportional to the number of recipients it reaches.
+    """
+
+    def __init__(self, addresses: Dict[str, str], groups: Optional[Dict[str, List[str]]] = None):
+        self.version = directory_version(addresses, groups)
+        self._routes: Dict[str, Route] = {}
+        self._root = _TrieNode()
+
+        for agent_name, url in addresses.items():
+            route = Route(agent_name, url.replace("WAKEUP", "RECEIVE_POST"))
+            key = normalize_address(agent_name)
+            self._routes[key] = route
+
+            node = self._root
+            node.routes.append(route)
+            for char in key:
+                node = node.children.setdefault(char, _TrieNode())
+                node.routes.append(route)
+
+        self._groups: Dict[str, List[str]] = {
+            normalize_address(name): list(members) for name, members in (groups or {}).items()
+        }
+
+    @classmethod
+    def from_cities(cls, cities_data: Dict) -> 'RoutingTable':
+        addresses = {}
+        for city_dict in cities_data.get('addresses', []):
+            addresses.update(city_dict)
+        return cls(addresses, cities_data.get('groups'))
+
+    def __len__(self) -> int:
+        return len(self._routes)
+
+    def lookup(self, agent_name: str) -> Optional[Route]:
+        """Resolves a single exact agent name."""
+        return self._routes.get(normalize_address(agent_name))
+
+    def resolve(self, recipients: Iterable[str], sender: Optional[str] = None) -> Tuple[List[Route], List[str]]:
+        """
+        Expands a message's recipient list into deduplicated routes.
+
+        Args:
+            recipients: Addresses taken from the message's 'to' field
+            sender: Address of the sender, excluded from wildcard and group expansions
+
+        Returns:
+            The routes to deliver to, in first-seen order, and the recipients that matched nothing
+        """
+        resolved: Dict[str, Route] = {}
+        unresolved: List[str] = []
+        sender_route = self._routes.get(normalize_address(sender)) if sender else None
+
+        for recipient in recipients:
+            if not self._expand(normalize_address(recipient), sender_route, resolved, set()):
+                unresolved.append(recipient)
+
+        return list(resolved.values()), unresolved
+
+    def _expand(self, key: str, sender_route: Optional[Route], resolved: Dict[str, Route], seen_groups: set) -> bool:
+        route = self._routes.get(key)
+        if route:
+            resolved.setdefault(route.agent_name, route)
+            return True
+
+        if key.endswith(WILDCARD):
+            node = self._root
+            for char in key[:-1]:
+                node = node.children.get(char)
+                if node is None:
+                    return False
+            for route in node.routes:
+                if route is not sender_route:
+                    resolved.setdefault(route.agent_name, route)
+            return bool(node.routes)
+
+        members = self._groups.get(key)
+        if members is None or key in seen_groups:
+            return False
+        seen_groups.add(key)
+        found = False
+        for member in members:
+            member_key = normalize_address(member)
+            if sender_route is not None and self._routes.get(member_key) is sender_route:
+                continue
+            found = self._expand(member_key, sender_route, resolved, seen_groups) or found
+        return found
@@ -0,0 +1,125 @@
+import math
+import threading
+from collections import deque
+from typing import Callable, Dict, Optional
+
+# Delivery lanes from most to least urgent, with their share of delivery capacity
+PRIORITY_WEIGHTS = {'high': 8, 'normal': 3, 'low': 1}
+DEFAULT_PRIORITY = 'normal'
+
+
+def priority_lane(value) -> str:
+    """
+    Maps the 'priority' of an outbox message onto a delivery lane.
+
+    Lane names are matched case-insensitively; numbers above zero are 'high' and numbers
+    below zero 'low'. Anything else is delivered as DEFAULT_PRIORITY.
+    """
+    if isinstance(value, str):
+        name = value.strip().lower()
+        if name in PRIORITY_WEIGHTS:
+            return name
+        try:
+            value = float(name)
+        except ValueError:
+            return DEFAULT_PRIORITY
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if value > 0:
+            return 'high'
+        if value < 0:
+            return 'low'
+    return DEFAULT_PRIORITY
+
+
+def parse_priority_weights(setting: str) -> Dict[str, float]:
+    """
+    Parses lane weights written as "high=8,normal=3,low=1".
+
+    Raises:
+        Exception: For a malformed entry or a weight that is not a positive number, which
+            would break the finish times of WeightedFairQueue
+    """
+    weights = {}
+    for entry in filter(None, (part.strip() for part in setting.split(','))):
+        lane, _, weight = entry.partition('=')
+        try:
+            weights[lane.strip()] = float(weight)
+        except ValueError:
+            raise Exception(f"Invalid priority weight {entry!r}, expected <lane>=<weight>")
+    _check_weights(weights)
+    return weights
+
+
+def _check_weights(weights: Dict[str, float]) -> None:
+    for lane, weight in weights.items():
+        if not (weight > 0 and math.isfinite(weight)):
+            raise Exception(f"Priority weight of lane {lane!r} must be a positive number, got {weight}")
+
+
+class WeightedFairQueue:
+    """
+    A multi-lane queue that serves its lanes by weighted fair queuing.
+
+    Every item is stamped with a virtual finish time of `1 / weight` after the later of
+    the queue's virtual clock and its lane's previous finish time, and `get()` returns the
+    item with the earliest finish time. A backlogged lane therefore gets `weight / total`
+    of the throughput, no lane is starved, and an urgent item waits behind at most a few
+    items of each other lane no matter how long their backlog is.
+
+    Each lane is bounded by `maxsize` on its own, so bulk traffic filling its lane never
+    blocks the other lanes. Items that `classify` returns None for (such as end-of-input
+    markers) are served in FIFO order once every lane is empty.
+    """
+
+    def __init__(self, classify: Callable[[object], Optional[str]], weights: Optional[Dict[str, float]] = None,
+                 maxsize: int = 0):
+        self.classify = classify
+        self.weights = dict(weights or PRIORITY_WEIGHTS)
+        _check_weights(self.weights)
+        self.maxsize = maxsize
+        self.served = {lane: 0 for lane in self.weights}
+        self._lanes = {lane: deque() for lane in self.weights}
+        self._finish = {lane: 0.0 for lane in self.weights}
+        self._virtual_time = 0.0
+        self._unclassified = deque()
+        self._condition = threading.Condition()
+
+    def put(self, item) -> None:
+        lane = self.classify(item)
+        with self._condition:
+            if lane is None:
+                self._unclassified.append(item)
+            else:
+                if lane not in self._lanes:
+                    lane = DEFAULT_PRIORITY if DEFAULT_PRIORITY in self._lanes else next(iter(self._lanes))
+                while self.maxsize and len(self._lanes[lane]) >= self.maxsize:
+                    self._condition.wait()
+                start = max(self._virtual_time, self._finish[lane])
+                self._finish[lane] = start + 1.0 / self.weights[lane]
+                self._lanes[lane].append((start, self._finish[lane], item))
+            self._condition.notify_all()
+
+    def get(self):
+        with self._condition:
+            while not self._unclassified and not any(self._lanes.values()):
+                self._condition.wait()
+
+            # Ties go to the lane listed first, i.e. the more urgent one
+            lane = min((lane for lane, items in self._lanes.items() if items),
+                       key=lambda lane: self._lanes[lane][0][1], default=None)
+            if lane is None:
+                item = self._unclassified.popleft()
+            else:
+                start, _, item = self._lanes[lane].popleft()
+                self._virtual_time = start
+                self.served[lane] += 1
+            self._condition.notify_all()
+            return item
+
+    def qsize(self) -> int:
+        with self._condition:
+            return len(self._unclassified) + sum(len(items) for items in self._lanes.values())
+
+    def lane_sizes(self) -> Dict[str, int]:
+        with self._condition:
+            return {lane: len(items) for lane, items in self._lanes.items()}
@@ -0,0 +1,147 @@
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - redis is optional
+    redis = None
+
+
+class MemoryStateBackend:
+    """
+    Shared-state operations on a dict in this process, for a single exchange worker.
+
+    Values are strings and may expire after `ttl` seconds; expired keys are dropped when
+    they are read and swept every `sweep_every` writes.
+    """
+
+    def __init__(self, sweep_every: int = 1024):
+        self._lock = threading.Lock()
+        self._values: Dict[str, Tuple[str, Optional[float]]] = {}
+        self._sweep_every = sweep_every
+        self._writes = 0
+
+    def _live(self, key: str, now: float) -> Optional[str]:
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= now:
+            del self._values[key]
+            return None
+        return entry[0]
+
+    def _store(self, key: str, value: str, ttl: Optional[float], now: float) -> None:
+        self._values[key] = (value, now + ttl if ttl else None)
+        self._writes += 1
+        if self._writes % self._sweep_every == 0:
+            for stale in [key for key, (_, expires_at) in self._values.items() if expires_at and expires_at <= now]:
+                del self._values[stale]
+
+    def get_many(self, keys: Iterable[str]) -> List[Optional[str]]:
+        now = time.monotonic()
+        with self._lock:
+            return [self._live(key, now) for key in keys]
+
+    def set_many(self, values: Dict[str, str], ttl: Optional[float] = None) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for key, value in values.items():
+                self._store(key, value, ttl, now)
+
+    def claim(self, keys: Iterable[str], ttl: float) -> List[bool]:
+        """Sets every key that is not set yet; True for the keys this call set."""
+        now = time.monotonic()
+        claimed = []
+        with self._lock:
+            for key in keys:
+                free = self._live(key, now) is None
+                if free:
+                    self._store(key, '1', ttl, now)
+                claimed.append(free)
+        return claimed
+
+    def incr(self, key: str, ttl: float) -> int:
+        """Increments a counter that expires `ttl` seconds after its first increment."""
+        now = time.monotonic()
+        with self._lock:
+            current = self._live(key, now)
+            if current is None:
+                self._store(key, '1', ttl, now)
+                return 1
+            value, expires_at = self._values[key]
+            self._values[key] = (str(int(value) + 1), expires_at)
+            return int(value) + 1
+
+    def delete(self, keys: Iterable[str]) -> None:
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+    def close(self) -> None:
+        pass
+
+
+class RedisStateBackend:
+    """
+    The same operations on a Redis server, so that exchange workers on any host share them.
+
+    Every call is one round trip: reads use MGET and multi-key writes are sent as one
+    non-transactional pipeline. Keys are namespaced with `prefix`.
+    """
+
+    def __init__(self, url: str, prefix: str = 'agent_post:', client=None):
+        if client is None and redis is None:
+            raise Exception("STATE_BACKEND_URL points to Redis but the redis package is not installed")
+        self.client = client or redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    def get_many(self, keys: Iterable[str]) -> List[Optional[str]]:
+        keys = [self._key(key) for key in keys]
+        return self.client.mget(keys) if keys else []
+
+    def set_many(self, values: Dict[str, str], ttl: Optional[float] = None) -> None:
+        if not values:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipe.set(self._key(key), value, px=int(ttl * 1000) if ttl else None)
+        pipe.execute()
+
+    def claim(self, keys: Iterable[str], ttl: float) -> List[bool]:
+        """Sets every key that is not set yet (SET NX); True for the keys this call set."""
+        keys = list(keys)
+        if not keys:
+            return []
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.set(self._key(key), '1', nx=True, px=int(ttl * 1000))
+        return [bool(result) for result in pipe.execute()]
+
+    def incr(self, key: str, ttl: float) -> int:
+        """Increments a counter that expires `ttl` seconds after its first increment."""
+        pipe = self.client.pipeline(transaction=False)
+        # Creates the key with its expiry only if it is missing; INCR keeps the expiry
+        pipe.set(self._key(key), 0, nx=True, px=int(ttl * 1000))
+        pipe.incr(self._key(key))
+        return pipe.execute()[1]
+
+    def delete(self, keys: Iterable[str]) -> None:
+        keys = [self._key(key) for key in keys]
+        if keys:
+            self.client.delete(*keys)
+
+    def close(self) -> None:
+        self.client.close()
+
+
+def create_state_backend(url: Optional[str] = None):
+    """Returns a RedisStateBackend for a redis:// or rediss:// URL, or a MemoryStateBackend without one."""
+    if not url or url == 'memory':
+        return MemoryStateBackend()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStateBackend(url)
+    raise Exception(f"Unsupported state backend URL: {url}")
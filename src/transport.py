@@ -0,0 +1,208 @@
+import threading
+from typing import Dict, Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+from src.metrics import Metrics, metrics as default_metrics
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - httpx is optional
+    httpx = None
+
+try:
+    import h2.exceptions  # httpx needs h2 for HTTP/2
+    HTTP2_AVAILABLE = httpx is not None
+except ImportError:  # pragma: no cover
+    HTTP2_AVAILABLE = False
+
+
+class _RawBody:
+    """The `response.raw` part of a requests response that ExternalAPI reads outbox bodies through."""
+
+    def __init__(self, response: 'httpx.Response'):
+        self._response = response
+        self._chunks: Optional[Iterator[bytes]] = None
+        self._buffer = b''
+
+    def read(self, amt: Optional[int] = None, decode_content: bool = True) -> bytes:
+        if self._chunks is None:
+            self._chunks = self._response.iter_bytes() if decode_content else self._response.iter_raw()
+        while amt is None or len(self._buffer) < amt:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if amt is None:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        if not self._buffer:
+            self._response.close()
+        return data
+
+
+class HttpxResponse:
+    """Presents an httpx response with the parts of the requests.Response API the exchange uses."""
+
+    def __init__(self, response: 'httpx.Response', streamed: bool):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.http_version = response.http_version
+        self.raw = _RawBody(response) if streamed else None
+
+    @property
+    def content(self) -> bytes:
+        return self._response.read()
+
+    @property
+    def text(self) -> str:
+        return self._response.read().decode(self._response.encoding or 'utf-8', errors='replace')
+
+    def json(self):
+        return self._response.json()
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+    def close(self) -> None:
+        self._response.close()
+
+
+class Http2Session:
+    """
+    A drop-in for the `requests` module functions (`get`, `post`) that multiplexes concurrent
+    requests as HTTP/2 streams over a shared httpx client.
+
+    Over https, HTTP/2 is negotiated with ALPN. The agent backend is plain http, where
+    HTTP/2 needs `prior_knowledge`. Whenever the server turns out not to speak HTTP/2 (it
+    rejects the prior-knowledge preface or negotiates HTTP/1.1), the session switches for
+    good to a pooled `requests` session of `max_connections` sockets and repeats the
+    request if its body allows. The same happens from the start when httpx and h2 are
+    not installed. httpx errors are raised as their requests equivalents, so callers keep
+    catching RequestException.
+    """
+
+    def __init__(self, http2: bool = True, prior_knowledge: bool = False, max_connections: int = 4,
+                 timeout: float = 30.0, metrics: Optional[Metrics] = None):
+        self.metrics = metrics or default_metrics
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.prior_knowledge = prior_knowledge
+        self._lock = threading.Lock()
+        self._confirmed = False
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._client = None
+        if http2 and not HTTP2_AVAILABLE:
+            print("HTTP/2 requested but httpx[http2] is not installed; using HTTP/1.1")
+        elif http2:
+            self._client = httpx.Client(
+                http1=not prior_knowledge,
+                http2=True,
+                timeout=timeout,
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            )
+
+    @property
+    def http2(self) -> bool:
+        """Whether requests currently go out over HTTP/2."""
+        return self._client is not None
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def request(self, method: str, url: str, data=None, json=None, headers: Optional[Dict] = None,
+                stream: bool = False, timeout: Optional[float] = None):
+        client = self._client
+        if client is None:
+            self.metrics.increment('http.requests_http11')
+            return self._session.request(method, url, data=data, json=json, headers=headers, stream=stream,
+                                         timeout=timeout or self.timeout)
+
+        try:
+            response = self._send_opening_stream(client, method, url, data, json, headers, stream, timeout)
+        except httpx.TransportError as e:
+            # Before any HTTP/2 response has been seen, a failure of a prior-knowledge request
+            # means the server only speaks HTTP/1.1: it answers the preface with an error or
+            # drops the connection.
+            if not self.prior_knowledge or self._confirmed or not self._replayable(data) \
+                    or isinstance(e, (httpx.ConnectError, httpx.TimeoutException)):
+                raise self._translate(method, url, e)
+            self._fall_back(client)
+            return self.request(method, url, data=data, json=json, headers=headers, stream=stream, timeout=timeout)
+        except httpx.HTTPError as e:
+            raise self._translate(method, url, e)
+
+        if response.http_version == 'HTTP/2':
+            self._confirmed = True
+            self.metrics.increment('http.requests_http2')
+        else:
+            # The server negotiated HTTP/1.1; this response is fine, later requests use the pool
+            self.metrics.increment('http.requests_http11')
+            self._fall_back(client)
+        return response
+
+    def _send_opening_stream(self, client, method, url, data, json, headers, stream, timeout,
+                             attempts: int = 3) -> HttpxResponse:
+        # httpcore picks the next stream id and opens the stream under separate locks, so a
+        # concurrent request can open a higher id first; h2 then refuses the lower one before
+        # anything is written. The request never reached the server and can go out again.
+        for attempt in range(attempts):
+            try:
+                return self._send(client, method, url, data, json, headers, stream, timeout)
+            except httpx.LocalProtocolError as e:
+                if attempt == attempts - 1 or not self._replayable(data) or not self._stream_id_too_low(e):
+                    raise
+                self.metrics.increment('http.stream_retries')
+
+    def _send(self, client, method, url, data, json, headers, stream, timeout) -> HttpxResponse:
+        content = data.encode('utf-8') if isinstance(data, str) else data
+        request = client.build_request(method, url, content=content, json=json, headers=headers,
+                                       timeout=timeout or self.timeout)
+        return HttpxResponse(client.send(request, stream=stream), streamed=stream)
+
+    @staticmethod
+    def _stream_id_too_low(error: Optional[BaseException]) -> bool:
+        while error is not None:
+            if isinstance(error, h2.exceptions.StreamIDTooLowError):
+                return True
+            error = error.__cause__ or error.__context__
+        return False
+
+    @staticmethod
+    def _translate(method: str, url: str, error: Exception) -> Exception:
+        if isinstance(error, httpx.TimeoutException):
+            return Timeout(f"{method} {url} timed out: {error}")
+        return ConnectionError(f"{method} {url} failed: {error}")
+
+    @staticmethod
+    def _replayable(data) -> bool:
+        # Generators are consumed by the failed attempt; bytes and re-iterable bodies are not
+        return data is None or isinstance(data, (bytes, str)) or (hasattr(data, '__iter__') and not hasattr(data, '__next__'))
+
+    def _fall_back(self, failed_client) -> None:
+        with self._lock:
+            if self._client is not failed_client:
+                return
+            print("Agent backend does not speak HTTP/2; falling back to HTTP/1.1")
+            self._client = None
+        self.metrics.increment('http.fallbacks')
+        # Requests still in flight on the client finish first
+        threading.Thread(target=failed_client.close, daemon=True).start()
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+        self._session.close()
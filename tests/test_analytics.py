@@ -0,0 +1,112 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import create_engine, insert
+
+from src.analytics import LatencyHistogram, MessageAnalytics, analyze, iter_message_frames
+from src.message import Message
+from src.message_repository import Base, MessageModel
+from src.partitioned_repository import PartitionedMessageRepository
+
+NOW = datetime(2025, 1, 1, 12, 0, 0)
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_percentiles_are_within_one_bin(self):
+        histogram = LatencyHistogram()
+        values = np.linspace(0.01, 100.0, 10000)
+        histogram.add(values[:5000])
+        histogram.add(np.append(values[5000:], np.nan))
+
+        self.assertEqual(10000, histogram.count)
+        for q in (50, 90, 99):
+            exact = np.percentile(values, q)
+            self.assertGreaterEqual(histogram.percentile(q), exact * 0.999)
+            self.assertLessEqual(histogram.percentile(q), exact * 1.13)
+        self.assertEqual(100.0, histogram.percentile(100))
+
+
+class TestMessageAnalytics(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.addCleanup(self.engine.dispose)
+        rows = []
+        for n in range(1, 101):
+            created = NOW - timedelta(hours=2, seconds=n)
+            row = {'id': n, 'created_at': created, 'from_address': f"agent{n % 2}",
+                   'to_address': 'agent7; agent8' if n % 10 == 0 else 'agent7', 'data': 'x' * 100,
+                   'collected_at': created + timedelta(seconds=10) if n <= 90 else None,
+                   'delivered_at': created + timedelta(seconds=12) if n <= 80 else None}
+            rows.append(row)
+        with self.engine.begin() as conn:
+            conn.execute(insert(MessageModel.__table__), rows)
+
+    def test_history_is_read_in_chunks(self):
+        frames = list(iter_message_frames(self.engine, chunk_size=30))
+        self.assertEqual([30, 30, 30, 10], [len(frame) for frame in frames])
+        self.assertNotIn('data', frames[0].columns)
+
+    def test_report_covers_latency_throughput_and_backlog(self):
+        report = analyze(self.engine, chunk_size=7, now=NOW)
+
+        self.assertEqual(100, report['messages'])
+        self.assertEqual(90, report['latency']['created_to_collected']['count'])
+        self.assertAlmostEqual(10.0, report['latency']['created_to_collected']['mean_s'])
+        self.assertAlmostEqual(2.0, report['latency']['collected_to_delivered']['max_s'])
+        self.assertEqual(80, report['latency']['created_to_delivered']['count'])
+
+        self.assertEqual({'messages': 80, 'per_hour': 80 / (79 / 3600.0)}, report['agents']['delivered_to']['agent7'])
+        self.assertEqual(8, report['agents']['delivered_to']['agent8']['messages'])
+        self.assertEqual({'agent0': 50, 'agent1': 50}, report['agents']['sent'])
+
+        backlog = report['backlog']
+        self.assertEqual(20, backlog['undelivered'])
+        self.assertEqual(10, backlog['uncollected'])
+        self.assertEqual({'agent7': 20, 'agent8': 2}, backlog['pending_for'])
+        self.assertAlmostEqual(7300.0, backlog['age']['max_s'])
+
+    def test_chunk_size_does_not_change_the_report(self):
+        whole = MessageAnalytics(now=NOW)
+        for frame in iter_message_frames(self.engine, chunk_size=1000):
+            whole.add_frame(frame)
+        self.assertEqual(whole.report(), analyze(self.engine, chunk_size=3, now=NOW))
+
+
+
+class TestPartitionedAnalytics(unittest.TestCase):
+    def test_recipient_messages_are_read_from_every_shard(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        db_url = f"sqlite:///{os.path.join(tmpdir.name, 'agent_post.db')}"
+        messages = [Message(from_address='agent0', to_address='agent1; agent2' if n % 2 else 'agent3', data='x',
+                            created_at=NOW - timedelta(minutes=n),
+                            collected_at=NOW - timedelta(minutes=n) + timedelta(seconds=5),
+                            delivered_at=NOW if n < 6 else None)
+                    for n in range(10)]
+
+        async def save():
+            repository = PartitionedMessageRepository(db_url, partitions=4)
+            await repository.save_many(messages)
+            await repository.dispose()
+        asyncio.run(save())
+
+        engine = create_engine(db_url)
+        self.addCleanup(engine.dispose)
+        report = analyze(engine, chunk_size=2, now=NOW, partitions=4)
+
+        # Each recipient's copy of a message is one row
+        self.assertEqual(15, report['messages'])
+        self.assertEqual({'agent0': 15}, report['agents']['sent'])
+        self.assertEqual({'agent1': 3, 'agent2': 3, 'agent3': 3},
+                         {agent: counts['messages'] for agent, counts in report['agents']['delivered_to'].items()})
+        self.assertEqual({'agent1': 2, 'agent2': 2, 'agent3': 2}, report['backlog']['pending_for'])
+        self.assertAlmostEqual(5.0, report['latency']['created_to_collected']['mean_s'])
+
+
+if __name__ == '__main__':
+    unittest.main()
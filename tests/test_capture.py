@@ -0,0 +1,111 @@
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.capture import CaptureWriter, RecordingHttp, ReplayHttp, read_capture, replay_cycles
+from src.city_api import CityAPI
+from src.external_api import ExternalAPI
+from src.message_service import MessageService
+from src.metrics import Metrics
+
+
+def outbox(n):
+    return {'outbox': [{'path': f'./{i}.json', 'file_content': {'message': {
+        'id': i, 'from': 'agent1', 'to': 'agent2', 'data': f'message {i}'}}} for i in range(n)]}
+
+
+class AgentBackend(BaseHTTPRequestHandler):
+    inbox_posts = []
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body: bytes, encoding: str = None):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        base = f"http://127.0.0.1:{self.server.server_port}"
+        self._reply(json.dumps({'data': {'addresses': [
+            {'agent1': f'{base}/agent1/api/WAKEUP/', 'agent2': f'{base}/agent2/api/WAKEUP/'}]}}).encode())
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/agent1/api/WAKEUP/':
+            self._reply(gzip.compress(json.dumps(outbox(3)).encode()), 'gzip')
+        elif 'RECEIVE_POST' in self.path:
+            AgentBackend.inbox_posts.append(json.loads(body))
+            self._reply(b'{"status": "ok"}')
+        else:
+            self._reply(b'{}')
+
+
+class TestRecordAndReplay(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'capture.jsonl.gz')
+        AgentBackend.inbox_posts = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), AgentBackend)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.cities_url = f"http://127.0.0.1:{self.server.server_port}/cities"
+
+    def _service(self, http, cities_url):
+        return MessageService(CityAPI(cities_url, http=http), ExternalAPI('token', metrics=Metrics(), http=http))
+
+    def _record(self, cycles=1):
+        for _ in range(cycles):
+            http = RecordingHttp(CaptureWriter(self.path))
+            service = self._service(http, self.cities_url)
+            service.process_messages()
+            service.fanout.close()
+            http.close()
+
+    def test_capture_holds_every_request_of_the_cycle(self):
+        self._record()
+
+        cycles = read_capture(self.path)
+        self.assertEqual(1, len(cycles))
+        requests = [(record['method'], record['url'].split('/', 3)[-1]) for record in cycles[0]]
+        self.assertEqual(('GET', 'cities'), requests[0])
+        self.assertEqual(3, requests.count(('POST', 'agent2/api/RECEIVE_POST/')))
+        outbox_record = next(record for record in cycles[0] if record['url'].endswith('agent1/api/WAKEUP/'))
+        # Kept compressed, as it came over the wire
+        self.assertEqual('gzip', outbox_record['headers']['Content-Encoding'])
+        self.assertGreaterEqual(outbox_record['elapsed'], 0)
+
+    def test_replay_reproduces_parsing_and_delivery(self):
+        self._record(cycles=2)
+        self.server.shutdown()
+
+        results = list(replay_cycles(self.path, self._service))
+        self.assertEqual(2, len(results))
+        for result in results:
+            self.assertEqual(3, result['traffic']['messages'])
+            self.assertEqual(3, result['traffic']['deliveries'])
+            self.assertEqual(0, result['requests_unmatched'])
+            self.assertEqual(0, result['requests_not_replayed'])
+
+    def test_replay_at_original_speed_takes_the_captured_time(self):
+        http = ReplayHttp([{'method': 'GET', 'url': 'http://x/', 'status': 200, 'elapsed': 0.2, 'body': ''}], speed=2)
+        start = time.perf_counter()
+        http.get('http://x/')
+        self.assertGreaterEqual(time.perf_counter() - start, 0.1)
+        self.assertEqual(200, http.post('http://x/unknown', data=b'{}').status_code)
+        self.assertEqual(1, http.unmatched)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from src.city_api import CityAPI
+from src.coalescing import CoalescingBuffer
+from src.external_api import ExternalAPI
+from src.message import Message
+from src.message_service import MessageService
+from src.routing import Route
+
+AGENT2 = Route('agent2', 'http://agent2/api/RECEIVE_POST/')
+AGENT3 = Route('agent3', 'http://agent3/api/RECEIVE_POST/')
+
+
+def updated_file(n):
+    return {'path': f'./{n}.json', 'file_content': json.dumps({'data': f'message {n}'})}
+
+
+class TestCoalescingBuffer(unittest.TestCase):
+    def setUp(self):
+        self.external_api = MagicMock(spec=ExternalAPI)
+        self.external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'coalesce.jsonl')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _posted(self):
+        return [(call_args[0][0], [entry['path'] for entry in call_args[0][1]['updated_files']])
+                for call_args in self.external_api.add_to_inbox.call_args_list]
+
+    def test_files_are_batched_until_the_window_ends(self):
+        buffer = CoalescingBuffer(self.external_api, max_delay=60)
+        for n in range(3):
+            buffer.add([AGENT2], updated_file(n))
+        buffer.add([AGENT3], updated_file(3))
+
+        self.external_api.add_to_inbox.assert_not_called()
+        self.assertEqual({'agent2': 3, 'agent3': 1}, buffer.pending())
+
+        buffer.flush_due(now=time.time() + 60)
+        self.assertEqual([(AGENT2.inbox_url, ['./0.json', './1.json', './2.json']),
+                          (AGENT3.inbox_url, ['./3.json'])], self._posted())
+        buffer.close()
+
+    def test_count_threshold_flushes_at_once(self):
+        buffer = CoalescingBuffer(self.external_api, max_delay=60, max_messages=2)
+        results = buffer.add([AGENT2], updated_file(0))
+        self.assertIsNone(results[0].status_code)
+
+        results = buffer.add([AGENT2], updated_file(1))
+        self.assertEqual(200, results[0].status_code)
+        self.assertEqual([(AGENT2.inbox_url, ['./0.json', './1.json'])], self._posted())
+        buffer.close()
+
+    def test_background_flusher_bounds_latency(self):
+        buffer = CoalescingBuffer(self.external_api, max_delay=0.05)
+        buffer.add([AGENT2, AGENT3], updated_file(0))
+
+        deadline = time.time() + 5
+        while self.external_api.add_to_inbox.call_count < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(2, self.external_api.add_to_inbox.call_count)
+        buffer.close()
+
+    def test_buffered_files_survive_a_restart(self):
+        buffer = CoalescingBuffer(self.external_api, path=self.path, max_delay=60)
+        buffer.add([AGENT2], updated_file(0))
+        buffer.add([AGENT2, AGENT3], updated_file(1))
+        buffer.flush_due(now=time.time() + 60)
+        buffer.add([AGENT3], updated_file(2))
+        # The process dies without closing the buffer
+        buffer._log.close()
+
+        restarted = CoalescingBuffer(self.external_api, path=self.path, max_delay=60)
+        self.assertEqual({'agent3': 1}, restarted.pending())
+        restarted.flush_all()
+        self.assertEqual((AGENT3.inbox_url, ['./2.json']), self._posted()[-1])
+        restarted.close()
+
+        reopened = CoalescingBuffer(self.external_api, path=self.path)
+        self.assertEqual({}, reopened.pending())
+        reopened.close()
+
+    def test_failed_batches_are_retried_then_dropped(self):
+        self.external_api.add_to_inbox.side_effect = Exception("Connection refused")
+        buffer = CoalescingBuffer(self.external_api, max_delay=60, max_attempts=2)
+        buffer.add([AGENT2], updated_file(0))
+
+        self.assertEqual("Connection refused", buffer.flush_all()[0].error)
+        self.assertEqual({'agent2': 1}, buffer.pending())
+        buffer.flush_all()
+        self.assertEqual({}, buffer.pending())
+        self.assertEqual(1, buffer.stats()['files_dropped'])
+        buffer.close()
+
+    def test_attempts_survive_a_restart_and_dropped_files_are_handed_over(self):
+        self.external_api.add_to_inbox.side_effect = Exception("Connection refused")
+        dropped = []
+        buffer = CoalescingBuffer(self.external_api, path=self.path, max_delay=60, max_attempts=2)
+        buffer.add([AGENT2], updated_file(0))
+        buffer.flush_all()
+        buffer._log.close()
+
+        restarted = CoalescingBuffer(self.external_api, path=self.path, max_delay=60, max_attempts=2,
+                                     on_drop=lambda agent, files, error: dropped.append((agent, files, error)))
+        restarted.flush_all()
+
+        self.assertEqual([('agent2', [updated_file(0)], "Connection refused")], dropped)
+        restarted.close()
+
+    def test_batches_that_are_not_due_carry_over_to_the_next_run(self):
+        buffer = CoalescingBuffer(self.external_api, path=self.path, max_delay=60)
+        buffer.add([AGENT2, AGENT3], updated_file(0))
+        buffer.close()
+        self.external_api.add_to_inbox.assert_not_called()
+
+        # The file is logged once, with both of its routes
+        with open(self.path) as log:
+            records = [json.loads(line) for line in log]
+        self.assertEqual([['agent2', 'agent3']], [[route['agent'] for route in record['routes']] for record in records])
+
+        next_run = CoalescingBuffer(self.external_api, path=self.path, max_delay=60)
+        next_run.add([AGENT2], updated_file(1))
+        next_run.flush_due(now=time.time() + 60)
+        next_run.close()
+        self.assertEqual([(AGENT2.inbox_url, ['./0.json', './1.json']), (AGENT3.inbox_url, ['./0.json'])],
+                         self._posted())
+
+    def test_close_without_a_log_posts_every_batch(self):
+        buffer = CoalescingBuffer(self.external_api, max_delay=60)
+        buffer.add([AGENT2], updated_file(0))
+        buffer.close()
+
+        self.assertEqual([(AGENT2.inbox_url, ['./0.json'])], self._posted())
+
+
+class TestCoalescedDelivery(unittest.TestCase):
+    def test_messages_for_one_recipient_arrive_as_one_batch(self):
+        city_api = MagicMock(spec=CityAPI)
+        city_api.get_cities.return_value = {'addresses': [
+            {'agent1': 'http://agent1/api/WAKEUP/', 'agent2': 'http://agent2/api/WAKEUP/'}
+        ]}
+        external_api = MagicMock(spec=ExternalAPI)
+        external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        external_api.collect_from_outbox.side_effect = lambda url: [
+            Message(from_address='agent1', to_address='agent2', data=f'update {i}', id=i) for i in range(5)
+        ] if url.startswith('http://agent1') else []
+
+        coalescer = CoalescingBuffer(external_api, max_delay=60)
+        service = MessageService(city_api, external_api, coalescer=coalescer)
+        service.process_messages()
+        external_api.add_to_inbox.assert_not_called()
+        coalescer.close()
+        service.fanout.close()
+
+        external_api.add_to_inbox.assert_called_once()
+        url, blob = external_api.add_to_inbox.call_args[0]
+        self.assertEqual('http://agent2/api/RECEIVE_POST/', url)
+        contents = [json.loads(entry['file_content'])['data'] for entry in blob['updated_files']]
+        self.assertEqual(sorted(f'update {i}' for i in range(5)), sorted(contents))
+
+
+if __name__ == '__main__':
+    unittest.main()
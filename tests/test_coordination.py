@@ -0,0 +1,135 @@
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from sqlalchemy import create_engine
+
+from src.city_api import CityAPI
+from src.coordination import LeaseCoordinator, AgentLease
+from src.external_api import ExternalAPI
+from src.message_repository import Base
+from src.message_service import MessageService
+
+
+class TestLeaseCoordinator(unittest.TestCase):
+    def setUp(self):
+        """Share one SQLite file between two coordinators acting as separate instances"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.tmpdir.name, 'leases.db')}")
+        Base.metadata.create_all(self.engine)
+
+        self.instance_a = LeaseCoordinator(engine=self.engine, owner='host-a', ttl_seconds=300)
+        self.instance_b = LeaseCoordinator(engine=self.engine, owner='host-b', ttl_seconds=300)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def test_instances_claim_disjoint_agents(self):
+        claimed_a = self.instance_a.claim(['agent1', 'agent2'])
+        claimed_b = self.instance_b.claim(['agent1', 'agent2', 'agent3'])
+
+        self.assertEqual(['agent1', 'agent2'], claimed_a)
+        self.assertEqual(['agent3'], claimed_b)
+
+    def test_capped_instances_share_agents(self):
+        agents = [f'agent{i}' for i in range(10)]
+        self.instance_a.max_agents = 4
+        self.instance_b.max_agents = 4
+
+        claimed_a = self.instance_a.claim(agents)
+        claimed_b = self.instance_b.claim(agents)
+
+        self.assertEqual(4, len(claimed_a))
+        self.assertEqual(4, len(claimed_b))
+        self.assertFalse(set(claimed_a) & set(claimed_b))
+        # The next cycle renews the same agents rather than taking new ones
+        self.assertEqual(sorted(claimed_a), sorted(self.instance_a.claim(agents)))
+
+    def test_capped_instances_rotate_through_agents(self):
+        agents = [f'agent{i}' for i in range(6)]
+        self.instance_a.max_agents = 2
+        polled = []
+        for _ in range(3):
+            claimed = self.instance_a.claim(agents)
+            polled.extend(claimed)
+            self.instance_a.release(claimed)
+
+        # Least recently polled first: every agent is polled once before any is polled again
+        self.assertEqual(sorted(agents), sorted(polled))
+        self.assertEqual(sorted(polled[:2]), sorted(self.instance_a.claim(agents)))
+
+    def test_agents_whose_lease_was_lost_are_not_collected(self):
+        city_api = MagicMock(spec=CityAPI)
+        external_api = MagicMock(spec=ExternalAPI)
+        city_api.get_cities.return_value = {
+            'addresses': [{'agent1': 'http://agent1/api/WAKEUP', 'agent2': 'http://agent2/api/WAKEUP'}]
+        }
+        external_api.collect_from_outbox.return_value = []
+        instance = LeaseCoordinator(engine=self.engine, owner='host-c', ttl_seconds=0.3)
+        service = MessageService(city_api, external_api, coordinator=instance)
+        instance.claim(['agent1', 'agent2'])
+        stop_renewing = service._renew_leases(['agent1', 'agent2'])
+        # Another instance takes agent2 over, e.g. after this one stalled past the TTL
+        with self.engine.begin() as conn:
+            conn.execute(AgentLease.__table__.update().where(AgentLease.agent_name == 'agent2')
+                         .values(owner='host-b'))
+        time.sleep(0.25)
+        stop_renewing.set()
+
+        self.assertEqual({'agent2'}, service.lost_leases)
+        self.assertEqual([], list(service._collect_stage(('agent2', 'http://agent2/api/WAKEUP'))))
+        external_api.collect_from_outbox.assert_not_called()
+
+    def test_renew_extends_only_own_leases(self):
+        self.instance_a.claim(['agent1'])
+        self.instance_b.claim(['agent2'])
+        with self.engine.begin() as conn:
+            conn.execute(AgentLease.__table__.update().values(expires_at=datetime(2000, 1, 1)))
+
+        self.assertEqual(['agent1'], self.instance_a.renew(['agent1', 'agent2']))
+        self.assertEqual([], self.instance_b.claim(['agent1']))
+        self.assertEqual(['agent2'], self.instance_a.claim(['agent2']))
+
+    def test_owner_can_renew_its_own_lease(self):
+        self.instance_a.claim(['agent1'])
+        self.assertEqual(['agent1'], self.instance_a.claim(['agent1']))
+
+    def test_release_makes_agents_claimable(self):
+        self.instance_a.claim(['agent1'])
+        self.instance_a.release(['agent1'])
+
+        self.assertEqual(['agent1'], self.instance_b.claim(['agent1']))
+
+    def test_expired_lease_is_taken_over(self):
+        self.instance_a.claim(['agent1'])
+
+        # Simulate a crashed instance whose lease ran out
+        with self.engine.begin() as conn:
+            conn.execute(AgentLease.__table__.update().values(expires_at=datetime(2000, 1, 1)))
+
+        self.assertEqual(['agent1'], self.instance_b.claim(['agent1']))
+        self.assertEqual([], self.instance_a.claim(['agent1']))
+
+    def test_service_only_polls_claimed_outboxes(self):
+        city_api = MagicMock(spec=CityAPI)
+        external_api = MagicMock(spec=ExternalAPI)
+        city_api.get_cities.return_value = {
+            'addresses': [{'agent1': 'http://agent1/api/WAKEUP', 'agent2': 'http://agent2/api/WAKEUP'}]
+        }
+        external_api.collect_from_outbox.return_value = []
+
+        self.instance_b.claim(['agent2'])
+        service = MessageService(city_api, external_api, coordinator=self.instance_a)
+        service.process_messages()
+
+        external_api.collect_from_outbox.assert_called_once_with('http://agent1/api/WAKEUP')
+        # Leases are released at the end of the cycle
+        self.assertEqual(['agent1'], self.instance_b.claim(['agent1']))
+
+
+if __name__ == '__main__':
+    unittest.main()
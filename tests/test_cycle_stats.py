@@ -0,0 +1,115 @@
+import random
+import unittest
+from unittest.mock import MagicMock
+
+from src.city_api import CityAPI
+from src.cycle_stats import CountMinSketch, CycleStats, TopK
+from src.external_api import ExternalAPI
+from src.message import Message
+from src.message_service import MessageService
+
+
+class TestCountMinSketch(unittest.TestCase):
+    def test_estimates_never_undercount(self):
+        sketch = CountMinSketch(width=64, depth=4)
+        counts = {}
+        rng = random.Random(7)
+        for _ in range(5000):
+            key = f"agent{int(rng.paretovariate(1.2)) % 500}"
+            counts[key] = counts.get(key, 0) + 1
+            sketch.add(key)
+
+        for key, count in counts.items():
+            self.assertGreaterEqual(sketch.estimate(key), count)
+        self.assertEqual(5000, sketch.total)
+        # The heavy hitter is estimated within the error bound of 2 * total / width
+        heaviest = max(counts, key=counts.get)
+        self.assertLessEqual(sketch.estimate(heaviest), counts[heaviest] + 2 * 5000 / 64)
+
+
+class TestTopK(unittest.TestCase):
+    def test_keeps_the_k_largest(self):
+        top = TopK(k=3)
+        for count in range(1, 20):
+            for key in ('a', 'b', 'c', 'd', 'e'):
+                top.offer(key, count * ord(key))
+        self.assertEqual(['e', 'd', 'c'], [key for key, _ in top.items()])
+        self.assertLessEqual(len(top._heap), 4 * top.k)
+
+
+class TestCycleStats(unittest.TestCase):
+    def test_memory_is_bounded_by_top_k(self):
+        stats = CycleStats(top_k=5)
+        for n in range(10000):
+            stats.record_message([f"agent{n}", 'hub'])
+            stats.record_delivery(f"sender{n % 3}", delivered=n % 10 != 0)
+
+        snapshot = stats.snapshot()
+        self.assertEqual(10000, snapshot['messages'])
+        self.assertEqual(9000, snapshot['deliveries'])
+        self.assertEqual(1000, snapshot['failed_deliveries'])
+        self.assertEqual(5, len(snapshot['top_recipients']))
+        hub, count = snapshot['top_recipients'][0]
+        self.assertEqual('hub', hub)
+        self.assertGreaterEqual(count, 10000)
+        self.assertEqual(['sender0', 'sender1', 'sender2'], sorted(name for name, _ in snapshot['top_senders']))
+
+    def test_reset_returns_the_period_and_starts_over(self):
+        stats = CycleStats()
+        stats.record_message(['agent2', 'agent2', 'agent3'])
+        stats.record_delivery('agent1', delivered=True)
+
+        ended = stats.reset()
+        self.assertEqual(1, ended['messages'])
+        self.assertEqual(2, ended['recipients'])
+        self.assertEqual([('agent1', 1)], ended['top_senders'])
+        self.assertEqual(0, stats.snapshot()['messages'])
+        self.assertEqual([], stats.snapshot()['top_recipients'])
+        self.assertEqual(0, stats.sent_by('agent1'))
+
+
+class TestServiceStats(unittest.TestCase):
+    def test_process_messages_records_the_cycle(self):
+        city_api = MagicMock(spec=CityAPI)
+        city_api.get_cities.return_value = {'addresses': [
+            {'agent1': 'http://agent1/api/WAKEUP/', 'agent2': 'http://agent2/api/WAKEUP/'}
+        ]}
+        external_api = MagicMock(spec=ExternalAPI)
+        external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        external_api.collect_from_outbox.side_effect = lambda url: [
+            Message(from_address='agent1', to_address='agent2,agent3', data='hello', id=1)
+        ] if url.startswith('http://agent1') else []
+
+        service = MessageService(city_api, external_api)
+        service.process_messages()
+        service.fanout.close()
+
+        snapshot = service.cycle_stats.reset()
+        self.assertEqual(1, snapshot['messages'])
+        self.assertEqual(1, snapshot['deliveries'])
+        self.assertEqual([('agent1', 1)], snapshot['top_senders'])
+        self.assertEqual([('agent2', 1), ('agent3', 1)], snapshot['top_recipients'])
+        self.assertEqual(0, service.cycle_stats.addressed_to('agent2'))
+
+    def test_rejected_post_is_not_a_delivery(self):
+        city_api = MagicMock(spec=CityAPI)
+        city_api.get_cities.return_value = {'addresses': [
+            {'agent1': 'http://agent1/api/WAKEUP/', 'agent2': 'http://agent2/api/WAKEUP/'}
+        ]}
+        external_api = MagicMock(spec=ExternalAPI)
+        external_api.add_to_inbox.return_value = MagicMock(status_code=422)
+        external_api.collect_from_outbox.side_effect = lambda url: [
+            Message(from_address='agent1', to_address='agent2', data='hello', id=1)
+        ] if url.startswith('http://agent1') else []
+
+        service = MessageService(city_api, external_api)
+        service.process_messages()
+        service.fanout.close()
+
+        snapshot = service.cycle_stats.reset()
+        self.assertEqual(0, snapshot['deliveries'])
+        self.assertEqual(1, snapshot['failed_deliveries'])
+
+
+if __name__ == '__main__':
+    unittest.main()
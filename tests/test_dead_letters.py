@@ -0,0 +1,121 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from sqlalchemy import create_engine
+
+from src.city_api import CityAPI
+from src.coalescing import CoalescingBuffer
+from src.dead_letters import DELIVERY_FAILED, UNRESOLVED, DeadLetterStore
+from src.external_api import ExternalAPI
+from src.idempotency import inbox_path, message_key, recipient_key
+from src.message import Message
+from src.message_repository import Base
+from src.message_service import MessageService
+
+
+class TestDeadLetters(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.tmpdir.name, 'dead_letters.db')}")
+        Base.metadata.create_all(self.engine)
+        self.store = DeadLetterStore(engine=self.engine)
+
+        self.city_api = MagicMock(spec=CityAPI)
+        self.city_api.get_cities.return_value = {'addresses': [{'agent0': 'http://agent0/api/WAKEUP',
+                                                                'agent1': 'http://agent1/api/WAKEUP'}]}
+        self.external_api = MagicMock(spec=ExternalAPI)
+        self.external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        self.message = Message(from_address='agent0', to_address='agent1, latecomer', data='hello', id=3)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def _service(self):
+        return MessageService(self.city_api, self.external_api, dead_letters=self.store)
+
+    def test_repeated_failures_count_attempts(self):
+        self.store.record(self.message, ['agent1'], DELIVERY_FAILED, 'Connection refused')
+        self.store.record(self.message, ['agent1', 'agent2'], DELIVERY_FAILED, 'HTTP 503')
+
+        letters = self.store.batch()
+        self.assertEqual([('agent1', 2, 'HTTP 503'), ('agent2', 1, 'HTTP 503')],
+                         [(letter.recipient, letter.attempts, letter.last_error) for letter in letters])
+        self.assertEqual(self.message, letters[0].message)
+        self.assertEqual(message_key(self.message), letters[0].message.delivery_key)
+        self.assertEqual([letters[1].id], [letter.id for letter in self.store.batch(max_attempts=2)])
+
+        self.store.remove([letters[0].id])
+        self.assertEqual({DELIVERY_FAILED: 1}, self.store.counts())
+
+    def test_cycle_records_unresolved_and_failed_recipients(self):
+        self.external_api.collect_from_outbox.side_effect = lambda url: [self.message] if 'agent0' in url else []
+        self.external_api.add_to_inbox.return_value = MagicMock(status_code=503)
+
+        self._service().process_messages()
+
+        letters = {letter.recipient: letter for letter in self.store.batch()}
+        self.assertEqual(UNRESOLVED, letters['latecomer'].reason)
+        self.assertEqual(DELIVERY_FAILED, letters['agent1'].reason)
+        self.assertEqual('HTTP 503', letters['agent1'].last_error)
+
+    def test_files_the_coalescing_buffer_gives_up_on_are_recorded(self):
+        self.external_api.collect_from_outbox.side_effect = lambda url: [self.message] if 'agent0' in url else []
+        self.external_api.add_to_inbox.return_value = MagicMock(status_code=503)
+        coalescer = CoalescingBuffer(self.external_api, max_delay=60, max_attempts=1)
+
+        MessageService(self.city_api, self.external_api, coalescer=coalescer, dead_letters=self.store).process_messages()
+        coalescer.close()
+
+        letters = {letter.recipient: letter for letter in self.store.batch()}
+        self.assertEqual(DELIVERY_FAILED, letters['agent1'].reason)
+        self.assertEqual('HTTP 503', letters['agent1'].last_error)
+        self.assertEqual(message_key(self.message), letters['agent1'].message.delivery_key)
+        self.assertIsNone(letters['agent1'].message.delivered_at)
+
+    def test_later_deliveries_remove_the_letter(self):
+        self.external_api.collect_from_outbox.side_effect = lambda url: [self.message] if 'agent0' in url else []
+        self.external_api.add_to_inbox.return_value = MagicMock(status_code=503)
+        self._service().process_messages()
+
+        # The sender still has the message in its outbox, and the next cycle delivers it
+        self.external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        self._service().process_messages()
+
+        self.assertEqual(['latecomer'], [letter.recipient for letter in self.store.batch()])
+
+    def test_reprocessing_redelivers_in_batches(self):
+        self.store.record(self.message, ['latecomer'], UNRESOLVED, 'recipient could not be resolved')
+        self.store.record(self.message, ['agent1'], DELIVERY_FAILED, 'Connection refused')
+        for n in range(5):
+            self.store.record(Message(from_address='agent0', to_address='agent1', data=f'backlog {n}'), ['agent1'],
+                              DELIVERY_FAILED, 'Connection refused')
+        self.city_api.get_cities.return_value['addresses'][0]['latecomer'] = 'http://latecomer/api/WAKEUP'
+
+        counts = self._service().reprocess_dead_letters(batch_size=2)
+
+        self.assertEqual({'delivered': 7, 'failed': 0, 'unresolved': 0}, counts)
+        self.assertEqual({}, self.store.counts())
+        # The retry writes the same inbox file under the same idempotency key
+        calls = {call_args[0][0]: call_args for call_args in self.external_api.add_to_inbox.call_args_list
+                 if json.loads(call_args[0][1])['updated_files'][0]['path'] == inbox_path(self.message)}
+        self.assertEqual({'http://agent1/api/RECEIVE_POST', 'http://latecomer/api/RECEIVE_POST'}, set(calls))
+        self.assertEqual(recipient_key(message_key(self.message), 'latecomer'),
+                         calls['http://latecomer/api/RECEIVE_POST'][1]['idempotency_key'])
+
+    def test_letters_that_fail_again_stay(self):
+        self.store.record(self.message, ['latecomer'], UNRESOLVED, 'recipient could not be resolved')
+        self.store.record(self.message, ['agent1'], DELIVERY_FAILED, 'Connection refused')
+        self.external_api.add_to_inbox.side_effect = Exception("Connection refused")
+
+        counts = self._service().reprocess_dead_letters()
+
+        self.assertEqual({'delivered': 0, 'failed': 1, 'unresolved': 1}, counts)
+        self.assertEqual([2, 2], [letter.attempts for letter in self.store.batch()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
+import gzip
+import json
 import unittest
 
 import pytest
 from src.external_api import ExternalAPI
+from src.metrics import Metrics
 from unittest.mock import patch, Mock
 import requests
 
@@ -77,5 +80,72 @@ class TestExternalAPI(unittest.TestCase):
             with pytest.raises(Exception):
                 external_api.add_to_inbox("test_url", {"data": "test"})
 
+
+class TestExternalAPICompression(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.outbox = {
+            "data": [
+                {"result": [
+                    {"file_content": {"message": {"data": "x" * 2000, "from": "sender", "to": "recipient"}},
+                     "path": "message1.json"}
+                ]}
+            ]
+        }
+
+    def test_collect_negotiates_and_inflates_gzip(self):
+        with patch('requests.post') as mock_post:
+            wire = gzip.compress(json.dumps(self.outbox).encode('utf-8'))
+            mock_post.return_value.headers = {'Content-Encoding': 'gzip'}
+            mock_post.return_value.raw.read.return_value = wire
+
+            api = ExternalAPI("test_token", metrics=self.metrics)
+            messages = api.collect_from_outbox("http://agent1/api/WAKEUP/")
+
+            self.assertEqual("x" * 2000, messages[0].data)
+            self.assertEqual('gzip, deflate', mock_post.call_args.kwargs['headers']['Accept-Encoding'])
+            mock_post.return_value.raw.read.assert_called_once_with(decode_content=False)
+
+            snapshot = self.metrics.snapshot()
+            self.assertEqual(len(wire), snapshot['counters']['outbox.bytes_wire'])
+            self.assertLess(snapshot['observations']['outbox.compression_ratio']['mean'], 0.1)
+            self.assertIn('outbox.decompress_seconds', snapshot['observations'])
+
+    def test_collect_accepts_identity_responses(self):
+        with patch('requests.post') as mock_post:
+            mock_post.return_value.headers = {}
+            mock_post.return_value.raw.read.return_value = json.dumps(self.outbox).encode('utf-8')
+
+            api = ExternalAPI("test_token", metrics=self.metrics)
+            messages = api.collect_from_outbox("http://agent1/api/WAKEUP/")
+
+            self.assertEqual(1, len(messages))
+            self.assertNotIn('outbox.compression_ratio', self.metrics.snapshot()['observations'])
+
+    def test_large_inbox_bodies_are_gzipped(self):
+        with patch('requests.post') as mock_post:
+            mock_post.return_value.status_code = 200
+            api = ExternalAPI("test_token", compress_threshold=1024, metrics=self.metrics)
+            payload = json.dumps({"updated_files": [{"path": "./a.json", "file_content": "y" * 4096}]}).encode('utf-8')
+
+            api.add_to_inbox("http://agent1/api/RECEIVE_POST/", payload)
+
+            kwargs = mock_post.call_args.kwargs
+            self.assertEqual('gzip', kwargs['headers']['Content-Encoding'])
+            self.assertEqual(payload, gzip.decompress(kwargs['data']))
+            self.assertEqual(1, self.metrics.snapshot()['counters']['inbox.requests_gzip'])
+
+    def test_small_inbox_bodies_are_sent_as_is(self):
+        with patch('requests.post') as mock_post:
+            mock_post.return_value.status_code = 200
+            api = ExternalAPI("test_token", compress_threshold=1024, metrics=self.metrics)
+
+            api.add_to_inbox("http://agent1/api/RECEIVE_POST/", {"data": "test"})
+
+            kwargs = mock_post.call_args.kwargs
+            self.assertNotIn('Content-Encoding', kwargs['headers'])
+            self.assertEqual({"data": "test"}, json.loads(kwargs['data']))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from src.city_api import CityAPI
+from src.external_api import ExternalAPI
+from src.fanout import BroadcastFanout
+from src.idempotency import inbox_path
+from src.message import Message
+from src.message_service import MessageService
+from src.routing import Route
+
+
+class TestBroadcastFanout(unittest.TestCase):
+    def setUp(self):
+        self.external_api = MagicMock(spec=ExternalAPI)
+        self.external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        self.fanout = BroadcastFanout(self.external_api, max_workers=4)
+        self.routes = [Route(f'FRBG/agent{i}', f'http://agent{i}/api/RECEIVE_POST/') for i in range(4)]
+        self.message = Message(from_address='FRBG/cityhall', to_address='FRBG/*', data='Town meeting', id=7)
+
+    def tearDown(self):
+        self.fanout.close()
+
+    def test_every_recipient_gets_the_same_bytes(self):
+        self.fanout.deliver(self.message, self.routes)
+
+        payloads = [call_args[0][1] for call_args in self.external_api.add_to_inbox.call_args_list]
+        self.assertEqual(4, len(payloads))
+        self.assertTrue(all(payload is payloads[0] for payload in payloads))
+
+        blob = json.loads(payloads[0])
+        updated_file = blob['updated_files'][0]
+        self.assertEqual(inbox_path(self.message), updated_file['path'])
+        self.assertIsNotNone(json.loads(updated_file['file_content'])['delivered_at'])
+        # Stamping the message is left to the caller, which knows which posts succeeded
+        self.assertIsNone(self.message.delivered_at)
+
+    def test_message_is_serialized_once(self):
+        self.message.to_dict = MagicMock(wraps=self.message.to_dict)
+        self.fanout.deliver(self.message, self.routes)
+        self.message.to_dict.assert_called_once()
+
+    def test_results_track_each_recipient(self):
+        def add_to_inbox(url, payload, idempotency_key=None):
+            if url.startswith('http://agent2'):
+                raise Exception("Connection refused")
+            return MagicMock(status_code=200)
+        self.external_api.add_to_inbox.side_effect = add_to_inbox
+
+        results = self.fanout.deliver(self.message, self.routes)
+
+        self.assertEqual([route.agent_name for route in self.routes], [result.agent_name for result in results])
+        self.assertEqual([True, True, False, True], [result.ok for result in results])
+        self.assertEqual("Connection refused", results[2].error)
+        self.assertTrue(all(result.delivered_at is not None for result in results))
+
+    def test_recipients_are_delivered_in_parallel(self):
+        barrier = threading.Barrier(len(self.routes), timeout=5)
+
+        def add_to_inbox(url, payload, idempotency_key=None):
+            barrier.wait()
+            return MagicMock(status_code=200)
+        self.external_api.add_to_inbox.side_effect = add_to_inbox
+
+        start = time.monotonic()
+        results = self.fanout.deliver(self.message, self.routes)
+
+        self.assertTrue(all(result.ok for result in results))
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_message_is_stamped_by_its_first_successful_post(self):
+        service = MessageService(MagicMock(spec=CityAPI), self.external_api)
+        self.external_api.add_to_inbox.return_value = MagicMock(status_code=503)
+        service._deliver_stage((self.message, self.routes, service.fanout.encode(self.message)))
+        self.assertIsNone(self.message.delivered_at)
+
+        self.external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        service._deliver_stage((self.message, self.routes, service.fanout.encode(self.message)))
+        self.assertIsNotNone(self.message.delivered_at)
+        service.fanout.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from src.city_api import CityAPI
+from src.external_api import ExternalAPI
+from src.fanout import BroadcastFanout
+from src.idempotency import IDEMPOTENCY_HEADER, inbox_path, message_key, recipient_key
+from src.journal import Journal
+from src.message import Message
+from src.message_service import MessageService
+from src.payload import SpooledData
+from src.routing import Route
+
+CREATED_AT = datetime(2025, 3, 1, 9, 30)
+
+
+class TestIdempotencyKeys(unittest.TestCase):
+    def _message(self, data='hello', **kwargs):
+        return Message(from_address='agent0', to_address='agent1, agent2', data=data, id=5,
+                       created_at=CREATED_AT, **kwargs)
+
+    def test_keys_depend_on_content_only(self):
+        first, again = self._message(), self._message(delivered_at=datetime.now())
+        self.assertEqual(message_key(first), message_key(again))
+        self.assertNotEqual(message_key(first), message_key(self._message(data='hello!')))
+        self.assertEqual(message_key(first), message_key(self._message(data=SpooledData.from_text('hello'))))
+
+        self.assertNotEqual(recipient_key(message_key(first), 'agent1'), recipient_key(message_key(first), 'agent2'))
+        self.assertEqual(recipient_key(message_key(first), 'agent1'), recipient_key(message_key(again), 'agent1'))
+
+    def test_recollected_messages_keep_their_key(self):
+        api = ExternalAPI('token')
+        undated = [{'file_content': {'message': {'id': 5, 'from': 'agent0', 'to': 'agent1', 'data': 'hello'}}}]
+        first, again = api.parse_outbox(undated, 'test')[0], api.parse_outbox(undated, 'test')[0]
+        self.assertIsNotNone(first.created_at)
+        self.assertEqual(message_key(first), message_key(again))
+
+        # The same creation time as an ISO string and as a datetime
+        self.assertEqual(message_key(self._message()),
+                         message_key(Message(from_address='agent0', to_address='agent1, agent2', data='hello', id=5,
+                                             created_at=CREATED_AT.isoformat())))
+
+    def test_simultaneous_deliveries_get_distinct_files(self):
+        fanout = BroadcastFanout(MagicMock(spec=ExternalAPI))
+        stamped = datetime.now()
+        paths = set()
+        for n in range(100):
+            msg = Message(from_address='agent0', to_address='agent1', data=f'message {n}', created_at=stamped)
+            paths.add(fanout.updated_file(msg)['path'])
+        self.assertEqual(100, len(paths))
+
+    def test_retries_reuse_path_and_header(self):
+        external_api = MagicMock(spec=ExternalAPI)
+        external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        fanout = BroadcastFanout(external_api)
+        routes = [Route('agent1', 'http://agent1/api/RECEIVE_POST/'), Route('agent2', 'http://agent2/api/RECEIVE_POST/')]
+
+        fanout.deliver(self._message(), routes)
+        fanout.deliver(self._message(), routes)
+        fanout.close()
+
+        calls = external_api.add_to_inbox.call_args_list
+        keys = [call_args[1]['idempotency_key'] for call_args in calls]
+        self.assertEqual(keys[:2], keys[2:])
+        self.assertEqual(2, len(set(keys)))
+        paths = {json.loads(call_args[0][1])['updated_files'][0]['path'] for call_args in calls}
+        self.assertEqual({inbox_path(self._message())}, paths)
+
+    def test_header_is_sent(self):
+        http = MagicMock()
+        ExternalAPI('token', http=http).add_to_inbox('http://agent1/api/RECEIVE_POST/', b'{}', idempotency_key='abc')
+        self.assertEqual('abc', http.post.call_args[1]['headers'][IDEMPOTENCY_HEADER])
+
+    def test_recovered_message_keeps_its_key(self):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = Journal(os.path.join(directory, 'exchange.journal'))
+            self.addCleanup(journal.close)
+            # The journaled key is used as is, not derived again from the recovered message
+            msg = self._message()
+            key = msg.delivery_key = 'f' * 32
+            journal.record_collected(msg)
+            journal.record_delivered(msg.journal_key, 'agent1')
+
+            city_api = MagicMock(spec=CityAPI)
+            city_api.get_cities.return_value = {
+                'addresses': [{'agent1': 'http://agent1/api/WAKEUP', 'agent2': 'http://agent2/api/WAKEUP'}]
+            }
+            external_api = MagicMock(spec=ExternalAPI)
+            external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+            external_api.collect_from_outbox.return_value = []
+            MessageService(city_api, external_api, journal=journal).process_messages()
+
+            url, payload = external_api.add_to_inbox.call_args[0]
+            self.assertEqual('http://agent2/api/RECEIVE_POST', url)
+            self.assertEqual(f"./{key}.json", json.loads(payload)['updated_files'][0]['path'])
+            self.assertEqual(recipient_key(key, 'agent2'), external_api.add_to_inbox.call_args[1]['idempotency_key'])
+
+
+if __name__ == '__main__':
+    unittest.main()
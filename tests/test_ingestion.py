@@ -0,0 +1,160 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app as app_module
+from src.city_api import CityAPI
+from src.external_api import ExternalAPI
+from src.ingestion import IngestionWorker, outbox_entries, token_matches
+from src.journal import Journal
+from src.message import Message
+from src.message_service import MessageService
+
+
+class TestIngestionHelpers(unittest.TestCase):
+    def test_token_matches_bearer_header(self):
+        self.assertTrue(token_matches('Bearer secret', 'secret'))
+        self.assertTrue(token_matches('bearer secret', 'secret'))
+        self.assertFalse(token_matches('Bearer wrong', 'secret'))
+        self.assertFalse(token_matches('secret', 'secret'))
+        self.assertFalse(token_matches(None, 'secret'))
+        self.assertFalse(token_matches('Bearer ', None))
+
+    def test_outbox_entries_accepts_messages_and_outbox_trees(self):
+        message = {'from': 'agent1', 'to': 'agent2', 'data': 'hi'}
+        self.assertEqual([{'file_content': {'message': message}}], outbox_entries({'message': message}))
+        self.assertEqual(2, len(outbox_entries({'messages': [message, message]})))
+        tree = {'data': [{'path': 'a.json', 'file_content': {'message': message}}]}
+        self.assertEqual([tree], outbox_entries(tree))
+        self.assertIsNone(outbox_entries(None))
+        self.assertIsNone(outbox_entries("hi"))
+
+
+class TestDeliverPushedMessages(unittest.TestCase):
+    def setUp(self):
+        self.city_api = MagicMock(spec=CityAPI)
+        self.city_api.get_cities.return_value = {'addresses': [
+            {'agent1': 'http://agent1/api/RECEIVE_POST/', 'agent2': 'http://agent2/api/RECEIVE_POST/'}
+        ]}
+        self.external_api = MagicMock(spec=ExternalAPI)
+        self.external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        self.service = MessageService(self.city_api, self.external_api)
+
+    def tearDown(self):
+        self.service.fanout.close()
+
+    def test_pushed_messages_are_delivered_without_polling(self):
+        self.service.deliver_messages([Message(from_address='agent1', to_address='agent2', data='hi', id=1)])
+
+        self.external_api.collect_from_outbox.assert_not_called()
+        self.external_api.add_to_inbox.assert_called_once()
+        self.assertEqual('http://agent2/api/RECEIVE_POST/', self.external_api.add_to_inbox.call_args[0][0])
+
+    def test_directory_is_reused_until_it_expires(self):
+        message = Message(from_address='agent1', to_address='agent2', data='hi', id=1)
+        self.service.deliver_messages([message], max_directory_age=60)
+        self.service.deliver_messages([message], max_directory_age=60)
+        self.assertEqual(1, self.city_api.get_cities.call_count)
+
+        self.service.deliver_messages([message], max_directory_age=0)
+        self.assertEqual(2, self.city_api.get_cities.call_count)
+
+    def test_worker_delivers_submitted_batches(self):
+        worker = IngestionWorker(self.service)
+        self.assertTrue(worker.submit([Message(from_address='agent2', to_address='agent1', data='yo', id=2)]))
+        worker.join()
+        worker.close()
+
+        self.assertEqual(1, worker.accepted)
+        self.assertEqual('http://agent1/api/RECEIVE_POST/', self.external_api.add_to_inbox.call_args[0][0])
+
+    def test_accepted_messages_survive_a_restart(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'ingestion.journal')
+            journal = Journal(path)
+            self.service.journal = journal
+            # A worker that dies before delivering what it accepted
+            self.service.deliver_messages = MagicMock()
+            worker = IngestionWorker(self.service)
+            self.assertTrue(worker.submit([Message(from_address='agent2', to_address='agent1', data='yo', id=2)]))
+            worker.close()
+            journal.close()
+
+            restarted = MessageService(self.city_api, self.external_api, journal=Journal(path))
+            IngestionWorker(restarted).close()
+            restarted.journal.close()
+            restarted.fanout.close()
+
+        self.assertEqual('http://agent1/api/RECEIVE_POST/', self.external_api.add_to_inbox.call_args[0][0])
+
+
+class TestIngestionEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.client = app_module.app.test_client()
+        self.worker = MagicMock()
+        self.worker.service.external_api = ExternalAPI(token='secret')
+        self.worker.submit.return_value = True
+        self.patches = [
+            patch.dict(os.environ, {'EXTERNAL_API_TOKEN': 'secret', 'CITY_API_URL': 'http://city/api'}),
+            patch.object(app_module, 'ingestion', self.worker),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def _push(self, payload, token='secret'):
+        return self.client.post('/outbox', data=json.dumps(payload), content_type='application/json',
+                                headers={'Authorization': f'Bearer {token}'})
+
+    def test_requires_the_exchange_token(self):
+        response = self._push({'message': {'from': 'agent1', 'to': 'agent2', 'data': 'hi'}}, token='wrong')
+        self.assertEqual(401, response.status_code)
+        self.worker.submit.assert_not_called()
+
+    def test_pushed_messages_are_queued_and_published(self):
+        subscription = app_module.broker.subscribe(['agent2'])
+        try:
+            response = self._push({'messages': [
+                {'id': 1, 'from': 'agent1', 'to': 'agent2', 'data': 'hi'},
+                {'id': 2, 'from': 'agent1', 'to': 'agent3', 'data': 'hey'},
+            ]})
+            pushed = subscription.get(timeout=0)
+        finally:
+            subscription.close()
+
+        self.assertEqual(202, response.status_code)
+        self.assertEqual(2, response.json['accepted'])
+        messages = self.worker.submit.call_args[0][0]
+        self.assertEqual(['agent2', 'agent3'], [msg.to_address for msg in messages])
+        self.assertEqual('hi', pushed['data'])
+
+    def test_rejects_empty_pushes_and_reports_backpressure(self):
+        self.assertEqual(400, self._push({'messages': []}).status_code)
+
+        self.worker.submit.return_value = False
+        response = self._push({'message': {'from': 'agent1', 'to': 'agent2', 'data': 'hi'}})
+        self.assertEqual(503, response.status_code)
+
+    def test_oversized_pushes_are_refused_before_parsing(self):
+        with patch.dict(app_module.app.config, {'MAX_CONTENT_LENGTH': 1024}):
+            response = self._push({'message': {'from': 'agent1', 'to': 'agent2', 'data': 'x' * 2048}})
+        self.assertEqual(413, response.status_code)
+        self.worker.submit.assert_not_called()
+
+    def test_refuses_pushes_without_a_directory(self):
+        with patch.dict(os.environ, {'CITY_API_URL': ''}):
+            response = self._push({'message': {'from': 'agent1', 'to': 'agent2', 'data': 'hi'}})
+        self.assertEqual(503, response.status_code)
+        self.worker.submit.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from src.city_api import CityAPI
+from src.external_api import ExternalAPI
+from src.journal import Journal
+from src.message import Message
+from src.message_service import MessageService
+from src.payload import SpooledData
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'exchange.journal')
+        self.journal = Journal(self.path)
+
+    def tearDown(self):
+        self.journal.close()
+        self.tmpdir.cleanup()
+
+    def _message(self, to_address='agent1, agent2'):
+        return Message(from_address='agent0', to_address=to_address, data='hello', id=5)
+
+    def test_recover_returns_unfinished_messages(self):
+        finished = self._message()
+        unfinished = self._message()
+        self.journal.record_collected(finished)
+        self.journal.record_collected(unfinished)
+        self.journal.record_delivered(unfinished.journal_key, 'agent1')
+        self.journal.record_done(finished.journal_key)
+
+        pending = Journal(self.path).recover()
+
+        self.assertEqual(1, len(pending))
+        msg, delivered = pending[0]
+        self.assertEqual(unfinished, msg)
+        self.assertEqual(unfinished.journal_key, msg.journal_key)
+        self.assertEqual({'agent1'}, delivered)
+
+    def test_torn_last_line_is_ignored(self):
+        msg = self._message()
+        self.journal.record_collected(msg)
+        with open(self.path, 'a', encoding='utf-8') as journal:
+            journal.write('{"event": "delivered", "key": "')
+
+        self.assertEqual(1, len(Journal(self.path).recover()))
+
+    def test_concurrent_appends_share_fsyncs(self):
+        def append():
+            for _ in range(50):
+                self.journal.record_collected(self._message())
+
+        threads = [threading.Thread(target=append) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(400, self.journal.stats()['records'])
+        self.assertLessEqual(self.journal.stats()['batches'], 400)
+        self.assertEqual(400, len(self.journal.recover()))
+
+    def test_compact_keeps_only_pending_work(self):
+        for _ in range(10):
+            msg = self._message()
+            self.journal.record_collected(msg)
+            self.journal.record_done(msg.journal_key)
+        pending = self._message()
+        self.journal.record_collected(pending)
+
+        self.journal.compact()
+
+        with open(self.path, encoding='utf-8') as journal:
+            self.assertEqual(1, len(journal.readlines()))
+        self.assertEqual(pending.journal_key, self.journal.recover()[0][0].journal_key)
+
+    def test_spooled_bodies_are_journaled_by_reference(self):
+        body = 'x' * 200000
+        msg = Message(from_address='agent0', to_address='agent1', data=SpooledData.from_text(body), id=5)
+        self.journal.record_collected(msg)
+        msg.data.close()
+
+        self.assertLess(os.path.getsize(self.path), 1000)
+        recovered, _ = Journal(self.path).recover()[0]
+        self.assertEqual(body, recovered.data.read())
+        self.assertNotEqual(msg.data.path, recovered.data.path)
+
+        self.journal.record_done(msg.journal_key)
+        self.journal.compact()
+        self.assertEqual([], os.listdir(self.journal.spool_dir))
+        self.assertEqual([], self.journal.recover())
+
+    def test_service_finishes_interrupted_cycle_without_recollecting(self):
+        interrupted = self._message()
+        self.journal.record_collected(interrupted)
+        self.journal.record_delivered(interrupted.journal_key, 'agent1')
+
+        city_api = MagicMock(spec=CityAPI)
+        external_api = MagicMock(spec=ExternalAPI)
+        external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        city_api.get_cities.return_value = {
+            'addresses': [{'agent1': 'http://agent1/api/WAKEUP', 'agent2': 'http://agent2/api/WAKEUP'}]
+        }
+        external_api.collect_from_outbox.return_value = []
+
+        service = MessageService(city_api, external_api, journal=self.journal)
+        service.process_messages()
+
+        urls = [call_args[0][0] for call_args in external_api.add_to_inbox.call_args_list]
+        self.assertEqual(['http://agent2/api/RECEIVE_POST'], urls)
+        self.assertEqual([], self.journal.recover())
+
+    def test_failed_delivery_stays_pending(self):
+        city_api = MagicMock(spec=CityAPI)
+        external_api = MagicMock(spec=ExternalAPI)
+        city_api.get_cities.return_value = {
+            'addresses': [{'agent0': 'http://agent0/api/WAKEUP', 'agent1': 'http://agent1/api/WAKEUP',
+                           'agent2': 'http://agent2/api/WAKEUP'}]
+        }
+        external_api.collect_from_outbox.side_effect = lambda url: [self._message()] if 'agent0' in url else []
+        external_api.add_to_inbox.side_effect = lambda url, payload, idempotency_key=None: MagicMock(
+            status_code=503 if 'agent2' in url else 200)
+
+        MessageService(city_api, external_api, journal=self.journal).process_messages()
+
+        pending = self.journal.recover()
+        self.assertEqual(1, len(pending))
+        self.assertEqual({'agent1'}, set(pending[0][1]))
+
+        # The next cycle's recovery only retries the recipient that failed
+        external_api.collect_from_outbox.side_effect = None
+        external_api.collect_from_outbox.return_value = []
+        external_api.add_to_inbox.side_effect = None
+        external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        external_api.add_to_inbox.reset_mock()
+        MessageService(city_api, external_api, journal=self.journal).process_messages()
+
+        urls = [call_args[0][0] for call_args in external_api.add_to_inbox.call_args_list]
+        self.assertEqual(['http://agent2/api/RECEIVE_POST'], urls)
+        self.assertEqual([], self.journal.recover())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app
+from benchmarks.load_test import InProcessTarget, run_clients, summarize
+
+
+class TestLoadDriver(unittest.TestCase):
+    def test_in_process_run_reports_every_request(self):
+        samples = run_clients(InProcessTarget(app), clients=4, requests_total=101, write_ratio=0.5,
+                              payload_sizes=(16, 2048))
+        summary = summarize(samples, wall_seconds=1.0)
+
+        self.assertEqual(101, summary['all']['requests'])
+        self.assertEqual(101, summary['write']['requests'] + summary['read']['requests'])
+        self.assertGreater(summary['write']['requests'], 0)
+        self.assertEqual(0, summary['all']['errors'])
+        self.assertLessEqual(summary['all']['p50_ms'], summary['all']['p99_ms'])
+
+    def test_failed_requests_count_as_errors(self):
+        class Unavailable:
+            def post_message(self, body):
+                raise ConnectionError("refused")
+
+            def get_messages(self):
+                return False
+
+        summary = summarize(run_clients(Unavailable(), clients=2, requests_total=10), wall_seconds=1.0)
+        self.assertEqual(1.0, summary['all']['error_rate'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -77,7 +77,7 @@ class TestMessageDeliveryPayload(unittest.TestCase):
         # Track the actual URL used when sending the message
         called_with = {}
 
-        def mock_add_to_inbox(url, message):
+        def mock_add_to_inbox(url, message, idempotency_key=None):
             called_with['url'] = url
             called_with['message'] = message
             return True
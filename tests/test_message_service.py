@@ -61,6 +61,7 @@ def test_message_multiple_recipients(self):
     # Iterate through the actual calls and validate their arguments
     for actual_call in actual_calls:
         recipient_url, payload = actual_call[0]  # Unpack `call` arguments
+        payload = json.loads(payload)  # The fan-out sends pre-encoded JSON bytes
 
         # Verify the structure of the payload
         self.assertIn('updated_files', payload)
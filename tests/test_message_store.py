@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from src.message_store import ApiMessage, MemoryMessageStore, SqlMessageStore, create_message_store
+
+
+class TestMessageStores(unittest.TestCase):
+    def test_concurrent_appends_are_all_kept(self):
+        store = MemoryMessageStore()
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(store.append, range(2000)))
+        self.assertEqual(list(range(2000)), sorted(store.all()))
+
+    def test_workers_share_one_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            url = f"sqlite:///{os.path.join(directory, 'api_messages.db')}"
+            # Two stores on one file stand in for two worker processes
+            workers = [SqlMessageStore(url), SqlMessageStore(url)]
+            messages = [{'from': 'agent1', 'to': 'agent2', 'data': f'message {n}'} for n in range(200)]
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(lambda n: workers[n % 2].append(messages[n]), range(len(messages))))
+
+            for store in workers:
+                stored = store.all()
+                self.assertEqual(200, len(stored))
+                self.assertEqual(sorted(m['data'] for m in messages), sorted(m['data'] for m in stored))
+                store.engine.dispose()
+
+    def test_versions_change_with_every_append(self):
+        with tempfile.TemporaryDirectory() as directory:
+            url = f"sqlite:///{os.path.join(directory, 'api_messages.db')}"
+            for store in (MemoryMessageStore(), SqlMessageStore(url)):
+                before = store.version()
+                store.append({'data': 'hello'})
+                version, messages = store.snapshot()
+                self.assertNotEqual(before, version)
+                self.assertEqual(version, store.version())
+                self.assertEqual([{'data': 'hello'}], messages)
+            store.engine.dispose()
+
+    def test_ids_committed_out_of_order_change_the_version(self):
+        store = SqlMessageStore('sqlite://')
+        with store.engine.begin() as conn:
+            conn.execute(ApiMessage.__table__.insert().values(id=10, body='"later"', created_at=datetime.utcnow()))
+        before = store.version()
+        # A transaction that got a lower id commits after the higher one
+        with store.engine.begin() as conn:
+            conn.execute(ApiMessage.__table__.insert().values(id=5, body='"earlier"', created_at=datetime.utcnow()))
+
+        self.assertNotEqual(before, store.version())
+        self.assertEqual(['earlier', 'later'], store.all())
+
+    def test_store_is_chosen_by_url(self):
+        self.assertIsInstance(create_message_store(None), MemoryMessageStore)
+        self.assertIsInstance(create_message_store('memory'), MemoryMessageStore)
+        store = create_message_store('sqlite://')
+        self.assertIsInstance(store, SqlMessageStore)
+        store.append('hello')
+        self.assertEqual(['hello'], store.all())
+
+
+if __name__ == '__main__':
+    unittest.main()
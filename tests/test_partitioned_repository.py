@@ -0,0 +1,139 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+from src.async_message_repository import BackgroundPersistence
+from src.city_api import CityAPI
+from src.external_api import ExternalAPI
+from src.message import Message
+from src.message_service import MessageService
+from src.payload import SpooledData
+from src.partitioned_repository import PartitionedMessageRepository, partition_name, partition_of, shard_url
+
+START = datetime(2025, 5, 1, 8, 0)
+
+
+class TestPartitionedMessageRepository(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_url = f"sqlite:///{os.path.join(self.tmpdir.name, 'agent_post.db')}"
+        self.repository = PartitionedMessageRepository(self.db_url, partitions=4)
+
+    def tearDown(self):
+        asyncio.run(self.repository.dispose())
+        self.tmpdir.cleanup()
+
+    def _messages(self):
+        return [Message(from_address='agent0', to_address=f"agent{n % 3 + 1}; Agent9", data=f"message {n}",
+                        created_at=START + timedelta(minutes=n), collected_at=START + timedelta(minutes=n, seconds=5))
+                for n in range(12)]
+
+    def _shard_rows(self, index):
+        path = shard_url(self.db_url, index)[len('sqlite:///'):]
+        with sqlite3.connect(path) as conn:
+            return conn.execute("SELECT DISTINCT recipient FROM recipient_messages").fetchall()
+
+    def test_recipients_live_in_their_own_shard(self):
+        messages = self._messages()
+
+        async def scenario():
+            await self.repository.save_many(messages)
+            # Saving again, as after a re-collection, adds nothing
+            await self.repository.save_many(messages[:4])
+            return await self.repository.count_by_partition()
+
+        counts = asyncio.run(scenario())
+
+        self.assertEqual(24, sum(counts.values()))
+        for recipient in ('agent1', 'agent2', 'agent3', 'agent9'):
+            shard = partition_of(recipient, 4)
+            self.assertIn((recipient,), self._shard_rows(shard))
+            for other in set(range(4)) - {shard}:
+                if os.path.exists(shard_url(self.db_url, other)[len('sqlite:///'):]):
+                    self.assertNotIn((recipient,), self._shard_rows(other))
+        self.assertEqual(set(partition_name(index) for index in range(4)), set(counts))
+
+    def test_lookups_and_updates_are_routed_by_recipient(self):
+        messages = self._messages()
+
+        async def scenario():
+            await self.repository.save_many(messages)
+            messages[0].delivered_at = START + timedelta(hours=1)
+            await self.repository.mark_delivered(messages[:1])
+            found = await self.repository.find_for_recipient(' AGENT1 ', since=START + timedelta(minutes=1))
+            latest = await self.repository.find_for_recipient('agent9', limit=100)
+            await self.repository.maintain()
+            return found, latest
+
+        found, latest = asyncio.run(scenario())
+
+        self.assertEqual(['message 3', 'message 6', 'message 9'], [message.data for message in found])
+        self.assertEqual(12, len(latest))
+        self.assertEqual(START + timedelta(hours=1), latest[0].delivered_at)
+        self.assertIsNone(latest[1].delivered_at)
+        self.assertEqual(messages[0].delivery_key, latest[0].delivery_key)
+
+    def test_spooled_bodies_are_stored_once(self):
+        body = ''.join(f"line {n}\n" for n in range(40000))
+        data = SpooledData.from_text(body, directory=self.tmpdir.name)
+        message = Message(from_address='agent0', to_address='agent1, agent2', data=data, created_at=START)
+
+        async def scenario():
+            await self.repository.save_many([message])
+            # A re-collected message adds nothing
+            await self.repository.save_many([message])
+            return [await self.repository.find_for_recipient(recipient) for recipient in ('agent1', 'agent2')]
+
+        for found in asyncio.run(scenario()):
+            self.assertEqual([body], [stored.data for stored in found])
+        data.close()
+
+    def test_background_persistence_writes_through_partitions(self):
+        persistence = BackgroundPersistence(self.repository)
+        messages = self._messages()
+        persistence.begin_cycle()
+        for message in messages:
+            persistence.saved(message)
+        persistence.delivered(messages[1])
+        persistence.end_cycle()
+        persistence.close()
+        self.assertEqual(0, persistence.errors)
+
+        found = asyncio.run(self.repository.find_for_recipient('agent2'))
+        self.assertEqual(4, len(found))
+        self.assertIsNotNone(found[0].delivered_at)
+
+    def test_messages_are_stored_per_delivery_route(self):
+        city_api = MagicMock(spec=CityAPI)
+        city_api.get_cities.return_value = {'addresses': [{
+            'FRBG/cityhall': 'http://cityhall/api/WAKEUP', 'FRBG/agent1': 'http://agent1/api/WAKEUP',
+            'FRBG/agent2': 'http://agent2/api/WAKEUP'}]}
+        external_api = MagicMock(spec=ExternalAPI)
+        external_api.collect_from_outbox.side_effect = lambda url: [Message(
+            from_address='FRBG/cityhall', to_address='FRBG/*', data='Town meeting', created_at=START)
+        ] if 'cityhall' in url else []
+        external_api.add_to_inbox.side_effect = lambda url, payload, idempotency_key=None: MagicMock(
+            status_code=503 if 'agent2' in url else 200)
+        persistence = BackgroundPersistence(self.repository)
+
+        service = MessageService(city_api, external_api, persistence=persistence)
+        service.process_messages()
+        service.fanout.close()
+        persistence.close()
+
+        async def lookups():
+            return [await self.repository.find_for_recipient(name) for name in ('FRBG/agent1', 'FRBG/agent2', 'FRBG/*')]
+
+        agent1, agent2, wildcard = asyncio.run(lookups())
+        self.assertIsNotNone(agent1[0].delivered_at)
+        # The failed recipient's copy is still pending
+        self.assertEqual([None], [message.delivered_at for message in agent2])
+        self.assertEqual([], wildcard)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import gzip
+import json
+import os
+import unittest
+from unittest.mock import MagicMock, patch
+
+from src.external_api import ExternalAPI
+from src.fanout import BroadcastFanout
+from src.idempotency import inbox_path
+from src.message import Message
+from src.metrics import Metrics
+from src.payload import InboxStream, SpooledData
+
+
+class TestSpooledPayloads(unittest.TestCase):
+    def setUp(self):
+        # Quotes, backslashes, newlines and non-ASCII text exercise both levels of JSON escaping
+        self.body = ('line "one"\n\\ path\tü € 😀 ' * 5000)
+
+    def test_spooled_data_round_trips_and_cleans_up(self):
+        spooled = SpooledData.from_text(self.body)
+        path = spooled.path
+
+        self.assertEqual(self.body, spooled.read())
+        self.assertEqual(len(self.body.encode('utf-8')), len(spooled))
+        self.assertEqual(self.body, ''.join(spooled.iter_text(chunk_size=1000)))
+
+        spooled.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_stream_matches_in_memory_blob(self):
+        msg = Message(from_address='FRBG/cityhall', to_address='FRBG/baker', data=self.body, id=3)
+        fanout = BroadcastFanout(MagicMock(spec=ExternalAPI))
+        expected = fanout.encode(msg)
+        sent_at = json.loads(json.loads(expected)['updated_files'][0]['file_content'])['delivered_at']
+
+        spooled_msg = Message(from_address='FRBG/cityhall', to_address='FRBG/baker',
+                              data=SpooledData.from_text(self.body), id=3,
+                              created_at=msg.created_at)
+        content = dict(spooled_msg.to_dict(include_data=False), delivered_at=sent_at)
+        stream = InboxStream(inbox_path(spooled_msg), content, spooled_msg.data, chunk_size=777)
+
+        self.assertEqual(expected, b''.join(stream))
+        self.assertEqual(expected, gzip.decompress(b''.join(stream.gzip())))
+        self.assertEqual(msg, spooled_msg)
+
+    def test_collect_spools_large_bodies_and_rejects_oversized_ones(self):
+        outbox = {"data": [{"result": [
+            {"file_content": {"message": {"data": "small", "from": "a", "to": "b"}}, "path": "1.json"},
+            {"file_content": {"message": {"data": "x" * 5000, "from": "a", "to": "b"}}, "path": "2.json"},
+            {"file_content": {"message": {"data": "y" * 50000, "from": "a", "to": "b"}}, "path": "3.json"},
+        ]}]}
+        metrics = Metrics()
+
+        with patch('requests.post') as mock_post:
+            mock_post.return_value.headers = {}
+            mock_post.return_value.raw.read.return_value = json.dumps(outbox).encode('utf-8')
+
+            api = ExternalAPI("test_token", metrics=metrics, spool_threshold=1000, max_message_bytes=10000)
+            messages = api.collect_from_outbox("http://agent1/api/WAKEUP/")
+
+        self.assertEqual(2, len(messages))
+        self.assertEqual("small", messages[0].data)
+        self.assertTrue(messages[1].is_spooled)
+        self.assertEqual("x" * 5000, messages[1].data.read())
+        self.assertEqual(1, metrics.snapshot()['counters']['outbox.messages_rejected'])
+
+    def test_oversized_compressed_response_is_rejected(self):
+        with patch('requests.post') as mock_post:
+            mock_post.return_value.headers = {'Content-Encoding': 'gzip'}
+            mock_post.return_value.raw.read.return_value = gzip.compress(b'[' + b'0,' * 100000 + b'0]')
+
+            api = ExternalAPI("test_token", metrics=Metrics(), max_response_bytes=10000)
+            with self.assertRaises(Exception):
+                api.collect_from_outbox("http://agent1/api/WAKEUP/")
+
+    def test_spooled_message_is_streamed_to_inbox(self):
+        with patch('requests.post') as mock_post:
+            mock_post.return_value.status_code = 200
+            api = ExternalAPI("test_token", metrics=Metrics())
+            msg = Message(from_address='a', to_address='b', data=SpooledData.from_text(self.body))
+
+            payload = BroadcastFanout(api).encode(msg)
+            api.add_to_inbox("http://agent2/api/RECEIVE_POST/", payload)
+
+            sent = mock_post.call_args.kwargs['data']
+            self.assertIsInstance(sent, InboxStream)
+            blob = json.loads(b''.join(sent))
+            self.assertEqual(self.body, json.loads(blob['updated_files'][0]['file_content'])['data'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from src.city_api import CityAPI
+from src.external_api import ExternalAPI
+from src.message import Message
+from src.message_service import MessageService
+from src.pipeline import Pipeline
+
+
+class TestPipeline(unittest.TestCase):
+    def test_items_flow_through_every_stage(self):
+        results = []
+        lock = threading.Lock()
+
+        def collect(item):
+            for i in range(3):
+                yield (item, i)
+
+        def deliver(item):
+            with lock:
+                results.append(item)
+
+        pipeline = Pipeline([
+            ('collect', collect, 2),
+            ('double', lambda item: [(item[0], item[1] * 2)], 3),
+            ('deliver', deliver, 2),
+        ], queue_size=2)
+        pipeline.run(['a', 'b'])
+
+        self.assertCountEqual([('a', 0), ('a', 2), ('a', 4), ('b', 0), ('b', 2), ('b', 4)], results)
+        stats = pipeline.stats()
+        self.assertEqual(2, stats['collect']['processed'])
+        self.assertEqual(6, stats['collect']['emitted'])
+        self.assertEqual(6, stats['deliver']['processed'])
+        self.assertEqual(0, stats['deliver']['queue_depth'])
+
+    def test_slow_stage_applies_backpressure(self):
+        produced = []
+
+        def source():
+            for i in range(20):
+                produced.append(i)
+                yield i
+
+        def slow(item):
+            time.sleep(0.01)
+
+        pipeline = Pipeline([('fast', lambda item: [item], 1), ('slow', slow, 1)], queue_size=2)
+        pipeline.run(source())
+
+        stats = pipeline.stats()
+        self.assertEqual(20, stats['slow']['processed'])
+        self.assertLessEqual(stats['slow']['max_queue_depth'], 2)
+        self.assertLessEqual(stats['fast']['max_queue_depth'], 2)
+
+    def test_errors_are_counted_and_skipped(self):
+        def parse(item):
+            if item == 2:
+                raise ValueError("bad item")
+            yield item
+
+        delivered = []
+        pipeline = Pipeline([('parse', parse, 1), ('deliver', delivered.append, 1)])
+        pipeline.run(range(4))
+
+        self.assertEqual([0, 1, 3], sorted(delivered))
+        self.assertEqual(1, pipeline.stats()['parse']['errors'])
+
+    def test_service_exposes_stage_stats(self):
+        city_api = MagicMock(spec=CityAPI)
+        external_api = MagicMock(spec=ExternalAPI)
+        city_api.get_cities.return_value = {
+            'addresses': [{'agent1': 'http://agent1/api/WAKEUP', 'agent2': 'http://agent2/api/WAKEUP'}]
+        }
+        external_api.collect_from_outbox.side_effect = lambda url: [
+            Message(from_address=url, to_address='agent1, agent2, nobody', data='hello')
+        ]
+
+        service = MessageService(city_api, external_api, stage_workers={'collect': 2, 'deliver': 3})
+        service.process_messages()
+
+        stats = service.pipeline_stats()
+        self.assertEqual(['collect', 'parse', 'resolve', 'encode', 'deliver'], list(stats))
+        self.assertEqual(2, stats['collect']['processed'])
+        self.assertEqual(3, stats['deliver']['workers'])
+        self.assertEqual(2, stats['deliver']['processed'])
+        self.assertEqual(4, external_api.add_to_inbox.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from src.city_api import CityAPI
+from src.external_api import ExternalAPI
+from src.message import Message
+from src.message_service import MessageService
+from src.polling import AdaptivePoller, record_wakes
+
+
+class TestAdaptivePoller(unittest.TestCase):
+    def setUp(self):
+        self.poller = AdaptivePoller(min_interval=60, max_interval=3600, alpha=0.5)
+
+    def test_unknown_agents_are_due(self):
+        self.assertEqual(['agent1', 'agent2'], self.poller.due(['agent1', 'agent2'], now=0))
+
+    def test_idle_agents_back_off_up_to_the_maximum(self):
+        intervals = [self.poller.record('agent1', 0, now=0) for _ in range(10)]
+
+        self.assertEqual(120, intervals[0])
+        self.assertEqual(sorted(intervals), intervals)
+        self.assertEqual(3600, intervals[-1])
+        self.assertEqual([], self.poller.due(['agent1'], now=3599))
+        self.assertEqual(['agent1'], self.poller.due(['agent1'], now=3600))
+
+    def test_activity_brings_the_interval_back_to_the_minimum(self):
+        for _ in range(10):
+            self.poller.record('agent1', 0, now=0)
+
+        self.assertEqual(60, self.poller.record('agent1', 5, now=100))
+        self.assertEqual(['agent1'], self.poller.due(['agent1'], now=160))
+
+    def test_wake_makes_an_agent_due_at_once(self):
+        for _ in range(10):
+            self.poller.record('agent1', 0, now=0)
+        self.poller.wake('agent1', now=500)
+
+        self.assertEqual(['agent1'], self.poller.due(['agent1'], now=500))
+        # An empty poll after a wake only backs off gently
+        self.assertEqual(120, self.poller.record('agent1', 0, now=500))
+
+    def test_wake_during_a_poll_is_kept(self):
+        for _ in range(10):
+            self.poller.record('agent1', 0, now=0)
+
+        # Woken by a delivery while its own outbox was being collected
+        self.poller.wake('agent1', now=505)
+        self.poller.record('agent1', 0, now=510, polled_at=500)
+        self.assertEqual(['agent1'], self.poller.due(['agent1'], now=510))
+
+        # A wake before the poll started was answered by that poll
+        self.poller.record('agent1', 0, now=520, polled_at=515)
+        self.assertEqual([], self.poller.due(['agent1'], now=520))
+
+    def test_state_and_wakes_survive_between_runs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'poll_state.json')
+            poller = AdaptivePoller(min_interval=60, max_interval=3600, path=path)
+            for _ in range(10):
+                poller.record('agent1', 0, now=0)
+                poller.record('agent2', 0, now=0)
+            poller.save()
+
+            record_wakes(path, ['agent2'], now=10)
+            restored = AdaptivePoller(min_interval=60, max_interval=3600, path=path)
+
+            self.assertEqual(poller.agents['agent1'], restored.agents['agent1'])
+            self.assertEqual(['agent2'], restored.due(['agent1', 'agent2'], now=10))
+            self.assertFalse(os.path.exists(f"{path}.wakes"))
+
+
+class TestAdaptivePollingService(unittest.TestCase):
+    def setUp(self):
+        self.city_api = MagicMock(spec=CityAPI)
+        self.city_api.get_cities.return_value = {'addresses': [
+            {'agent1': 'http://agent1/api/WAKEUP/', 'agent2': 'http://agent2/api/WAKEUP/'}
+        ]}
+        self.external_api = MagicMock(spec=ExternalAPI)
+        self.external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        self.poller = AdaptivePoller(min_interval=60, max_interval=3600)
+        self.service = MessageService(self.city_api, self.external_api, poller=self.poller)
+
+    def tearDown(self):
+        self.service.fanout.close()
+
+    def test_only_due_outboxes_are_polled(self):
+        def collect(url):
+            if url.startswith('http://agent1'):
+                return [Message(from_address='agent1', to_address='agent2', data='hi', id=1)]
+            return []
+        self.external_api.collect_from_outbox.side_effect = collect
+
+        self.service.process_messages()
+        self.assertEqual(2, self.external_api.collect_from_outbox.call_count)
+
+        # agent1 was polled just now, but agent2 received mail so it is polled again
+        self.external_api.collect_from_outbox.reset_mock()
+        self.external_api.collect_from_outbox.side_effect = lambda url: []
+        self.service.process_messages()
+        self.external_api.collect_from_outbox.assert_called_once_with('http://agent2/api/WAKEUP/')
+
+        self.external_api.collect_from_outbox.reset_mock()
+        self.service.process_messages()
+        self.external_api.collect_from_outbox.assert_not_called()
+        self.assertGreater(self.poller.agents['agent2'].interval, 60)
+
+    def test_failed_collection_is_not_an_empty_poll(self):
+        self.external_api.collect_from_outbox.side_effect = Exception("Connection refused")
+
+        self.service.process_messages()
+
+        self.assertEqual(['agent1', 'agent2'], self.poller.due(['agent1', 'agent2']))
+        self.assertEqual({}, self.poller.agents)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import json
+import os
+import pstats
+import tempfile
+import threading
+import unittest
+
+from src.external_api import ExternalAPI
+from src.profiling import CycleProfiler
+
+
+class Worker:
+    def handle(self, n):
+        return [str(i) * 10 for i in range(n)]
+
+    @staticmethod
+    def parse(text):
+        return text.split(',')
+
+
+def busy_in_thread():
+    results = []
+    thread = threading.Thread(target=lambda: results.append(Worker().handle(1000)))
+    thread.start()
+    thread.join()
+    return results
+
+
+class TestCycleProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_writes_profile_allocations_and_timings(self):
+        functions = [(Worker, 'handle'), (Worker, 'parse'), (ExternalAPI, '_extract_file_entries')]
+        with CycleProfiler(self.directory.name, functions=functions) as profiler:
+            busy_in_thread()
+            Worker.parse('a,b')
+            ExternalAPI('token')._extract_file_entries({'a': [{'file_content': '1'}, {'b': {'file_content': '2'}}]})
+
+        self.assertEqual(['allocations.txt', 'calls.txt', 'cycle.prof', 'timings.json'],
+                         sorted(os.listdir(profiler.path)))
+        with open(os.path.join(profiler.path, 'timings.json')) as f:
+            timings = json.load(f)
+        self.assertEqual(1, timings['Worker.handle']['count'])
+        self.assertEqual(1, timings['Worker.parse']['count'])
+        # The recursion inside _extract_file_entries is one call
+        self.assertEqual(1, timings['ExternalAPI._extract_file_entries']['count'])
+
+        # Work done in other threads is part of the call graph
+        functions = {name for _, _, name in pstats.Stats(os.path.join(profiler.path, 'cycle.prof')).stats}
+        self.assertIn('handle', functions)
+        with open(os.path.join(profiler.path, 'allocations.txt')) as f:
+            self.assertTrue(f.read().startswith('Peak traced memory'))
+
+    def test_originals_are_restored(self):
+        handle, parse = Worker.__dict__['handle'], Worker.__dict__['parse']
+        with self.assertRaises(RuntimeError):
+            with CycleProfiler(self.directory.name, functions=[(Worker, 'handle'), (Worker, 'parse')]):
+                self.assertIsNot(handle, Worker.__dict__['handle'])
+                self.assertEqual(['a', 'b'], Worker.parse('a,b'))
+                raise RuntimeError("cycle failed")
+
+        self.assertIs(handle, Worker.__dict__['handle'])
+        self.assertIs(parse, Worker.__dict__['parse'])
+        self.assertEqual(1, len(os.listdir(self.directory.name)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, broker, socketio
+from src.push import PushBroker, recipients_of
+
+
+class TestPushBroker(unittest.TestCase):
+    def test_messages_reach_only_their_recipients(self):
+        push = PushBroker()
+        cityhall = push.subscribe(['FRBG/cityhall'])
+        baker = push.subscribe(['frbg/baker'])
+        dashboard = push.subscribe([])
+
+        delivered = push.publish({'to': 'FRBG/Baker', 'data': 'bread'}, ['FRBG/Baker'])
+
+        self.assertEqual(2, delivered)
+        self.assertIsNone(cityhall.get(timeout=0))
+        self.assertEqual('bread', baker.get(timeout=0)['data'])
+        self.assertEqual('bread', dashboard.get(timeout=0)['data'])
+
+    def test_slow_subscriber_drops_instead_of_blocking(self):
+        push = PushBroker(max_pending=2)
+        subscription = push.subscribe(['agent1'])
+        for i in range(5):
+            push.publish({'n': i}, ['agent1'])
+
+        self.assertEqual(3, subscription.dropped)
+        self.assertEqual(0, subscription.get(timeout=0)['n'])
+
+    def test_closed_subscriptions_are_removed(self):
+        push = PushBroker()
+        subscription = push.subscribe(['agent1', 'agent2'])
+        subscription.close()
+
+        self.assertEqual(0, push.subscriber_count())
+        self.assertEqual(0, push.publish({'to': 'agent1'}, ['agent1']))
+
+    def test_recipients_of_free_form_messages(self):
+        self.assertEqual(['agent1', 'agent2'], recipients_of({'to': 'agent1, agent2'}))
+        self.assertEqual(['agent3'], recipients_of({'to_address': 'agent3'}))
+        self.assertEqual([], recipients_of("Hello, World!"))
+
+
+class TestPushEndpoints(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+
+    def _post(self, message):
+        return self.client.post('/messages', data=json.dumps({"message": message}), content_type='application/json')
+
+    def test_socketio_subscribers_receive_new_messages(self):
+        agent2 = socketio.test_client(app)
+        agent3 = socketio.test_client(app)
+        agent2.emit('subscribe', {'recipients': ['agent2']}, callback=True)
+        agent3.emit('subscribe', {'recipients': ['agent3']}, callback=True)
+        dashboard = socketio.test_client(app)
+        dashboard.emit('subscribe', {'recipients': ['agent2', '*']}, callback=True)
+
+        self._post({'from': 'agent1', 'to': 'agent2', 'data': 'ping'})
+
+        received = agent2.get_received()
+        self.assertEqual(1, len(received))
+        self.assertEqual('new_message', received[0]['name'])
+        self.assertEqual('ping', received[0]['args'][0]['data'])
+        self.assertEqual([], agent3.get_received())
+        self.assertEqual(1, len(dashboard.get_received()))
+
+        agent2.disconnect()
+        agent3.disconnect()
+        dashboard.disconnect()
+
+    def test_event_stream_pushes_new_messages(self):
+        response = self.client.get('/messages/stream?recipient=agent2', buffered=False)
+        events = iter(response.response)
+        self.assertEqual(b": connected\n\n", next(events))
+
+        self._post({'from': 'agent1', 'to': 'agent2', 'data': 'pong'})
+
+        event = next(events).decode('utf-8')
+        self.assertTrue(event.startswith("event: message\n"))
+        self.assertEqual('pong', json.loads(event.split("data: ", 1)[1])['data'])
+
+        response.close()
+        self.assertEqual(0, broker.subscriber_count())
+
+
+if __name__ == '__main__':
+    unittest.main()
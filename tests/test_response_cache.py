@@ -0,0 +1,82 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app as app_module
+from src.message_store import MemoryMessageStore
+from src.response_cache import ResponseCache
+
+
+class TestResponseCache(unittest.TestCase):
+    def test_a_new_version_drops_every_entry(self):
+        cache = ResponseCache()
+        cache.put('1', 'all', b'one')
+        self.assertEqual(b'one', cache.get('1', 'all'))
+        self.assertIsNone(cache.get('2', 'all'))
+        self.assertIsNone(cache.get('1', 'all'))
+
+    def test_least_recently_used_keys_are_evicted(self):
+        cache = ResponseCache(max_entries=2)
+        cache.put('1', 'a', b'a')
+        cache.put('1', 'b', b'b')
+        cache.get('1', 'a')
+        cache.put('1', 'c', b'c')
+        self.assertIsNone(cache.get('1', 'b'))
+        self.assertEqual(b'a', cache.get('1', 'a'))
+
+
+class TestConditionalGet(unittest.TestCase):
+    def setUp(self):
+        self.original_store, self.original_cache = app_module.store, app_module.response_cache
+        app_module.store = MemoryMessageStore()
+        app_module.response_cache = ResponseCache()
+        self.client = app_module.app.test_client()
+
+    def tearDown(self):
+        app_module.store, app_module.response_cache = self.original_store, self.original_cache
+
+    def _post(self, message):
+        self.assertEqual(201, self.client.post('/messages', json={'message': message}).status_code)
+
+    def test_unchanged_messages_are_answered_with_304(self):
+        self._post({'from': 'agent1', 'to': 'agent2', 'data': 'hello'})
+        first = self.client.get('/messages')
+        etag = first.headers['ETag']
+
+        again = self.client.get('/messages', headers={'If-None-Match': etag})
+        self.assertEqual(304, again.status_code)
+        self.assertEqual(b'', again.get_data())
+        self.assertEqual(etag, again.headers['ETag'])
+
+        self._post('another')
+        changed = self.client.get('/messages', headers={'If-None-Match': etag})
+        self.assertEqual(200, changed.status_code)
+        self.assertNotEqual(etag, changed.headers['ETag'])
+        self.assertEqual(2, len(changed.get_json()['messages']))
+
+    def test_bodies_are_served_from_the_cache_until_a_write(self):
+        self._post('hello')
+        self.client.get('/messages')
+        self.client.get('/messages')
+        self.assertEqual(1, app_module.response_cache.hits)
+        self._post('world')
+        self.assertEqual(['hello', 'world'], self.client.get('/messages').get_json()['messages'])
+
+    def test_filters_and_pages_have_their_own_entries(self):
+        for n in range(5):
+            self._post({'from': 'agent1', 'to': 'agent2' if n % 2 else 'agent3', 'data': n})
+
+        to_agent2 = self.client.get('/messages?recipient=Agent2')
+        self.assertEqual([1, 3], [message['data'] for message in to_agent2.get_json()['messages']])
+
+        page = self.client.get('/messages?page=2&per_page=2').get_json()
+        self.assertEqual([2, 3], [message['data'] for message in page['messages']])
+        self.assertEqual(5, page['total'])
+        self.assertNotEqual(to_agent2.headers['ETag'], self.client.get('/messages').headers['ETag'])
+        self.assertEqual(400, self.client.get('/messages?page=0').status_code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+from unittest.mock import MagicMock
+
+from src.city_api import CityAPI
+from src.external_api import ExternalAPI
+from src.message import Message
+from src.message_service import MessageService
+from src.routing import RoutingTable
+
+
+class TestRoutingTable(unittest.TestCase):
+    def setUp(self):
+        self.addresses = {
+            'FRBG/cityhall': 'http://loopai_web:5000/api/public/agent/1/action/WAKEUP/',
+            'FRBG/Agent_hwp2bg': 'http://loopai_web:5000/api/public/agent/2/action/WAKEUP/',
+            'BRLN/mayor': 'http://loopai_web:5000/api/public/agent/3/action/WAKEUP/',
+        }
+        self.table = RoutingTable(self.addresses, groups={'council': ['FRBG/cityhall', 'BRLN/mayor']})
+
+    def test_inbox_urls_are_precomputed(self):
+        route = self.table.lookup('FRBG/cityhall')
+        self.assertEqual('http://loopai_web:5000/api/public/agent/1/action/RECEIVE_POST/', route.inbox_url)
+
+    def test_names_are_normalized(self):
+        routes, unresolved = self.table.resolve([' frbg/CITYHALL '])
+        self.assertEqual(['FRBG/cityhall'], [route.agent_name for route in routes])
+        self.assertEqual([], unresolved)
+
+    def test_city_wildcard_excludes_sender(self):
+        routes, _ = self.table.resolve(['FRBG/*'], sender='FRBG/cityhall')
+        self.assertEqual(['FRBG/Agent_hwp2bg'], [route.agent_name for route in routes])
+
+    def test_group_and_duplicates_are_deduplicated(self):
+        routes, _ = self.table.resolve(['council', 'BRLN/mayor', 'BRLN/*'])
+        self.assertCountEqual(['FRBG/cityhall', 'BRLN/mayor'], [route.agent_name for route in routes])
+
+    def test_unknown_recipients_are_reported(self):
+        routes, unresolved = self.table.resolve(['FRBG/nobody', 'PARIS/*'])
+        self.assertEqual([], routes)
+        self.assertEqual(['FRBG/nobody', 'PARIS/*'], unresolved)
+
+    def test_service_reuses_table_until_directory_changes(self):
+        service = MessageService(MagicMock(spec=CityAPI), MagicMock(spec=ExternalAPI))
+        first = service.get_routing_table(dict(self.addresses))
+        self.assertIs(first, service.get_routing_table(dict(self.addresses)))
+
+        changed = dict(self.addresses, **{'FRBG/baker': 'http://loopai_web:5000/api/public/agent/4/action/WAKEUP/'})
+        self.assertIsNot(first, service.get_routing_table(changed))
+
+    def test_service_delivers_to_whole_city(self):
+        city_api = MagicMock(spec=CityAPI)
+        external_api = MagicMock(spec=ExternalAPI)
+        external_api.collect_from_outbox.return_value = [
+            Message(from_address='FRBG/cityhall', to_address='FRBG/*', data='Town meeting at noon')
+        ]
+        city_api.get_cities.return_value = {'addresses': [self.addresses]}
+
+        MessageService(city_api, external_api).process_messages()
+
+        urls = {call_args[0][0] for call_args in external_api.add_to_inbox.call_args_list}
+        self.assertEqual({'http://loopai_web:5000/api/public/agent/2/action/RECEIVE_POST/'}, urls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from src.city_api import CityAPI
+from src.external_api import ExternalAPI
+from src.message import Message
+from src.message_service import MessageService
+from src.scheduling import WeightedFairQueue, parse_priority_weights, priority_lane
+
+
+class TestPriorityLane(unittest.TestCase):
+    def test_names_and_numbers_map_to_lanes(self):
+        self.assertEqual('high', priority_lane('HIGH'))
+        self.assertEqual('low', priority_lane(' low '))
+        self.assertEqual('high', priority_lane(5))
+        self.assertEqual('low', priority_lane('-1'))
+        self.assertEqual('normal', priority_lane(0))
+        self.assertEqual('normal', priority_lane('urgent-ish'))
+        self.assertEqual('normal', priority_lane(None))
+
+
+class TestWeightedFairQueue(unittest.TestCase):
+    def test_weights_must_be_positive(self):
+        self.assertEqual({'high': 8.0, 'low': 0.5}, parse_priority_weights(' high=8, low=0.5 '))
+        self.assertEqual({}, parse_priority_weights(''))
+        for setting in ('high=0', 'low=-1', 'normal=nan', 'high'):
+            with self.assertRaises(Exception):
+                parse_priority_weights(setting)
+        with self.assertRaisesRegex(Exception, "'low' must be a positive number"):
+            WeightedFairQueue(lambda item: item, {'high': 8, 'low': 0})
+
+    def test_backlogged_lanes_share_by_weight(self):
+        wfq = WeightedFairQueue(lambda item: item[0], {'high': 3, 'low': 1})
+        for i in range(40):
+            wfq.put(('low', i))
+        for i in range(40):
+            wfq.put(('high', i))
+
+        served = [wfq.get() for _ in range(40)]
+        # Even though all low items were queued first, high gets three slots in four
+        self.assertEqual(30, [lane for lane, _ in served].count('high'))
+        self.assertEqual(list(range(10)), [i for lane, i in served if lane == 'low'])
+
+    def test_urgent_item_overtakes_a_long_backlog(self):
+        wfq = WeightedFairQueue(lambda item: item[0])
+        for i in range(1000):
+            wfq.put(('low', i))
+        for _ in range(5):
+            wfq.get()
+        wfq.put(('high', 'urgent'))
+
+        position = next(n for n in range(10) if wfq.get() == ('high', 'urgent'))
+        self.assertLessEqual(position, 1)
+
+    def test_unclassified_items_come_after_every_lane(self):
+        done = object()
+        wfq = WeightedFairQueue(lambda item: None if item is done else 'normal')
+        wfq.put(done)
+        wfq.put('a')
+        wfq.put('b')
+
+        self.assertEqual(['a', 'b', done], [wfq.get() for _ in range(3)])
+
+    def test_full_lane_does_not_block_other_lanes(self):
+        wfq = WeightedFairQueue(lambda item: item[0], maxsize=2)
+        wfq.put(('low', 1))
+        wfq.put(('low', 2))
+        blocked = threading.Thread(target=wfq.put, args=(('low', 3),), daemon=True)
+        blocked.start()
+
+        wfq.put(('high', 1))
+        self.assertEqual({'high': 1, 'normal': 0, 'low': 2}, wfq.lane_sizes())
+        self.assertTrue(blocked.is_alive())
+
+        self.assertEqual(('high', 1), wfq.get())
+        wfq.get()
+        blocked.join(timeout=5)
+        self.assertFalse(blocked.is_alive())
+        self.assertEqual(2, wfq.lane_sizes()['low'])
+
+
+class TestPriorityDelivery(unittest.TestCase):
+    def test_high_priority_messages_are_delivered_ahead_of_bulk(self):
+        city_api = MagicMock(spec=CityAPI)
+        city_api.get_cities.return_value = {'addresses': [
+            {'bulk': 'http://bulk/api/WAKEUP/', 'alarm': 'http://alarm/api/WAKEUP/', 'agent2': 'http://agent2/api/WAKEUP/'}
+        ]}
+        external_api = ExternalAPI(token='test')
+        bulk = [Message(from_address='bulk', to_address='agent2', data=f'newsletter {i}', id=i, priority='low')
+                for i in range(50)]
+        alarm = Message(from_address='alarm', to_address='agent2', data='fire!', id=99, priority='high')
+        external_api.collect_from_outbox = MagicMock(
+            side_effect=lambda url: bulk if url.startswith('http://bulk') else [alarm] if url.startswith('http://alarm') else [])
+
+        delivered = []
+
+        def add_to_inbox(url, payload, idempotency_key=None):
+            time.sleep(0.002)
+            delivered.append(payload)
+            return MagicMock(status_code=200)
+        external_api.add_to_inbox = add_to_inbox
+
+        service = MessageService(city_api, external_api, stage_workers={'collect': 1, 'deliver': 1}, queue_size=100)
+        service.process_messages()
+        service.fanout.close()
+
+        position = next(i for i, payload in enumerate(delivered) if b'fire!' in payload)
+        self.assertLess(position, 5)
+        self.assertEqual(1, service.pipeline_stats()['deliver']['served_by_priority']['high'])
+
+    def test_priority_is_read_from_the_outbox_message(self):
+        api = ExternalAPI(token='test')
+        messages = api.parse_outbox({'data': [
+            {'file_content': {'message': {'from': 'a', 'to': 'b', 'data': 'x', 'priority': 'High'}}},
+            {'file_content': {'message': {'from': 'a', 'to': 'b', 'data': 'y'}}},
+        ]}, 'test')
+
+        self.assertEqual(['high', None], [msg.priority for msg in messages])
+        self.assertEqual('high', messages[0].to_dict()['priority'])
+        self.assertNotIn('priority', messages[1].to_dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
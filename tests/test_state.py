@@ -0,0 +1,175 @@
+import shutil
+import socket
+import subprocess
+import time
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from src.city_api import CityAPI
+from src.external_api import ExternalAPI
+from src.fanout import BroadcastFanout
+from src.message import Message
+from src.message_service import MessageService
+from src.routing import Route
+from src.state import MemoryStateBackend, RedisStateBackend
+
+
+class StateBackendTests:
+    """Behaviour every state backend has; mixed into a TestCase that sets `self.state`."""
+
+    def test_values_expire(self):
+        self.state.set_many({'a': '1', 'b': '2'}, ttl=0.2)
+        self.state.set_many({'c': '3'})
+        self.assertEqual(['1', '2', '3', None], self.state.get_many(['a', 'b', 'c', 'd']))
+
+        time.sleep(0.3)
+        self.assertEqual([None, None, '3'], self.state.get_many(['a', 'b', 'c']))
+        self.state.delete(['c'])
+        self.assertEqual([None], self.state.get_many(['c']))
+
+    def test_claim_and_incr(self):
+        self.assertEqual([True, True], self.state.claim(['x', 'y'], ttl=60))
+        self.assertEqual([False, True, False], self.state.claim(['x', 'z', 'y'], ttl=60))
+
+        self.assertEqual([1, 2, 3], [self.state.incr('failures', ttl=0.2) for _ in range(3)])
+        time.sleep(0.3)
+        self.assertEqual(1, self.state.incr('failures', ttl=0.2))
+
+
+class TestMemoryStateBackend(StateBackendTests, unittest.TestCase):
+    def setUp(self):
+        self.state = MemoryStateBackend(sweep_every=2)
+
+    def test_workers_share_state(self):
+        city_api = MagicMock(spec=CityAPI)
+        city_api.get_cities.return_value = {'addresses': [{'agent0': 'http://agent0/api/WAKEUP',
+                                                           'agent1': 'http://agent1/api/WAKEUP'}]}
+        external_api = MagicMock(spec=ExternalAPI)
+        external_api.open_circuits.return_value = set()
+        external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        # Both workers collect the same message from agent0's outbox
+        external_api.collect_from_outbox.side_effect = lambda url: [Message(
+            from_address='agent0', to_address='agent1', data='hello', id=1,
+            created_at=datetime(2025, 1, 1))] if 'agent0' in url else []
+
+        for _ in range(2):
+            MessageService(city_api, external_api, state=self.state).process_messages()
+
+        self.assertEqual(1, external_api.add_to_inbox.call_count)
+
+    def test_undelivered_messages_are_collected_again(self):
+        city_api = MagicMock(spec=CityAPI)
+        city_api.get_cities.return_value = {'addresses': [{'agent0': 'http://agent0/api/WAKEUP',
+                                                           'agent1': 'http://agent1/api/WAKEUP'}]}
+        external_api = MagicMock(spec=ExternalAPI)
+        external_api.open_circuits.return_value = set()
+        external_api.add_to_inbox.return_value = MagicMock(status_code=503)
+        external_api.collect_from_outbox.side_effect = lambda url: [Message(
+            from_address='agent0', to_address='agent1', data='hello', id=1,
+            created_at=datetime(2025, 1, 1))] if 'agent0' in url else []
+
+        MessageService(city_api, external_api, state=self.state).process_messages()
+        # The failed delivery released the message's claim, so the next collection retries it
+        external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        MessageService(city_api, external_api, state=self.state).process_messages()
+        MessageService(city_api, external_api, state=self.state).process_messages()
+
+        self.assertEqual(2, external_api.add_to_inbox.call_count)
+
+    def _apis(self):
+        city_api = MagicMock(spec=CityAPI)
+        city_api.get_cities.return_value = {'addresses': [{'agent0': 'http://agent0/api/WAKEUP',
+                                                           'agent1': 'http://agent1/api/WAKEUP'}]}
+        external_api = MagicMock(spec=ExternalAPI)
+        external_api.open_circuits.return_value = set()
+        external_api.add_to_inbox.return_value = MagicMock(status_code=200)
+        external_api.collect_from_outbox.side_effect = lambda url: [Message(
+            from_address='agent0', to_address='agent1', data='hello', id=1,
+            created_at=datetime(2025, 1, 1))] if 'agent0' in url else []
+        return city_api, external_api
+
+    def test_in_flight_claims_expire_and_delivered_ones_last(self):
+        city_api, external_api = self._apis()
+        # A worker that claimed the message and died before delivering it
+        crashed = MessageService(city_api, external_api, state=self.state, claim_seconds=0.2)
+        self.assertEqual(1, len(crashed._unseen(external_api.collect_from_outbox('http://agent0/api/WAKEUP'))))
+
+        service = MessageService(city_api, external_api, state=self.state, claim_seconds=0.2, dedup_seconds=60)
+        service.process_messages()
+        self.assertEqual(0, external_api.add_to_inbox.call_count)
+        time.sleep(0.3)
+        service.process_messages()
+        time.sleep(0.3)
+        service.process_messages()
+
+        self.assertEqual(1, external_api.add_to_inbox.call_count)
+
+    def test_messages_that_fail_in_a_stage_are_released(self):
+        city_api, external_api = self._apis()
+        service = MessageService(city_api, external_api, state=self.state)
+        service._encode_stage = MagicMock(side_effect=Exception("Broken payload"))
+        service.process_messages()
+
+        MessageService(city_api, external_api, state=self.state).process_messages()
+
+        self.assertEqual(1, external_api.add_to_inbox.call_count)
+
+    def test_circuit_opens_after_failures(self):
+        http = MagicMock()
+        http.post.return_value = MagicMock(status_code=503, text='unavailable')
+        api = ExternalAPI('token', http=http, state=self.state, circuit_failures=2, circuit_seconds=60)
+        fanout = BroadcastFanout(api)
+        routes = [Route('agent1', 'http://agent1/api/RECEIVE_POST/')]
+
+        results = [fanout.send(routes, b'{}')[0] for _ in range(3)]
+
+        self.assertEqual([503, 503, None], [result.status_code for result in results])
+        self.assertEqual('circuit open', results[2].error)
+        self.assertEqual(2, http.post.call_count)
+        # A second worker sharing the state skips the inbox too
+        self.assertEqual({'http://agent1/api/RECEIVE_POST/'},
+                         ExternalAPI('token', state=self.state, circuit_failures=2).open_circuits(['http://agent1/api/RECEIVE_POST/']))
+        fanout.close()
+
+    def test_cities_are_cached(self):
+        http = MagicMock()
+        http.get.return_value.json.return_value = {'data': {'addresses': [{'agent0': 'http://agent0/api/WAKEUP'}]}}
+
+        workers = [CityAPI('http://city/api', http=http, state=self.state, cache_seconds=60) for _ in range(2)]
+
+        self.assertEqual(workers[0].get_cities(), workers[1].get_cities())
+        self.assertEqual(1, http.get.call_count)
+
+
+@unittest.skipUnless(shutil.which('redis-server'), "redis-server is not installed")
+class TestRedisStateBackend(StateBackendTests, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            cls.port = sock.getsockname()[1]
+        cls.server = subprocess.Popen(['redis-server', '--port', str(cls.port), '--save', '', '--appendonly', 'no'],
+                                      stdout=subprocess.DEVNULL)
+        for _ in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', cls.port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+
+    def setUp(self):
+        self.state = RedisStateBackend(f"redis://127.0.0.1:{self.port}/0", prefix=f"{self.id()}:")
+
+    def tearDown(self):
+        self.state.client.flushdb()
+        self.state.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import socket
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import h2.exceptions
+import httpx
+from requests.exceptions import ConnectionError, HTTPError
+
+from benchmarks.backend import LocalBackend
+from src.city_api import CityAPI
+from src.external_api import ExternalAPI
+from src.metrics import Metrics
+from src.transport import Http2Session
+
+
+class TestHttp2Session(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def _session(self, **kwargs):
+        session = Http2Session(prior_knowledge=True, metrics=self.metrics, **kwargs)
+        self.addCleanup(session.close)
+        return session
+
+    def test_concurrent_requests_share_one_connection(self):
+        backend = LocalBackend(delay=0.05)
+        self.addCleanup(backend.close)
+        session = self._session()
+
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            responses = list(executor.map(lambda i: session.post(f"{backend.url}/inbox/{i}", data=b'{}'), range(20)))
+
+        self.assertEqual({'HTTP/2'}, {response.http_version for response in responses})
+        self.assertEqual('/inbox/7', responses[7].json()['data']['path'])
+        self.assertEqual(1, backend.connections)
+        self.assertGreater(backend.max_concurrent, 1)
+        self.assertEqual(20, self.metrics.snapshot()['counters']['http.requests_http2'])
+
+    def test_refused_stream_id_is_sent_again(self):
+        backend = LocalBackend()
+        self.addCleanup(backend.close)
+        session = self._session()
+        send = session._send
+        refusals = []
+
+        def refuse_once(*args):
+            if not refusals:
+                refusals.append(True)
+                # How httpx reports h2 refusing a stream opened after a higher one
+                try:
+                    raise h2.exceptions.StreamIDTooLowError(1, 3)
+                except h2.exceptions.StreamIDTooLowError as e:
+                    raise httpx.LocalProtocolError(str(e)) from e
+            return send(*args)
+
+        session._send = refuse_once
+        response = session.post(f"{backend.url}/inbox/1", data=b'{}')
+
+        self.assertEqual('/inbox/1', response.json()['data']['path'])
+        self.assertEqual(1, self.metrics.snapshot()['counters']['http.stream_retries'])
+        self.assertTrue(session.http2)
+
+    def test_streamed_body_reads_through_raw(self):
+        backend = LocalBackend()
+        self.addCleanup(backend.close)
+
+        response = self._session().post(f"{backend.url}/outbox", json={'a': 1}, stream=True)
+        body = response.raw.read(5) + response.raw.read()
+        self.assertEqual(b'{"data": {"method": "POST", "path": "/outbox", "received": 7}}', body)
+
+    def test_falls_back_to_http11_when_the_server_rejects_http2(self):
+        backend = LocalBackend(http2=False)
+        self.addCleanup(backend.close)
+        session = self._session()
+
+        response = session.post(f"{backend.url}/inbox", data=b'{"x": 1}')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(8, response.json()['data']['received'])
+        self.assertFalse(session.http2)
+        self.assertEqual({'HTTP/1.1': 1}, backend.protocols)
+        self.assertEqual(1, self.metrics.snapshot()['counters']['http.fallbacks'])
+
+    def test_unreachable_server_does_not_downgrade(self):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        session = self._session()
+
+        with self.assertRaises(ConnectionError):
+            session.get(f"http://127.0.0.1:{port}/")
+        self.assertTrue(session.http2)
+
+    def test_error_statuses_raise_requests_errors(self):
+        backend = LocalBackend()
+        self.addCleanup(backend.close)
+        response = self._session().get(backend.url)
+        response.status_code = 503
+        with self.assertRaises(HTTPError):
+            response.raise_for_status()
+
+
+class TestClientsOverHttp2(unittest.TestCase):
+    def test_city_and_inbox_requests_use_the_session(self):
+        backend = LocalBackend()
+        self.addCleanup(backend.close)
+        session = Http2Session(prior_knowledge=True, metrics=Metrics())
+        self.addCleanup(session.close)
+
+        self.assertEqual('GET', CityAPI(f"{backend.url}/cities", http=session).get_cities()['method'])
+        response = ExternalAPI('token', http=session).add_to_inbox(f"{backend.url}/inbox", {'updated_files': []})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'HTTP/2': 2}, backend.protocols)
+
+
+if __name__ == '__main__':
+    unittest.main()